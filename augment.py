@@ -0,0 +1,234 @@
+# augment.py
+import cv2
+import numpy as np
+import torch
+
+from .config import DCFG
+from .telemetry import AugmentTimer
+
+"""
+Augmentation engine for the torch DataLoader path (transform_func / second_source_transform_func in preprocess.py).
+
+The old functions built a new A.Compose for every image only to change the resize size. Here every pipeline is
+built once, the random parameters of a whole batch are drawn at once (sample_params), and the stages run on a batch:
+    border (per image, sizes differ) -> noise (2nd source only, per image, only on the pixels that reach the crop)
+    -> resize + center crop 224 (per image) -> blur (per image) -> rotate90 (grouped by k on the stacked array)
+    -> one uint8 -> float tensor conversion of the stacked [N, H, W, C] array
+The distributions are the ones of the old A.Compose pipelines:
+    A.Resize(h, w, p): h, w ~ randint(224, 320), cv2 INTER_LINEAR, skipped with probability 1 - p
+    A.CenterCrop(224, 224): top left at ((h - 224)//2, (w - 224)//2)
+    A.Blur(blur_limit=5, p): box filter, ksize uniform in {3, 5}
+    A.RandomRotate90(p): np.rot90 with k uniform in {0, 1, 2, 3}
+A single image goes through the same batch code, see benchmark.benchmark_augmentation for the per-image cost.
+"""
+
+# per-stage augmentation cost (ms/image), no shared memory until dataset.instrument_loader enables it
+AUGMENT_TIMER = AugmentTimer(['border', 'noise', 'lines', 'resize_crop', 'blur', 'rotate90', 'to_tensor'])
+
+CROP_SIZE = 224
+
+
+def _resize_center_crop(image, h, w, size=CROP_SIZE):
+    """cv2.resize to (h, w) then a center crop, the crop is a view"""
+    image = cv2.resize(image, (w, h), interpolation=cv2.INTER_LINEAR)
+    y1, x1 = (h - size)//2, (w - size)//2
+    return image[y1:y1+size, x1:x1+size]
+
+
+def _center_crop(image, size=CROP_SIZE):
+    h, w = image.shape[:2]
+    y1, x1 = (h - size)//2, (w - size)//2
+    return image[y1:y1+size, x1:x1+size]
+
+
+def rotate90_batch(images, ks):
+    """In place np.rot90 of every square image of a stacked [N, H, W(, C)] array, images with the same k are rotated together"""
+    for k in (1, 2, 3):
+        ids = np.flatnonzero(ks == k)
+        if len(ids):
+            images[ids] = np.rot90(images[ids], k, axes=(1, 2))
+    return images
+
+
+def to_tensor_batch(images, scale=1/255.0):
+    """Stacked uint8 [N, H, W(, C)] -> float tensor [N, C, H, W], same values as ToTensorV2()(image)/255.0
+    The output is a permuted view of the NHWC array, ie. channels_last in memory, there is no transpose copy
+    """
+    if images.ndim == 3:
+        images = images[..., None]
+    tensor = torch.from_numpy(np.ascontiguousarray(images)).permute(0, 3, 1, 2).float()
+    return tensor.mul_(scale) if scale else tensor
+
+
+class AugmentPipeline:
+    """border_func -> random resize -> center crop -> random blur -> random rotate90 -> tensor
+    Init Arguments:
+        border_func: function(image) -> image, eg. preprocess._custom_opencv
+        resize_p, blur_p, rotate90_p: float, probability of every stage
+        blur_limit: int, largest (odd) box filter size, the sizes are 3, 5, ..., blur_limit
+        scale: float or None, multiplied to the output tensor (None keeps 0-255 values)
+    """
+    def __init__(self, border_func, resize_range=(224, 320), resize_p=1.0, blur_limit=5, blur_p=0.0, rotate90_p=0.0, scale=1/255.0):
+        self.border_func = border_func
+        self.resize_range = resize_range
+        self.resize_p = resize_p
+        self.blur_ksizes = np.arange(3, blur_limit + 1, 2)
+        self.blur_p = blur_p
+        self.rotate90_p = rotate90_p
+        self.scale = scale
+
+    def sample_params(self, batch_size, rng=np.random):
+        """Random parameters of a batch, rng: np.random (global state, seeded per DataLoader worker) or a RandomState"""
+        return {
+            'h': rng.randint(*self.resize_range, size=batch_size),
+            'w': rng.randint(*self.resize_range, size=batch_size),
+            'is_resized': rng.uniform(0, 1, size=batch_size) < self.resize_p,
+            'blur_ksize': np.where(rng.uniform(0, 1, size=batch_size) < self.blur_p, rng.choice(self.blur_ksizes, size=batch_size), 0),
+            'rotate90_k': np.where(rng.uniform(0, 1, size=batch_size) < self.rotate90_p, rng.randint(0, 4, size=batch_size), 0),
+        }
+
+    def _make_borders(self, images, params, rng):
+        with AUGMENT_TIMER.time('border', count=len(images)):
+            return [self.border_func(image) for image in images]
+
+    def apply_batch(self, images, rng=np.random):
+        """
+        Arguments:
+            images: list of uint8 [H, W, C] images (sizes may differ) or a stacked uint8 array
+        Returns:
+            float tensor [N, C, 224, 224]
+        """
+        params = self.sample_params(len(images), rng)
+        images = self._make_borders(images, params, rng)
+
+        with AUGMENT_TIMER.time('resize_crop', count=len(images)):
+            crops = [
+                _resize_center_crop(image, h, w) if is_resized else _center_crop(image)
+                for image, h, w, is_resized in zip(images, params['h'], params['w'], params['is_resized'])
+            ]
+            batch = np.stack(crops)
+
+        if self.blur_p:
+            with AUGMENT_TIMER.time('blur', count=len(batch)):
+                for i in np.flatnonzero(params['blur_ksize']):
+                    ksize = int(params['blur_ksize'][i])
+                    batch[i] = cv2.blur(batch[i], (ksize, ksize)).reshape(batch[i].shape)
+
+        if self.rotate90_p:
+            with AUGMENT_TIMER.time('rotate90', count=len(batch)):
+                batch = rotate90_batch(batch, params['rotate90_k'])
+
+        with AUGMENT_TIMER.time('to_tensor', count=len(batch)):
+            return to_tensor_batch(batch, self.scale)
+
+    def __call__(self, image, rng=np.random):
+        """Single image -> float tensor [C, 224, 224]"""
+        return self.apply_batch([image], rng)[0]
+
+
+# --------------------------
+# Second Source
+# --------------------------
+def _get_source_roi(in_size, size, is_resized, crop_size=CROP_SIZE, blur_radius=2):
+    """[start, end) of the input rows (or columns) that can reach the output of resize to size + center crop + blur"""
+    if not is_resized:
+        start = (in_size - crop_size)//2
+        return max(0, start - blur_radius), min(in_size, start + crop_size + blur_radius)
+    scale = in_size/size
+    start = (size - crop_size)//2
+    margin = int(np.ceil(blur_radius*scale)) + 1
+    return max(0, int(np.floor((start + 0.5)*scale - 0.5)) - margin), min(in_size, int(np.ceil((start + crop_size - 0.5)*scale - 0.5)) + 1 + margin)
+
+
+def add_second_source_noise(image, rng=np.random):
+    """Noise of the old _second_source_custom_opencv, in place on a uint8 image (or a view of it):
+        pixels < 100 (strokes): + N(0, 1), cast back to uint8 like the old in place assignment
+        then pixels > 200 (background): - randint(0, 50)
+    """
+    word_cond = image < 100
+    image[word_cond] = image[word_cond] + rng.normal(0, 1, size=np.count_nonzero(word_cond))
+    np.subtract(image, rng.randint(0, 50, size=image.shape, dtype=np.uint8), out=image, where=image > 200)
+    return image
+
+
+class SecondSourceAugmentPipeline(AugmentPipeline):
+    """Second source data: random crop + white / wrap borders + noise + fake scan lines, then AugmentPipeline stages"""
+    def __init__(self, resize_p=0.7, blur_limit=5, blur_p=0.7, rotate90_p=0.1, scale=1/255.0):
+        super().__init__(None, resize_p=resize_p, blur_limit=blur_limit, blur_p=blur_p, rotate90_p=rotate90_p, scale=scale)
+
+    @staticmethod
+    def sample_border_params(batch_size, rng=np.random):
+        p = rng.uniform(0, 1, size=batch_size)
+        p2 = rng.uniform(0, 1, size=batch_size)
+        return {
+            'n': rng.randint(30, 45, size=batch_size),
+            'border_p': rng.uniform(0, 1, size=batch_size),
+            'x': rng.randint(40, 160, size=batch_size), 'y': rng.randint(40, 160, size=batch_size),
+            'x2': rng.randint(260, 420, size=batch_size), 'y2': rng.randint(260, 420, size=batch_size),
+            'r': rng.randint(150, 215, size=batch_size),
+            'g': rng.randint(10, 50, size=batch_size),
+            'b': rng.randint(10, 50, size=batch_size),
+            'line_width': rng.randint(1, 5, size=batch_size),
+            'p': p,
+            'p2': p2,
+        }
+
+    @staticmethod
+    def _make_border(image, n, border_p):
+        image = image[n:300-n, n:300-n]
+        # 70% 在左右使用 wrap 在上下使用白色
+        if border_p > 0.3:
+            image = cv2.copyMakeBorder(image, 100, 100, 0, 0, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+            image = cv2.copyMakeBorder(image, 0, 0, 100, 100, cv2.BORDER_WRAP)
+        # 20% 在上下使用 wrap 在左右使用白色
+        elif border_p > 0.1:
+            image = cv2.copyMakeBorder(image, 0, 0, 100, 100, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+            image = cv2.copyMakeBorder(image, 100, 100, 0, 0, cv2.BORDER_WRAP)
+        # 10% 全部使用 wrap
+        else:
+            image = cv2.copyMakeBorder(image, 100, 100, 100, 100, cv2.BORDER_WRAP)
+        return image
+
+    @staticmethod
+    def _draw_lines(image, params, i):
+        x, y, x2, y2 = (int(params[key][i]) for key in ('x', 'y', 'x2', 'y2'))
+        p, p2 = params['p'][i], params['p2'][i]
+        color = (int(params['r'][i]), int(params['g'][i]), int(params['b'][i]))
+        line_width = int(params['line_width'][i])
+        delta_x, delta_y = (400, 0) if p > 0.5 else (0, 400)
+        # the second line also follows p (not p2), as in the original augmentation
+        delta_x2, delta_y2 = (-400, 0) if p > 0.5 else (0, -400)
+        # 加上擬原始數據線條
+        if p > 0.4:
+            image = cv2.line(image, (x, y), (x+delta_x, y+delta_y), color, line_width)
+        if p2 > 0.4:
+            image = cv2.line(image, (x2, y2), (x2+delta_x2, y2+delta_y2), color, line_width)
+        return image
+
+    def _make_borders(self, images, params, rng):
+        border_params = self.sample_border_params(len(images), rng)
+        with AUGMENT_TIMER.time('border', count=len(images)):
+            images = [self._make_border(image, n, border_p) for image, n, border_p in zip(images, border_params['n'], border_params['border_p'])]
+        with AUGMENT_TIMER.time('noise', count=len(images)):
+            # pixels outside the resize + crop (+ blur) window never reach the output, so they are not noised
+            for image, h, w, is_resized in zip(images, params['h'], params['w'], params['is_resized']):
+                y1, y2 = _get_source_roi(image.shape[0], h, is_resized)
+                x1, x2 = _get_source_roi(image.shape[1], w, is_resized)
+                add_second_source_noise(image[y1:y2, x1:x2], rng)
+        with AUGMENT_TIMER.time('lines', count=len(images)):
+            images = [self._draw_lines(image, border_params, i) for i, image in enumerate(images)]
+            if 'gray' in DCFG.transform_approach:
+                images = [cv2.cvtColor(image, cv2.COLOR_RGB2GRAY) for image in images]
+        return images
+
+
+class BatchAugmentCollate:
+    """DataLoader collate_fn running an AugmentPipeline on the raw images of a whole batch (in the worker process)
+    The dataset has to return raw uint8 images, ie. BasicDataset with transform=None
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+
+    def __call__(self, samples):
+        images, labels = zip(*samples)
+        return self.pipeline.apply_batch(list(images)), torch.as_tensor(labels)
@@ -0,0 +1,237 @@
+# averaging.py
+import os
+import csv
+from pathlib import Path
+
+import torch
+from torch import nn
+import pytorch_lightning as pl
+
+from .config import MCFG
+from .ckpt_catalog import CheckpointCatalog
+
+"""
+Weight averaging: accuracy for free at serving time, the averaged model has the same architecture, so the same latency.
+
+    EMACallback: exponential moving average of the weights (and the BN running stats) during training
+        (MCFG.ema_decay, every MCFG.ema_every_n_steps steps), kept in the checkpoints to resume and written as
+        checkpoints/ema.ckpt at the end of training
+    average_checkpoints: uniform "soup" of the top-k checkpoints kept by ModelCheckpoint(save_top_k=MCFG.save_top_k_models),
+        ranked with the checkpoint catalog (see ckpt_catalog.py)
+    recalibrate_bn: the BN running stats of averaged weights are not the stats of the averaged network, they are
+        recomputed on a calibration subset with a forward-only pass (no_grad, dropout off, cumulative averages)
+    compare_averaged_checkpoints: val acc / CPU latency of every single top-k checkpoint against the EMA and the soup,
+        with and without BN recalibration
+
+The averaged checkpoints are regular Lightning checkpoints, get_model(ckpt_path=...) loads them.
+"""
+
+EMA_CKPT_NAME = 'ema.ckpt'
+SOUP_CKPT_NAME = 'soup.ckpt'
+EXCLUDED_PREFIXES = ('teacher_model.',) # frozen teachers of the distillation classifiers
+
+
+def _get_averaged_state(pl_module):
+    return {key: value for key, value in pl_module.state_dict().items() if not key.startswith(EXCLUDED_PREFIXES)}
+
+
+class EMACallback(pl.Callback):
+    """
+    Init Arguments:
+        decay: float, ema = decay*ema + (1 - decay)*weights, warmed up as min(decay, (1 + n)/(10 + n)) for the n-th update
+        every_n_steps: int, update every n training steps
+        dirpath: folder of ema.ckpt (written at the end of training), None: not written
+    """
+    def __init__(self, decay=0.999, every_n_steps=1, dirpath=None):
+        super().__init__()
+        self.decay = decay
+        self.every_n_steps = every_n_steps
+        self.dirpath = Path(dirpath) if dirpath else None
+        self.ema_state = None
+        self.num_updates = 0
+
+    def on_fit_start(self, trainer, pl_module):
+        if self.ema_state is None:
+            self.ema_state = {key: value.detach().clone() for key, value in _get_averaged_state(pl_module).items()}
+        else: # restored from a checkpoint
+            device = next(pl_module.parameters()).device
+            self.ema_state = {key: value.to(device) for key, value in self.ema_state.items()}
+
+    @torch.no_grad()
+    def update(self, pl_module):
+        self.num_updates += 1
+        decay = min(self.decay, (1 + self.num_updates)/(10 + self.num_updates))
+        for key, value in _get_averaged_state(pl_module).items():
+            ema_value = self.ema_state[key]
+            if ema_value.is_floating_point():
+                ema_value.mul_(decay).add_(value.detach(), alpha=1 - decay)
+            else: # num_batches_tracked
+                ema_value.copy_(value)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        if (trainer.global_step + 1) % self.every_n_steps == 0:
+            self.update(pl_module)
+
+    def swap(self, pl_module):
+        """Exchange the weights of pl_module and the EMA weights (call twice to restore)"""
+        model_state = _get_averaged_state(pl_module)
+        with torch.no_grad():
+            for key, ema_value in self.ema_state.items():
+                model_value = model_state[key]
+                tmp = model_value.detach().clone()
+                model_value.copy_(ema_value)
+                ema_value.copy_(tmp)
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint):
+        return {'ema_state': {key: value.cpu() for key, value in self.ema_state.items()}, 'num_updates': self.num_updates}
+
+    def on_load_checkpoint(self, trainer, pl_module, callback_state):
+        self.ema_state = callback_state['ema_state']
+        self.num_updates = callback_state['num_updates']
+
+    def on_train_end(self, trainer, pl_module):
+        if self.dirpath is None or not trainer.is_global_zero:
+            return
+        self.swap(pl_module)
+        try:
+            trainer.save_checkpoint(self.dirpath / EMA_CKPT_NAME)
+        finally:
+            self.swap(pl_module)
+        print(f"EMA weights ({self.num_updates} updates, decay {self.decay}) saved to {self.dirpath / EMA_CKPT_NAME}")
+
+# --------------------------
+# Checkpoint soup
+# --------------------------
+def get_top_k_ckpt_paths(ckpt_folder, k=None, target_metric=None):
+    """Best k checkpoints of a version_folder/checkpoints folder for target_metric (default MCFG.monitor)"""
+    ckpt_paths = CheckpointCatalog(ckpt_folder).get_top_k(target_metric or MCFG.monitor, k)
+    assert ckpt_paths, f"no checkpoint recorded in the catalog of {ckpt_folder}"
+    return ckpt_paths
+
+def save_state_dict_checkpoint(template_ckpt, state_dict, output_path, **info):
+    """Lightning checkpoint with the hyper parameters of template_ckpt and the weights of state_dict (no optimizer states)"""
+    excluded_keys = ('state_dict', 'optimizer_states', 'lr_schedulers', 'callbacks')
+    checkpoint = {key: value for key, value in template_ckpt.items() if key not in excluded_keys}
+    checkpoint.update({'state_dict': state_dict, **info})
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    torch.save(checkpoint, output_path)
+    return output_path
+
+def average_checkpoints(ckpt_paths, output_path=None):
+    """Uniform average of the weights of ckpt_paths (integer buffers are taken from the first one)
+    Returns:
+        output_path (default: checkpoints folder of the first one / soup.ckpt)
+    """
+    output_path = output_path or Path(ckpt_paths[0]).parent / SOUP_CKPT_NAME
+    template_ckpt = torch.load(ckpt_paths[0], map_location='cpu')
+    averaged = {
+        key: value.double() if value.is_floating_point() else value.clone()
+        for key, value in template_ckpt['state_dict'].items() if not key.startswith(EXCLUDED_PREFIXES)
+    }
+    for ckpt_path in ckpt_paths[1:]:
+        state_dict = torch.load(ckpt_path, map_location='cpu')['state_dict']
+        for key, value in averaged.items():
+            if value.is_floating_point():
+                value.add_(state_dict[key].double())
+    state_dict = {
+        key: (value/len(ckpt_paths)).to(template_ckpt['state_dict'][key].dtype) if value.is_floating_point() else value
+        for key, value in averaged.items()
+    }
+    return save_state_dict_checkpoint(template_ckpt, state_dict, output_path, averaged_from=[Path(ckpt_path).name for ckpt_path in ckpt_paths])
+
+# --------------------------
+# BN recalibration
+# --------------------------
+def _get_images(batch):
+    """Image batch of a DALI ([{'data' | 'aug_data': ...}]) or a torch DataLoader ((images, labels)) batch"""
+    if isinstance(batch, (list, tuple)) and isinstance(batch[0], dict):
+        return batch[0]['data'] if 'data' in batch[0] else batch[0]['aug_data']
+    return batch[0]
+
+def recalibrate_bn(model, loader, num_batches=100, device=None):
+    """Recompute the running stats of every BN layer of model (in place) as the cumulative averages of
+    num_batches batches of loader, forward only: no gradient, every other layer (dropout...) in eval mode
+    """
+    bn_layers = [module for module in model.modules() if isinstance(module, nn.modules.batchnorm._BatchNorm)]
+    if not bn_layers:
+        return model
+    device = device or next(model.parameters()).device
+    momenta = [bn.momentum for bn in bn_layers]
+    was_training = model.training
+    model.eval()
+    for bn in bn_layers:
+        bn.reset_running_stats()
+        bn.momentum = None # cumulative moving average
+        bn.train()
+    try:
+        with torch.no_grad():
+            for i, batch in enumerate(loader):
+                if i >= num_batches:
+                    break
+                model(_get_images(batch).float().to(device))
+    finally:
+        for bn, momentum in zip(bn_layers, momenta):
+            bn.momentum = momentum
+        model.train(was_training)
+        if hasattr(loader, 'reset'): # DALI iterators stopped before the end of the epoch
+            loader.reset()
+    return model
+
+def save_recalibrated_checkpoint(model, ckpt_path, output_path=None, **info):
+    output_path = output_path or Path(ckpt_path).with_name(f"{Path(ckpt_path).stem}_bn.ckpt")
+    template_ckpt = torch.load(ckpt_path, map_location='cpu')
+    state_dict = {key: value.cpu() for key, value in _get_averaged_state(model).items()}
+    return save_state_dict_checkpoint(template_ckpt, state_dict, output_path, is_bn_recalibrated=True, **info)
+
+# --------------------------
+# Report
+# --------------------------
+def compare_averaged_checkpoints(ckpt_folder, k=None, datamodule_fn=None, raw_model_type=None, model_class_name=None,
+        target_metric=None, num_calibration_batches=100, num_threads=1, report_path=None):
+    """Val acc and CPU latency of the top-k single checkpoints, the EMA checkpoint (if any) and their soup,
+    the averaged ones also after BN recalibration on num_calibration_batches training batches
+    Arguments:
+        ckpt_folder: version_folder/checkpoints
+        datamodule_fn: function() -> datamodule, default dataset.create_datamodule
+    Returns:
+        list of row dicts
+    """
+    from .model import get_model
+    from .prune import validate_accuracy
+    from .distill import measure_cpu_latency
+    if datamodule_fn is None:
+        from .dataset import create_datamodule as datamodule_fn
+    ckpt_folder = Path(ckpt_folder)
+    ckpt_paths = get_top_k_ckpt_paths(ckpt_folder, k or MCFG.save_top_k_models, target_metric)
+
+    def load_model(ckpt_path):
+        return get_model(raw_model_type=raw_model_type, is_pretrained=False, model_class_name=model_class_name, ckpt_path=ckpt_path, is_continued_training=False)
+
+    def evaluate(name, ckpt_path):
+        model = load_model(ckpt_path)
+        row = {'name': name, 'ckpt_path': str(ckpt_path), 'val_acc': validate_accuracy(model, datamodule_fn()), **measure_cpu_latency(model, num_threads=num_threads)}
+        print(row)
+        return row, model
+
+    rows = [evaluate(f"single_{i}", ckpt_path)[0] for i, ckpt_path in enumerate(ckpt_paths)]
+    averaged = [('soup', average_checkpoints(ckpt_paths))] if len(ckpt_paths) > 1 else []
+    if (ckpt_folder / EMA_CKPT_NAME).exists():
+        averaged.append(('ema', ckpt_folder / EMA_CKPT_NAME))
+    for name, ckpt_path in averaged:
+        row, model = evaluate(name, ckpt_path)
+        rows.append(row)
+        recalibrate_bn(model, datamodule_fn().train_dataloader(), num_calibration_batches)
+        rows.append(evaluate(f"{name}_bn", save_recalibrated_checkpoint(model, ckpt_path, num_calibration_batches=num_calibration_batches))[0])
+
+    best_single_acc = max(row['val_acc'] for row in rows if row['name'].startswith('single'))
+    print(f"{'name':<12}{'val_acc':>9}{'gain':>9}{'median(ms)':>12}")
+    for row in rows:
+        row['gain'] = row['val_acc'] - best_single_acc
+        print(f"{row['name']:<12}{row['val_acc']:>9.4f}{row['gain']:>+9.4f}{row['median_ms']:>12.2f}")
+    if report_path:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, 'w', newline='') as out_file:
+            writer = csv.DictWriter(out_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
@@ -0,0 +1,519 @@
+# benchmark.py
+import os
+import time
+import tempfile
+
+"""
+Micro benchmarks for the data / training hot paths, every function prints a small report and returns the raw numbers.
+"""
+
+def _timeit(func, repeat=3):
+    """Return the best wall time of several runs and the result of the last run"""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+# --------------------------
+# Manifest
+# --------------------------
+def benchmark_manifest_loading(txt_path=None, num_rows=2_000_000, num_unique_paths=100_000):
+    """Compare reading a legacy "path label" txt file against loading its manifest.
+    If txt_path is None a synthetic txt file with num_rows rows is written to a temp folder.
+    """
+    from .utils import FileHandler
+    from .manifest import Manifest, convert_to_manifest
+
+    if txt_path is None:
+        txt_path = os.path.join(tempfile.mkdtemp(), 'synthetic_train_balanced_images.txt')
+        with open(txt_path, 'w', encoding='utf-8') as out_file:
+            out_file.writelines(f'/content/YuShanTrain/{i % num_unique_paths}_宋.jpg {i % 801}\n' for i in range(num_rows))
+
+    manifest_path = convert_to_manifest(txt_path)
+    txt_time, _ = _timeit(lambda: FileHandler.read_path_and_label_from_txt(txt_path))
+    load_time, manifest = _timeit(lambda: Manifest.load(manifest_path))
+    list_time, _ = _timeit(lambda: Manifest.load(manifest_path).to_paths_and_labels()) # lazy paths, int labels
+    disk_size = sum(os.path.getsize(os.path.join(manifest_path, name)) for name in os.listdir(manifest_path))
+    results = {
+        'rows': len(manifest),
+        'txt_read_s': txt_time,
+        'manifest_load_s': load_time,
+        'manifest_to_paths_and_labels_s': list_time,
+        'txt_size_mb': os.path.getsize(txt_path) / 2**20,
+        'manifest_size_mb': disk_size / 2**20,
+    }
+    print('manifest loading: ', results)
+    return results
+
+# --------------------------
+# Metrics
+# --------------------------
+def benchmark_metric_accumulation(device=None, num_steps=500, batch_size=128, class_num=801):
+    """Per-step overhead of the old `.item()` counting against MetricAccumulator (one sync at the end)"""
+    import torch
+    from .metrics import MetricAccumulator
+
+    device = device or ('cuda:0' if torch.cuda.is_available() else 'cpu')
+    logits = torch.randn(batch_size, class_num, device=device)
+    targets = torch.randint(class_num, (batch_size,), device=device)
+    loss = torch.nn.functional.cross_entropy(logits, targets)
+
+    def item_counting():
+        corrects, total = 0, 0
+        for _ in range(num_steps):
+            _, y_hat = torch.max(logits, dim=1)
+            corrects += torch.sum(y_hat == targets).item()
+            total += targets.shape[0]
+        return corrects/total
+
+    accumulator = MetricAccumulator(class_num=class_num).to(device)
+    def accumulating():
+        accumulator.reset()
+        for _ in range(num_steps):
+            _, y_hat = torch.max(logits, dim=1)
+            accumulator.update(y_hat, targets, loss)
+        return accumulator.compute()['acc']
+
+    item_time, item_acc = _timeit(item_counting)
+    accumulator_time, accumulator_acc = _timeit(accumulating)
+    assert abs(item_acc - accumulator_acc) < 1e-9
+    results = {
+        'device': str(device),
+        'item_us_per_step': item_time/num_steps*1e6,
+        'accumulator_us_per_step': accumulator_time/num_steps*1e6,
+    }
+    print('metric accumulation: ', results)
+    return results
+
+# --------------------------
+# CPU DDP scaling
+# --------------------------
+def benchmark_cpu_ddp_scaling(make_model, make_datamodule, process_counts=(1, 2, 4, 8), num_steps=50, batch_size=None):
+    """Training throughput of CPU DDP (gloo) with 1..N local processes, every process gets cpu count / N threads
+    Arguments:
+        make_model, make_datamodule: functions returning a fresh classifier / datamodule (eg. a YushanDataModule)
+    Returns:
+        list of dict {'processes', 'threads_per_process', 'images_per_s', 'speedup'}
+    """
+    import pytorch_lightning as pl
+    from .callbacks import CPUThreadsCallback
+    from .config import DCFG
+
+    batch_size = batch_size or DCFG.batch_size
+    results = []
+    for num_processes in process_counts:
+        callback = CPUThreadsCallback(num_processes=num_processes)
+        trainer = pl.Trainer(
+            max_epochs=1,
+            limit_train_batches=num_steps,
+            limit_val_batches=0,
+            logger=False,
+            checkpoint_callback=False,
+            callbacks=[callback],
+            accelerator='ddp_cpu' if num_processes > 1 else None,
+            num_processes=num_processes,
+        )
+        start = time.perf_counter()
+        trainer.fit(make_model(), datamodule=make_datamodule())
+        elapsed = time.perf_counter() - start
+        results.append({
+            'processes': num_processes,
+            'threads_per_process': callback.num_threads,
+            'images_per_s': num_steps*batch_size*num_processes/elapsed,
+        })
+        results[-1]['speedup'] = results[-1]['images_per_s']/results[0]['images_per_s']
+        print(results[-1])
+    return results
+
+# --------------------------
+# Augmentation
+# --------------------------
+def _make_synthetic_word_images(num_images, seed=0, size_range=(60, 160), is_second_source=False):
+    """White images with a few dark strokes, 300x300 for the second source, random sizes otherwise"""
+    import cv2
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    images = []
+    for _ in range(num_images):
+        h, w = (300, 300) if is_second_source else rng.randint(*size_range, size=2)
+        image = np.full((h, w, 3), 235, dtype=np.uint8) + rng.randint(0, 20, size=(h, w, 3)).astype(np.uint8)
+        for _ in range(5):
+            x1, x2 = rng.randint(0, w, size=2)
+            y1, y2 = rng.randint(0, h, size=2)
+            cv2.line(image, (int(x1), int(y1)), (int(x2), int(y2)), (20, 20, 20), int(rng.randint(2, 8)))
+        images.append(image)
+    return images
+
+
+def _legacy_transform_func(image):
+    """transform_func before augment.py: a new A.Compose per image"""
+    import numpy as np
+    import albumentations as A
+    from albumentations.pytorch.transforms import ToTensorV2
+    from .preprocess import _custom_opencv
+    h = np.random.randint(224, 320)
+    w = np.random.randint(224, 320)
+    transform = A.Compose([A.Resize(h, w), A.CenterCrop(224, 224), A.RandomRotate90(p=0.2), ToTensorV2()])
+    return transform(image=_custom_opencv(image))['image']/255.0
+
+
+def _legacy_second_source_transform_func(image):
+    """second_source_transform_func before augment.py (boolean mask noise, a new A.Compose per image), scaled to 0~1"""
+    import cv2
+    import numpy as np
+    import albumentations as A
+    from albumentations.pytorch.transforms import ToTensorV2
+    n = np.random.randint(30, 45)
+    img = image[n:300-n, n:300-n]
+    p = np.random.uniform(0, 1)
+    if p > 0.3:
+        img = cv2.copyMakeBorder(img, 100, 100, 0, 0, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+        img = cv2.copyMakeBorder(img, 0, 0, 100, 100, cv2.BORDER_WRAP)
+    elif p > 0.1:
+        img = cv2.copyMakeBorder(img, 0, 0, 100, 100, cv2.BORDER_CONSTANT, value=[255, 255, 255])
+        img = cv2.copyMakeBorder(img, 100, 100, 0, 0, cv2.BORDER_WRAP)
+    else:
+        img = cv2.copyMakeBorder(img, 100, 100, 100, 100, cv2.BORDER_WRAP)
+    y, x = np.random.randint(40, 160), np.random.randint(40, 160)
+    p = np.random.uniform(0, 1)
+    delta_x, delta_y = (400, 0) if p > 0.5 else (0, 400)
+    r, b, g, w = np.random.randint(150, 215), np.random.randint(10, 50), np.random.randint(10, 50), np.random.randint(1, 5)
+    x2, y2 = np.random.randint(260, 420), np.random.randint(260, 420)
+    p2 = np.random.uniform(0, 1)
+    delta_x2, delta_y2 = (-400, 0) if p > 0.5 else (0, -400)
+    word_cond = img < 100
+    img[word_cond] = img[word_cond] + np.random.normal(0, 1, size=img[word_cond].shape)
+    bg_cond = img > 200
+    img[bg_cond] = img[bg_cond] - np.random.randint(low=0, high=50, size=img[bg_cond].shape)
+    if p > 0.4:
+        img = cv2.line(img, (x, y), (x+delta_x, y+delta_y), (r, g, b), w)
+    if p2 > 0.4:
+        img = cv2.line(img, (x2, y2), (x2+delta_x2, y2+delta_y2), (r, g, b), w)
+    h, w = np.random.randint(224, 320), np.random.randint(224, 320)
+    transform = A.Compose([A.Resize(h, w, p=0.7), A.CenterCrop(224, 224), A.Blur(blur_limit=5, p=0.7), A.RandomRotate90(p=0.1), ToTensorV2()])
+    return transform(image=img)['image']/255.0
+
+
+def _get_output_stats(outputs):
+    """Pixel mean / std and the mean image of a stack of augmented views of the same image"""
+    import torch
+    outputs = torch.stack(outputs).float()
+    return {'mean': outputs.mean().item(), 'std': outputs.std().item(), 'mean_image': outputs.mean(dim=0)}
+
+
+def benchmark_augmentation(num_images=256, batch_size=64, num_views=400, seed=0):
+    """Per-image cost of the old per-call A.Compose augmentations against augment.py (single image and batched),
+    plus a statistical check: num_views augmented views of one image from both, compared by pixel mean / std and
+    the mean absolute difference of their mean images (the noise floor is the same number between two runs of the
+    old function)
+    """
+    import numpy as np
+    from .preprocess import transform_func, second_source_transform_func
+
+    rows = []
+    cases = [
+        ('transform_func', _legacy_transform_func, transform_func, False),
+        ('second_source_transform_func', _legacy_second_source_transform_func, second_source_transform_func, True),
+    ]
+    for name, legacy_func, new_func, is_second_source in cases:
+        images = _make_synthetic_word_images(num_images, seed=seed, is_second_source=is_second_source)
+        batches = [images[i:i+batch_size] for i in range(0, num_images, batch_size)]
+        legacy_time, _ = _timeit(lambda: [legacy_func(image.copy()) for image in images])
+        single_time, _ = _timeit(lambda: [new_func(image.copy()) for image in images])
+        batch_time, _ = _timeit(lambda: [new_func.pipeline.apply_batch([image.copy() for image in batch]) for batch in batches])
+
+        np.random.seed(seed)
+        legacy_stats = _get_output_stats([legacy_func(images[0].copy()) for _ in range(num_views)])
+        legacy_stats_2 = _get_output_stats([legacy_func(images[0].copy()) for _ in range(num_views)])
+        new_stats = _get_output_stats(list(new_func.pipeline.apply_batch([images[0].copy() for _ in range(num_views)])))
+        row = {
+            'augmentation': name,
+            'legacy_ms_per_image': 1000*legacy_time/num_images,
+            'single_ms_per_image': 1000*single_time/num_images,
+            'batch_ms_per_image': 1000*batch_time/num_images,
+            'legacy_mean': legacy_stats['mean'], 'new_mean': new_stats['mean'],
+            'legacy_std': legacy_stats['std'], 'new_std': new_stats['std'],
+            'mean_image_diff': (legacy_stats['mean_image'] - new_stats['mean_image']).abs().mean().item(),
+            'mean_image_diff_noise_floor': (legacy_stats['mean_image'] - legacy_stats_2['mean_image']).abs().mean().item(),
+        }
+        rows.append(row)
+        print(f"{name}: legacy {row['legacy_ms_per_image']:.2f} ms/image, single {row['single_ms_per_image']:.2f} ms/image, "
+              f"batch {row['batch_ms_per_image']:.2f} ms/image | mean {row['legacy_mean']:.4f} vs {row['new_mean']:.4f}, "
+              f"std {row['legacy_std']:.4f} vs {row['new_std']:.4f}, mean image diff {row['mean_image_diff']:.4f} "
+              f"(noise floor {row['mean_image_diff_noise_floor']:.4f})")
+    return rows
+
+# --------------------------
+# Border padding
+# --------------------------
+def _sample_image_shapes(num_images, image_paths=None, seed=0, size_range=(30, 250)):
+    """(h, w) of the first num_images image_paths, or random shapes of word crops when no paths are given"""
+    import numpy as np
+    if image_paths:
+        from .utils import ImageReader
+        return [ImageReader.read_image_RGB_cv2(path).shape[:2] for path in image_paths[:num_images]]
+    rng = np.random.RandomState(seed)
+    return [tuple(rng.randint(*size_range, size=2)) for _ in range(num_images)]
+
+
+def check_border_parity(num_images=2000, image_paths=None, seed=0):
+    """Bit exact check of border.pad_image / pad_batch (numpy gather) against cv2.copyMakeBorder, both modes,
+    with the dali_custom_func padding sizes, including borders wider than the image
+    """
+    import cv2
+    import numpy as np
+    from .border import pad_image, pad_batch, CV2_BORDER_FLAGS
+    from .preprocess import _calculate_dhdw_half
+
+    rng = np.random.RandomState(seed)
+    num_mismatches = {mode: 0 for mode in CV2_BORDER_FLAGS}
+    for h, w in _sample_image_shapes(num_images, image_paths, seed):
+        images = rng.randint(0, 256, size=(2, h, w, 3)).astype(np.uint8)
+        dh_half, dw_half = _calculate_dhdw_half(h, w)
+        for mode, flag in CV2_BORDER_FLAGS.items():
+            expected = [cv2.copyMakeBorder(image, dh_half, dh_half, dw_half, dw_half, flag) for image in images]
+            gathered = pad_image(images[0], dh_half, dh_half, dw_half, dw_half, mode, backend='gather')
+            batched = pad_batch(images, dh_half, dh_half, dw_half, dw_half, mode)
+            is_equal = np.array_equal(gathered, expected[0]) and all(np.array_equal(b, e) for b, e in zip(batched, expected))
+            num_mismatches[mode] += not is_equal
+    print(f'border parity against cv2 over {num_images} shapes, mismatches: {num_mismatches}')
+    return num_mismatches
+
+
+def benchmark_border(num_images=2000, batch_size=64, image_paths=None, seed=0):
+    """Per-image time of the square padding of dali_custom_func: cv2.copyMakeBorder, numpy gather (one image) and
+    numpy gather on batches of same-shaped images, over the image size distribution (of image_paths if given)
+    """
+    import cv2
+    import numpy as np
+    from .border import pad_image, pad_batch, CV2_BORDER_FLAGS
+    from .preprocess import _calculate_dhdw_half
+
+    rng = np.random.RandomState(seed)
+    shapes = _sample_image_shapes(num_images, image_paths, seed)
+    images = [rng.randint(0, 256, size=(h, w, 3)).astype(np.uint8) for h, w in shapes]
+    pads = [_calculate_dhdw_half(h, w) for h, w in shapes]
+    results = []
+    for mode, flag in CV2_BORDER_FLAGS.items():
+        cv2_time, _ = _timeit(lambda: [cv2.copyMakeBorder(image, dh, dh, dw, dw, flag) for image, (dh, dw) in zip(images, pads)])
+        gather_time, _ = _timeit(lambda: [pad_image(image, dh, dh, dw, dw, mode, backend='gather') for image, (dh, dw) in zip(images, pads)])
+        batch = np.stack([images[0]]*batch_size)
+        dh, dw = pads[0]
+        batch_time, _ = _timeit(lambda: pad_batch(batch, dh, dh, dw, dw, mode))
+        results.append({
+            'mode': mode,
+            'cv2_us_per_image': cv2_time/num_images*1e6,
+            'gather_us_per_image': gather_time/num_images*1e6,
+            'batch_gather_us_per_image': batch_time/batch_size*1e6,
+            'batch_image_shape': shapes[0],
+        })
+        print(results[-1])
+    return results
+
+# --------------------------
+# Metrics index
+# --------------------------
+def benchmark_metrics_index(model_folder, target_metric="val_acc"):
+    """Best-epoch lookup of every version under model_folder (root_model_folder/model_type): EventAccumulator
+    Reload() of every event file against the metrics index (first build, incremental update, queries)
+    """
+    from pathlib import Path
+    from tensorboard.backend.event_processing import event_accumulator
+    from .metrics_index import MetricsIndex
+
+    model_folder = Path(model_folder)
+    version_folders = list(model_folder.glob("*v[0-9]*"))
+    def reload_all():
+        for path in model_folder.glob("**/*tfevent*"):
+            event_accumulator.EventAccumulator(str(path), size_guidance={event_accumulator.SCALARS: 0}).Reload()
+
+    reload_time, _ = _timeit(reload_all, repeat=1)
+    db_path = Path(tempfile.mkdtemp()) / 'metrics_index.sqlite'
+    metrics_index = MetricsIndex(model_folder.parent, db_path=db_path)
+    build_time, _ = _timeit(lambda: metrics_index.update(model_folder), repeat=1)
+    update_time, _ = _timeit(lambda: metrics_index.update(model_folder))
+    query_time, _ = _timeit(lambda: [metrics_index.get_best_metrics_record(version_folder, target_metric) for version_folder in version_folders])
+    results = {
+        'versions': len(version_folders),
+        'event_accumulator_reload_s': reload_time,
+        'index_build_s': build_time,
+        'index_update_s': update_time,
+        'index_query_ms_per_version': 1000*query_time/max(1, len(version_folders)),
+    }
+    print('metrics index: ', results)
+    return results
+
+# --------------------------
+# Import time
+# --------------------------
+HEAVY_MODULES = ['torch', 'pytorch_lightning', 'pandas', 'matplotlib', 'tensorboard', 'albumentations', 'cupy', 'nvidia.dali']
+
+_IMPORT_CHECK_SCRIPT = """
+import builtins, socket, sys, time, json
+calls = []
+def _input(*args):
+    calls.append('input')
+    raise RuntimeError('input() called at import')
+def _connect(self, *args):
+    calls.append('socket.connect')
+    raise RuntimeError('network call at import')
+builtins.input = _input
+socket.socket.connect = _connect
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{'elapsed': elapsed, 'calls': calls, 'heavy': [name for name in {heavy} if name in sys.modules]}}))
+"""
+
+def benchmark_import_time(module='predict', repeat=3, max_seconds=1.0, num_top_modules=10):
+    """Import time of a package module in fresh interpreters (python -X importtime), with input() and socket
+    connections made to fail, and the heavy modules (HEAVY_MODULES) that got imported on the way
+    """
+    import sys
+    import json
+    import subprocess
+
+    package_name = __name__.rpartition('.')[0]
+    package_parent = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    full_name = f"{package_name}.{module}" if package_name else module
+    script = _IMPORT_CHECK_SCRIPT.format(module=full_name, heavy=HEAVY_MODULES)
+    times, outputs = [], None
+    for _ in range(repeat):
+        process = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', script], cwd=package_parent,
+            stdin=subprocess.DEVNULL, capture_output=True, text=True
+        )
+        assert process.returncode == 0, f"import {full_name} failed:\n{process.stderr[-2000:]}"
+        outputs = json.loads(process.stdout.strip().splitlines()[-1])
+        times.append(outputs['elapsed'])
+
+    # "import time: self [us] | cumulative | imported package" lines of the last run
+    self_times = []
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[0].split(':')[1].strip().isdigit():
+            self_times.append((int(fields[0].split(':')[1]), fields[2].strip()))
+    results = {
+        'module': full_name,
+        'best_s': min(times),
+        'is_fast': min(times) < max_seconds,
+        'blocked_calls': outputs['calls'],
+        'heavy_modules': outputs['heavy'],
+        'top_modules_ms': [(name, self_us/1000) for self_us, name in sorted(self_times, reverse=True)[:num_top_modules]],
+    }
+    print('import time: ', {key: value for key, value in results.items() if key != 'top_modules_ms'})
+    for name, self_ms in results['top_modules_ms']:
+        print(f"    {name}: {self_ms:.1f} ms")
+    return results
+
+# --------------------------
+# Memory format / precision
+# --------------------------
+def benchmark_memory_format(make_model=None, batch_size=32, num_steps=10, num_threads=None, seed=0):
+    """Inference (batch 1 and batch_size) and training step time of contiguous / channels_last x float32 / bf16 autocast
+    on CPU, with the logit parity against contiguous float32, and the cost of stacking a batch of preprocessed images
+    as NCHW (default collate) or NHWC (precision.channels_last_collate)
+    Arguments:
+        make_model: function() -> nn.Module, default an untrained efficientnet-b0 with 801 classes
+    """
+    import copy
+    import torch
+    from torch.utils.data.dataloader import default_collate
+    from .precision import autocast, to_memory_format, channels_last_collate
+    from .preprocess import preprocess
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if make_model is None:
+        from efficientnet_pytorch import EfficientNet
+        make_model = lambda: EfficientNet.from_name('efficientnet-b0', num_classes=801)
+    torch.manual_seed(seed)
+    base_model = make_model().eval()
+    x = torch.rand(batch_size, 3, 224, 224)
+    with torch.no_grad():
+        reference = base_model(x)
+
+    results = []
+    for memory_format in ('contiguous', 'channels_last'):
+        for dtype in (None, 'bfloat16'):
+            model = to_memory_format(copy.deepcopy(base_model), memory_format)
+            inputs = to_memory_format(x, memory_format)
+            def infer(inputs):
+                with torch.no_grad(), autocast('cpu', dtype):
+                    return model(inputs).float()
+            logits = infer(inputs)
+            single_time, _ = _timeit(lambda: [infer(inputs[:1]) for _ in range(num_steps)])
+            batch_time, _ = _timeit(lambda: [infer(inputs) for _ in range(max(1, num_steps//5))])
+
+            model.train()
+            optimizer = torch.optim.SGD(model.parameters(), lr=1e-3)
+            labels = torch.randint(0, logits.shape[1], (batch_size,))
+            def train_step():
+                with autocast('cpu', dtype):
+                    loss = torch.nn.functional.cross_entropy(model(inputs).float(), labels)
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            train_time, _ = _timeit(train_step, repeat=3)
+            results.append({
+                'memory_format': memory_format,
+                'autocast': dtype or 'float32',
+                'batch1_ms': 1000*single_time/num_steps,
+                f'batch{batch_size}_ms': 1000*batch_time/max(1, num_steps//5),
+                'train_step_ms': 1000*train_time,
+                'max_abs_logit_diff': float((logits - reference).abs().max()),
+                'top1_agreement': float((logits.argmax(1) == reference.argmax(1)).float().mean()),
+            })
+            print(results[-1])
+
+    images = [preprocess(image) for image in _make_synthetic_word_images(batch_size, seed=seed)]
+    samples = [(image, 0) for image in images]
+    nchw_time, _ = _timeit(lambda: default_collate(samples)[0].contiguous(memory_format=torch.channels_last), repeat=5)
+    nhwc_time, batch = _timeit(lambda: channels_last_collate(samples)[0], repeat=5)
+    collate_results = {
+        'default_collate_to_channels_last_ms': 1000*nchw_time,
+        'channels_last_collate_ms': 1000*nhwc_time,
+        'is_same_batch': bool(torch.equal(batch, default_collate(samples)[0])),
+        'is_channels_last': batch.is_contiguous(memory_format=torch.channels_last),
+    }
+    print('collate: ', collate_results)
+    return results, collate_results
+
+# --------------------------
+# Compiled model
+# --------------------------
+def benchmark_compiled(make_model=None, backends=('eager', 'trace', 'compile'), buckets=(1, 4, 16), batch_sizes=(1, 3, 16), num_steps=20):
+    """compiled.CompiledModel per backend: compile time and first-call penalty of every bucket (reported apart), then the
+    steady-state images/sec of every batch size (batch sizes between buckets are padded to the next bucket)
+    Arguments:
+        make_model: function() -> nn.Module, default an untrained efficientnet-b0 with 801 classes
+    """
+    import torch
+    from .compiled import CompiledModel
+
+    if make_model is None:
+        from efficientnet_pytorch import EfficientNet
+        make_model = lambda: EfficientNet.from_name('efficientnet-b0', num_classes=801)
+    base_model = make_model().eval()
+    inputs = {batch_size: torch.rand(batch_size, 3, 224, 224) for batch_size in batch_sizes}
+    with torch.no_grad():
+        references = {batch_size: base_model(x) for batch_size, x in inputs.items()}
+
+    results = []
+    for backend in backends:
+        compiled_model = CompiledModel(make_model().eval() if backend != 'eager' else base_model, backend=backend, buckets=buckets)
+        compiled_model.model.load_state_dict(base_model.state_dict())
+        start = time.perf_counter()
+        compiled_model.warmup()
+        result = {'backend': backend, 'warmup_s': time.perf_counter() - start, 'buckets': compiled_model.summary()}
+        for batch_size, x in inputs.items():
+            step_time, logits = _timeit(lambda: [compiled_model(x) for _ in range(num_steps)], repeat=2)
+            result[f'bs{batch_size}_images_per_sec'] = batch_size*num_steps/step_time
+            result[f'bs{batch_size}_max_abs_diff'] = float((logits[-1] - references[batch_size]).abs().max())
+        results.append(result)
+        print(f"{backend}: warmup {result['warmup_s']:.2f}s", {key: value for key, value in result.items() if key.startswith('bs')})
+        for bucket, stats in result['buckets'].items():
+            print(f"    bucket {bucket}: compile {stats['compile_s']:.3f}s, first call {stats['first_call_s']:.3f}s")
+    return results
@@ -0,0 +1,96 @@
+# border.py
+import numpy as np
+import cv2
+
+"""
+Border padding (cv2.BORDER_WRAP / cv2.BORDER_REPLICATE) for numpy and cupy arrays, used by dali_custom_func.
+
+Padding is a gather: output row i is input row
+    wrap:      (i - top) mod h
+    replicate: clip(i - top, 0, h - 1)
+and the same for columns. The row / column index tables only depend on (size, pad before, pad after, mode), so they
+are computed once and cached (per array package, cupy tables live on the device), then every image (or a whole batch
+of same-sized images) is padded with two `take` calls. Unlike the old slice-copy kernels this also works when the
+border is wider than the image (wrap tiles it as often as needed), and the output is bit exact with cv2.copyMakeBorder,
+see benchmark.check_border_parity.
+For single numpy images 'auto' uses cv2.copyMakeBorder, which is the fastest on CPU.
+"""
+
+WRAP = 'wrap'
+REPLICATE = 'replicate'
+CV2_BORDER_FLAGS = {WRAP: cv2.BORDER_WRAP, REPLICATE: cv2.BORDER_REPLICATE}
+
+_INDEX_TABLES = {}
+_MAX_INDEX_TABLES = 4096
+
+
+def _get_np_pkg(array):
+    if isinstance(array, np.ndarray):
+        return np
+    import cupy
+    return cupy
+
+
+def get_border_mode(transform_approach):
+    """DCFG.transform_approach -> WRAP or REPLICATE"""
+    if 'replicate' in transform_approach:
+        return REPLICATE
+    elif 'wrap' in transform_approach:
+        return WRAP
+    raise ValueError("Invalid transform approach config")
+
+
+def get_index_table(size, pad_before, pad_after, mode, np_pkg=np, num_channels=1):
+    """Input index of every output position along one axis, cached
+    num_channels > 1: indices into the [W*C] bytes of an interleaved row instead of into the W pixels
+    """
+    key = (np_pkg.__name__, size, pad_before, pad_after, mode, num_channels)
+    table = _INDEX_TABLES.get(key)
+    if table is None:
+        table = np.arange(-pad_before, size + pad_after)
+        if mode == WRAP:
+            table = np.mod(table, size)
+        elif mode == REPLICATE:
+            table = np.clip(table, 0, size - 1)
+        else:
+            raise ValueError(f"Invalid border mode: {mode}")
+        if num_channels > 1:
+            table = (table[:, None]*num_channels + np.arange(num_channels)).ravel()
+        table = np_pkg.asarray(table)
+        if len(_INDEX_TABLES) >= _MAX_INDEX_TABLES:
+            _INDEX_TABLES.clear()
+        _INDEX_TABLES[key] = table
+    return table
+
+
+def _gather(images, top, bottom, left, right, mode, row_axis, np_pkg):
+    """Columns first on the [..., H, W*C] view (contiguous runs of C bytes), then rows (whole padded rows)"""
+    h, w = images.shape[row_axis], images.shape[row_axis + 1]
+    num_channels = images.shape[-1] if images.ndim == row_axis + 3 else 1
+    rows = get_index_table(h, top, bottom, mode, np_pkg)
+    cols = get_index_table(w, left, right, mode, np_pkg, num_channels)
+    flat = images.reshape(*images.shape[:row_axis + 1], w*num_channels)
+    padded = flat.take(cols, axis=row_axis + 1).take(rows, axis=row_axis)
+    return padded.reshape(*images.shape[:row_axis], h + top + bottom, w + left + right, *images.shape[row_axis + 2:])
+
+
+def pad_image(image, top, bottom, left, right, mode, np_pkg=None, backend='auto'):
+    """Pad one [H, W] or [H, W, C] image
+    Arguments:
+        np_pkg: numpy or cupy, default from the array type
+        backend: 'auto' (cv2 for numpy images, gather otherwise), 'cv2' or 'gather'
+    """
+    np_pkg = np_pkg or _get_np_pkg(image)
+    if backend == 'cv2' or (backend == 'auto' and np_pkg is np):
+        return cv2.copyMakeBorder(image, top, bottom, left, right, CV2_BORDER_FLAGS[mode])
+    return _gather(image, top, bottom, left, right, mode, 0, np_pkg)
+
+
+def pad_batch(images, top, bottom, left, right, mode, np_pkg=None):
+    """Pad a stacked [N, H, W] or [N, H, W, C] batch of same-sized images at once"""
+    np_pkg = np_pkg or _get_np_pkg(images)
+    return _gather(images, top, bottom, left, right, mode, 1, np_pkg)
+
+
+def clear_index_tables():
+    _INDEX_TABLES.clear()
@@ -0,0 +1,233 @@
+# callbacks.py
+import os
+import time
+from pathlib import Path
+import torch
+import pytorch_lightning as pl
+from pytorch_lightning.callbacks import ModelCheckpoint
+
+from .telemetry import LOADER_STATS
+from .ckpt_catalog import CheckpointCatalog
+
+
+class CPUThreadsCallback(pl.Callback):
+    """Set the intra-op thread count inside every (spawned) training process,
+    so N CPU DDP processes do not fight over the same cores
+    """
+    def __init__(self, num_threads=None, num_processes=1):
+        super().__init__()
+        self.num_threads = num_threads or max(1, (os.cpu_count() or 1)//max(1, num_processes))
+
+    def setup(self, trainer, pl_module, stage=None):
+        torch.set_num_threads(self.num_threads)
+        print(f"rank {trainer.global_rank}: using {self.num_threads} threads")
+
+
+class ProfilerCallback(pl.Callback):
+    """Profile a window of training steps with torch.profiler (works on CPU-only machines)
+
+    Steps: skip_first, then wait (not recorded), warmup (recorded but dropped), active (kept).
+    For the active window it writes
+        trace_<step>.json: chrome trace, open in chrome://tracing or https://ui.perfetto.dev
+        summary_<step>.txt: data-loader wait vs compute time and the op table ranked by self time (CPU, memory)
+    Data-loader wait is the time between the end of a batch and the start of the next one,
+    compute is the time from on_train_batch_start to on_train_batch_end (forward, backward, optimizer step).
+    """
+    def __init__(self, output_folder, skip_first=10, wait=1, warmup=2, active=5, row_limit=30):
+        super().__init__()
+        self.output_folder = Path(output_folder)
+        self.skip_first = skip_first
+        self.wait = wait
+        self.warmup = warmup
+        self.active = active
+        self.row_limit = row_limit
+        self.profiler = None
+        self.step = 0
+        self.batch_start_time = None
+        self.last_batch_end_time = None
+        self.data_wait_times, self.compute_times = [], []
+
+    def _is_recording(self):
+        return self.skip_first + self.wait + self.warmup <= self.step < self.skip_first + self.wait + self.warmup + self.active
+
+    def on_train_start(self, trainer, pl_module):
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(skip_first=self.skip_first, wait=self.wait, warmup=self.warmup, active=self.active, repeat=1),
+            on_trace_ready=self._on_trace_ready,
+            profile_memory=True,
+            record_shapes=True,
+        )
+        self.profiler.__enter__()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=0):
+        self.batch_start_time = time.perf_counter()
+        if self.last_batch_end_time is not None and self._is_recording():
+            self.data_wait_times.append(self.batch_start_time - self.last_batch_end_time)
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.last_batch_end_time = time.perf_counter()
+        if self._is_recording():
+            self.compute_times.append(self.last_batch_end_time - self.batch_start_time)
+        if self.profiler is not None:
+            self.profiler.step()
+        self.step += 1
+
+    def _get_time_summary(self):
+        data_wait, compute = sum(self.data_wait_times), sum(self.compute_times)
+        total = (data_wait + compute) or 1
+        return (f"steps: {len(self.compute_times)}, data-loader wait: {data_wait:.3f}s ({data_wait/total:.1%}), "
+                f"compute: {compute:.3f}s ({compute/total:.1%})")
+
+    def _on_trace_ready(self, prof):
+        trace_path = self.output_folder / f"trace_{self.step}.json"
+        prof.export_chrome_trace(str(trace_path))
+        sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        table = prof.key_averages().table(sort_by=sort_by, row_limit=self.row_limit)
+        summary = self._get_time_summary() + "\n\n" + table
+        summary_path = self.output_folder / f"summary_{self.step}.txt"
+        with open(summary_path, 'w') as out_file:
+            out_file.write(summary)
+        print(f"profiler: {self._get_time_summary()}\n - chrome trace: {trace_path}\n - summary: {summary_path}")
+
+    def on_train_end(self, trainer, pl_module):
+        if self.profiler is not None:
+            self.profiler.__exit__(None, None, None)
+            self.profiler = None
+
+
+class LoaderTelemetryCallback(pl.Callback):
+    """Data-loader stall detector, see telemetry.py
+
+    Reads the telemetry.LOADER_STATS fed by the instrumented loaders of the datamodules (DCFG.is_loader_instrumented,
+    see dataset.instrument_loader), then for every phase logs to the TensorBoardLogger (every log_every_n_steps and at epoch end):
+        loader/<phase>_wait_ms: time waiting for the next batch
+        loader/<phase>_step_ms: time in the step (forward, backward, optimizer)
+        loader/<phase>_images_per_sec, loader/<phase>_wait_fraction
+        loader/<phase>_queue_ready: batches already prefetched by the workers when next() was called (torch DataLoader only)
+        augment/<stage>_ms: mean time of every augmentation stage, if an AugmentTimer is given
+    A high wait fraction with an empty prefetch queue means the model is starved by the loader.
+    """
+    def __init__(self, log_every_n_steps=50, augment_timer=None):
+        super().__init__()
+        self.log_every_n_steps = log_every_n_steps
+        self.augment_timer = augment_timer
+        self.stats = LOADER_STATS
+        self.batch_start_time = None
+
+    def _log(self, trainer, tag_values):
+        if trainer.logger is None:
+            return
+        for tag, value in tag_values.items():
+            if value is not None:
+                trainer.logger.experiment.add_scalar(tag, value, trainer.global_step)
+
+    def _log_phase(self, trainer, phase):
+        summary = self.stats[phase].summary()
+        self._log(trainer, {
+            f'loader/{phase}_wait_ms': summary['wait_ms'],
+            f'loader/{phase}_step_ms': summary['step_ms'],
+            f'loader/{phase}_images_per_sec': summary['images_per_sec'],
+            f'loader/{phase}_wait_fraction': summary['wait_fraction'],
+            f'loader/{phase}_queue_ready': summary['queue_ready'],
+        })
+        return summary
+
+    def _print_summary(self, phase, summary):
+        queue = f", prefetch queue ready {summary['queue_ready']:.1f}/{summary['queue_capacity']}" if summary['queue_ready'] is not None else ""
+        print(f"\n{phase} loader: {summary['batches']} batches, {summary['images_per_sec']:.1f} images/s, "
+              f"waiting for data {summary['wait_fraction']:.1%} of the time ({summary['wait_ms']:.1f} ms/batch), "
+              f"step {summary['step_ms']:.1f} ms/batch{queue}")
+
+    def on_train_epoch_start(self, trainer, pl_module):
+        self.stats['train'].reset()
+        if self.augment_timer is not None:
+            self.augment_timer.reset()
+
+    def on_validation_epoch_start(self, trainer, pl_module):
+        self.stats['val'].reset()
+
+    def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=0):
+        self.batch_start_time = time.perf_counter()
+
+    def on_train_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        self.stats['train'].add_step(time.perf_counter() - self.batch_start_time)
+        if self.log_every_n_steps and (batch_idx + 1) % self.log_every_n_steps == 0:
+            self._log_phase(trainer, 'train')
+
+    def on_validation_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=0):
+        self.batch_start_time = time.perf_counter()
+
+    def on_validation_batch_end(self, trainer, pl_module, outputs, batch, batch_idx, dataloader_idx=0):
+        self.stats['val'].add_step(time.perf_counter() - self.batch_start_time)
+
+    def on_validation_epoch_end(self, trainer, pl_module):
+        if self.stats['val'].num_batches:
+            self._print_summary('val', self._log_phase(trainer, 'val'))
+
+    def on_train_epoch_end(self, trainer, pl_module, unused=None):
+        if not self.stats['train'].num_batches:
+            return
+        self._print_summary('train', self._log_phase(trainer, 'train'))
+        if self.augment_timer is not None:
+            augment_stats = self.augment_timer.get_stats()
+            self._log(trainer, {f'augment/{stage_name}_ms': stats['mean_ms'] for stage_name, stats in augment_stats.items()})
+            if augment_stats:
+                print("augmentation (ms/image): " + ", ".join(f"{stage_name} {stats['mean_ms']:.2f}" for stage_name, stats in augment_stats.items()))
+
+
+class CheckpointCatalogCallback(pl.Callback):
+    """Record every checkpoint saved by the ModelCheckpoint callbacks of the trainer in a catalog.json next to it
+    (see ckpt_catalog.py): epoch, global step and the logged scalar metrics at saving time.
+    The epoch / step / metrics are captured in on_save_checkpoint, the file names are synced from
+    ModelCheckpoint.best_k_models and last_model_path afterwards, so the order of the callbacks does not matter.
+    """
+    def __init__(self):
+        super().__init__()
+        self.pending = None
+        self.num_saves = 0
+        self.recorded = {} # ckpt path: num_saves when it was recorded
+
+    def on_save_checkpoint(self, trainer, pl_module, checkpoint):
+        metrics = {
+            key: float(value) for key, value in trainer.callback_metrics.items()
+            if not isinstance(value, torch.Tensor) or value.numel() == 1
+        }
+        self.pending = {'epoch': trainer.current_epoch, 'step': trainer.global_step, 'metrics': metrics}
+        self.num_saves += 1
+
+    def _sync(self, trainer):
+        if self.pending is None:
+            return
+        for checkpoint_callback in [callback for callback in trainer.callbacks if isinstance(callback, ModelCheckpoint)]:
+            if not checkpoint_callback.dirpath:
+                continue
+            last_model_path = str(checkpoint_callback.last_model_path or '')
+            # top-k checkpoints are written once, last.ckpt is overwritten at every save
+            new_paths = [
+                ckpt_path for ckpt_path in map(str, set(checkpoint_callback.best_k_models) | {last_model_path} - {''})
+                if ckpt_path not in self.recorded or (ckpt_path == last_model_path and self.recorded[ckpt_path] != self.num_saves)
+            ]
+            catalog = CheckpointCatalog(checkpoint_callback.dirpath)
+            for ckpt_path in new_paths:
+                catalog.add(ckpt_path, **self.pending)
+                self.recorded[ckpt_path] = self.num_saves
+            num_entries = len(catalog.entries)
+            catalog.prune_missing()
+            if new_paths or num_entries != len(catalog.entries):
+                catalog.save()
+
+    def on_validation_end(self, trainer, pl_module):
+        self._sync(trainer)
+
+    def on_train_epoch_end(self, trainer, pl_module, unused=None):
+        self._sync(trainer)
+
+    def on_train_end(self, trainer, pl_module):
+        self._sync(trainer)
@@ -0,0 +1,115 @@
+# ckpt_catalog.py
+import os
+import re
+import json
+import time
+from pathlib import Path
+
+"""
+Checkpoint catalog: a catalog.json next to the checkpoints (version_folder/checkpoints) with one entry per saved
+checkpoint, written by callbacks.CheckpointCatalogCallback when ModelCheckpoint saves:
+    {"checkpoints": [{"name": "epoch=5.ckpt", "epoch": 5, "step": 4800, "metrics": {"val_loss": 0.21, ...}, "saved_at": ...}]}
+Entries of checkpoints removed by ModelCheckpoint (save_top_k) are dropped on the next write.
+get_best() answers "best checkpoint for metric X" without probing file names, find_nearest_ckpt() is the bounded
+fallback for legacy version folders without a catalog.
+"""
+
+CATALOG_NAME = 'catalog.json'
+EPOCH_PATTERN = re.compile(r"epoch=(\d+)")
+
+
+def _is_better(value, best_value, mode):
+    return best_value is None or (value > best_value if mode == 'max' else value < best_value)
+
+
+class CheckpointCatalog:
+    """
+    Init Arguments:
+        folder: str or Path, the checkpoint folder (ModelCheckpoint dirpath, ie. version_folder/checkpoints)
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.path = self.folder / CATALOG_NAME
+        self.entries = self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return []
+        with open(self.path) as in_file:
+            return json.load(in_file)['checkpoints']
+
+    def exists(self):
+        return self.path.exists()
+
+    def save(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as out_file:
+            json.dump({'checkpoints': self.entries}, out_file, indent=4)
+        os.replace(tmp_path, self.path)
+
+    def add(self, ckpt_path, epoch, step, metrics):
+        """Add or replace the entry of ckpt_path, metrics: dict of python numbers"""
+        name = Path(ckpt_path).name
+        self.entries = [entry for entry in self.entries if entry['name'] != name]
+        self.entries.append({'name': name, 'epoch': epoch, 'step': step, 'metrics': metrics, 'saved_at': time.time()})
+
+    def prune_missing(self):
+        """Drop the entries whose checkpoint file was deleted"""
+        self.entries = [entry for entry in self.entries if (self.folder / entry['name']).exists()]
+
+    def get_best(self, target_metric="val_loss", mode=None):
+        """Path of the best existing checkpoint for target_metric (eg. "val_loss", "val_acc", "val_loss_epoch"), or None
+        Arguments:
+            mode: 'min' or 'max', default 'max' for acc and 'min' for loss
+        """
+        mode = mode or ('max' if 'acc' in target_metric else 'min')
+        best_entry, best_value = None, None
+        for entry in self.entries:
+            value = _get_metric_value(entry['metrics'], target_metric)
+            if value is not None and (self.folder / entry['name']).exists() and _is_better(value, best_value, mode):
+                best_entry, best_value = entry, value
+        return self.folder / best_entry['name'] if best_entry else None
+
+    def get_top_k(self, target_metric="val_loss", k=None, mode=None):
+        """Paths of the existing checkpoints ranked by target_metric, best first, at most k (None: all)"""
+        mode = mode or ('max' if 'acc' in target_metric else 'min')
+        ranked = sorted(
+            (
+                (_get_metric_value(entry['metrics'], target_metric), entry['name']) for entry in self.entries
+                if _get_metric_value(entry['metrics'], target_metric) is not None and (self.folder / entry['name']).exists()
+            ),
+            reverse=(mode == 'max'),
+        )
+        return [self.folder / name for _, name in ranked[:k]]
+
+    def get_by_epoch(self, epoch):
+        for entry in self.entries:
+            if entry['epoch'] == epoch and (self.folder / entry['name']).exists():
+                return self.folder / entry['name']
+        return None
+
+
+def _get_metric_value(metrics, target_metric):
+    """Exact key first, then the logged variants: val_loss <-> val_loss_epoch / val_epoch_loss"""
+    if target_metric in metrics:
+        return metrics[target_metric]
+    trn_val, l_acc = target_metric.replace('_epoch', '').split('_')[:2]
+    for key in (f"{trn_val}_{l_acc}", f"{trn_val}_{l_acc}_epoch", f"{trn_val}_epoch_{l_acc}"):
+        if key in metrics:
+            return metrics[key]
+    return None
+
+
+def find_nearest_ckpt(version_folder, epoch, max_depth=2):
+    """Bounded fallback for folders without a catalog: the existing checkpoint whose "epoch=N" is the closest to epoch,
+    looking in version_folder and its sub folders (eg. checkpoints/) up to max_depth levels, None if there is none
+    """
+    version_folder = Path(version_folder)
+    candidates = []
+    for depth in range(max_depth):
+        for ckpt_path in version_folder.glob('/'.join(['*']*(depth + 1)) + '.ckpt'):
+            re_result = EPOCH_PATTERN.search(ckpt_path.name)
+            if re_result:
+                candidates.append((abs(int(re_result.group(1)) - epoch), depth, ckpt_path))
+    return min(candidates)[2] if candidates else None
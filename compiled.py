@@ -0,0 +1,155 @@
+# compiled.py
+import time
+import bisect
+from pathlib import Path
+
+import torch
+
+from .config import DCFG, MCFG
+from .precision import autocast, to_memory_format
+
+"""
+Graph-compiled model execution with one compiled artifact per batch-size bucket.
+
+CompiledModel (serving, predict.py / tta.py / evaluate.py) pads every batch up to the next bucket size
+(eg. 1, 2, 4, 8, 16, 32), so a dynamic batcher or a varying last batch always hits an already compiled shape:
+    'trace':   torch.jit.trace + torch.jit.freeze (+ optimize_for_inference) per bucket, the traced graphs can be saved
+               to cache_folder and are loaded instead of traced by the next process
+    'compile': torch.compile(dynamic=False), one graph per bucket (inductor C++ kernels on CPU), kept in memory only
+    'eager':   no compilation, same padding (for comparisons)
+Batches bigger than the largest bucket are split into chunks of the largest bucket.
+
+Compilation costs are tracked separately from the steady state:
+    compile_s:    building the artifact (tracing / freezing, torch.compile wrapping)
+    first_call_s: the first call of a bucket (lazy compilation of torch.compile, profiling runs of the JIT)
+see benchmark.benchmark_compiled for the steady-state throughput of every backend.
+
+Training (BasicClassifier.forward) uses torch.compile of the raw model with MCFG.compile_backend = 'compile', the
+module is not registered as a sub-module so the checkpoints keep their keys.
+"""
+
+BACKENDS = ('eager', 'trace', 'compile')
+DEFAULT_BUCKETS = (1, 2, 4, 8, 16, 32)
+
+
+def _set_exportable_swish(model):
+    """efficientnet_pytorch's memory efficient swish is a python autograd Function, not traceable / compilable"""
+    for module in model.modules():
+        if hasattr(module, 'set_swish'):
+            module.set_swish(memory_efficient=False)
+    return model
+
+def compile_for_training(model):
+    """torch.compile of a raw model for the training step (dynamic shapes for the last partial batch)"""
+    assert hasattr(torch, 'compile'), "torch.compile needs torch >= 2.0"
+    return torch.compile(_set_exportable_swish(model), dynamic=None)
+
+
+class CompiledModel:
+    """
+    Init Arguments:
+        model: nn.Module taking [N, C, H, W] inputs, put in eval mode
+        backend: 'trace', 'compile' or 'eager'
+        buckets: sorted batch sizes to compile
+        input_shape: (C, H, W) of one image
+        memory_format: None (DCFG.memory_format) | 'contiguous' | 'channels_last'
+        autocast_dtype: None (MCFG.cpu_autocast_dtype) | 'bfloat16', traced into the graph of 'trace'
+        cache_folder, cache_key: save / load the traced graphs as cache_folder/{cache_key}_{format}_{dtype}_bs{bucket}.pt,
+            cache_key has to change with the weights, eg. the checkpoint name
+    """
+    def __init__(self, model, backend='trace', buckets=DEFAULT_BUCKETS, input_shape=(3, 224, 224), memory_format=None,
+            autocast_dtype=None, cache_folder=None, cache_key=None):
+        assert backend in BACKENDS, f"backend should be one of {BACKENDS}"
+        self.memory_format = memory_format or DCFG.memory_format
+        self.autocast_dtype = autocast_dtype or MCFG.cpu_autocast_dtype
+        self.model = to_memory_format(model.eval(), self.memory_format)
+        if backend != 'eager':
+            _set_exportable_swish(self.model)
+        self.backend = backend
+        self.buckets = sorted(buckets)
+        self.input_shape = tuple(input_shape)
+        self._compiled_module = None
+        self.cache_folder = Path(cache_folder) if cache_folder and cache_key else None
+        self.cache_key = cache_key
+        self.device = next(model.parameters()).device
+        self.compiled = {}
+        self.stats = {bucket: {'compile_s': None, 'first_call_s': None, 'calls': 0, 'is_loaded': False} for bucket in self.buckets}
+
+    def get_bucket(self, batch_size):
+        i = bisect.bisect_left(self.buckets, batch_size)
+        return self.buckets[min(i, len(self.buckets) - 1)]
+
+    def _get_example(self, bucket):
+        return to_memory_format(torch.rand(bucket, *self.input_shape, device=self.device), self.memory_format)
+
+    def _get_cache_path(self, bucket):
+        return self.cache_folder / f"{self.cache_key}_{self.memory_format}_{self.autocast_dtype or 'float32'}_bs{bucket}.pt"
+
+    def _eager_forward(self, x):
+        with torch.no_grad(), autocast(x.device.type, self.autocast_dtype):
+            return self.model(x).float()
+
+    def _build(self, bucket):
+        start = time.perf_counter()
+        if self.backend == 'eager':
+            compiled = self._eager_forward
+        elif self.backend == 'compile':
+            # one compiled module, dynamo keeps one graph per (static) bucket shape, compiled on the first call
+            if self._compiled_module is None:
+                self._compiled_module = torch.compile(self.model, dynamic=False)
+            def compiled(x):
+                with torch.no_grad(), autocast(x.device.type, self.autocast_dtype):
+                    return self._compiled_module(x).float()
+        else:
+            cache_path = self._get_cache_path(bucket) if self.cache_folder else None
+            if cache_path and cache_path.exists():
+                frozen = torch.jit.load(str(cache_path), map_location=self.device)
+                self.stats[bucket]['is_loaded'] = True
+            else:
+                with torch.no_grad(), autocast(self.device.type, self.autocast_dtype):
+                    traced = torch.jit.trace(self.model, self._get_example(bucket), check_trace=False)
+                frozen = torch.jit.freeze(traced.eval())
+                if cache_path: # the frozen graph, the prepacked weights of optimize_for_inference are not serializable
+                    cache_path.parent.mkdir(parents=True, exist_ok=True)
+                    torch.jit.save(frozen, str(cache_path))
+            compiled = torch.jit.optimize_for_inference(frozen)
+        self.stats[bucket]['compile_s'] = time.perf_counter() - start
+        self.compiled[bucket] = compiled
+        return compiled
+
+    def warmup(self, buckets=None):
+        """Build and run every bucket once, so the first requests do not pay the compilation"""
+        for bucket in buckets or self.buckets:
+            self._run_bucket(self._get_example(bucket), bucket)
+        return self.stats
+
+    def _run_bucket(self, x, bucket):
+        compiled = self.compiled[bucket] if bucket in self.compiled else self._build(bucket)
+        stats = self.stats[bucket]
+        if stats['first_call_s'] is None:
+            start = time.perf_counter()
+            with torch.no_grad():
+                output = compiled(x)
+            stats['first_call_s'] = time.perf_counter() - start
+        else:
+            with torch.no_grad():
+                output = compiled(x)
+        stats['calls'] += 1
+        return output.float()
+
+    def __call__(self, x):
+        """[N, C, H, W] -> float logits [N, num_classes], N is padded to its bucket"""
+        max_bucket = self.buckets[-1]
+        if len(x) > max_bucket:
+            return torch.cat([self(chunk) for chunk in torch.split(x, max_bucket)])
+        batch_size = len(x)
+        bucket = self.get_bucket(batch_size)
+        x = to_memory_format(x.to(self.device, non_blocking=True), self.memory_format)
+        if bucket != batch_size:
+            x = torch.cat([x, x[-1:].expand(bucket - batch_size, *x.shape[1:])])
+            x = to_memory_format(x, self.memory_format)
+        return self._run_bucket(x, bucket)[:batch_size]
+
+    def summary(self):
+        """Compilation cost of the buckets that were used"""
+        return {bucket: dict(stats) for bucket, stats in self.stats.items() if stats['compile_s'] is not None}
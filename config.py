@@ -1,9 +1,10 @@
 # config.py
 from datetime import date
-import torch
 import os
+import sys
+import json
 from pathlib import Path
-from .utils import ModelFileHandler, ConfigHandler
+from .utils import ROOT, ModelFileHandler, ConfigHandler
 
 """
 Please Jump to Bottom to Modify Config
@@ -11,8 +12,23 @@ Please Jump to Bottom to Modify Config
     2) model config: MCFG
     3) optimizer config: OCFG
     4) noisy student config: NS
+
+Importing this module has no side effect besides reading the optional config file, the model version / checkpoint
+selection (which may ask for input) only runs in init_config(), called by train.train() and main.py.
+    YUSHAN_ROOT: data / model root folder, default the Google Drive folder on colab (see utils.ROOT)
+    YUSHAN_CONFIG: path of a json file overriding the values below, eg. {"DCFG": {"batch_size": 64}, "MCFG": {"version": "2021-08-01.v1"}}
 """
 
+CONFIG_PATH_ENV = 'YUSHAN_CONFIG'
+
+
+def _get_default_device():
+    """"cuda:0" or "cpu" without importing torch (slow), torch.device accepts the str"""
+    if 'torch' in sys.modules:
+        return "cuda:0" if sys.modules['torch'].cuda.is_available() else "cpu"
+    is_gpu_visible = os.environ.get('CUDA_VISIBLE_DEVICES', '0') not in ('', '-1')
+    return "cuda:0" if is_gpu_visible and os.path.exists('/proc/driver/nvidia/version') else "cpu"
+
 # --------------------
 #  Modifying Config
 # --------------------
@@ -20,9 +36,9 @@ Please Jump to Bottom to Modify Config
 # data config
 class DCFG: 
     """Config for Data"""
-    input_path = Path('/content/gdrive/MyDrive/SideProject/YushanChineseWordClassification/train')
+    input_path = Path(ROOT) / 'train'
     is_gpu_used = True # use GPU or not
-    device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+    device = _get_default_device()
     is_memory_pinned= True
     
     batch_size = 128 # batch size
@@ -31,6 +47,9 @@ class DCFG:
     data_type = 'mixed' # raw, mixed, cleaned, noisy_student, 2nd
     transform_approach = "replicate, " # BORDER_TYPE: replicate | wrap, COLOR: gray|,
     is_dali_used = True
+    is_batch_augmented = False # torch DataLoader only: augment whole batches in the collate_fn, see augment.py
+    is_loader_instrumented = False # log loader wait / step time, images/sec and augmentation cost, see telemetry.py
+    memory_format = 'contiguous' # contiguous | channels_last: NHWC batches and weights, see precision.py
     class_num = 801
     expected_num_per_class = 100
 
@@ -51,12 +70,24 @@ class MCFG:
     log_every_n_steps = 50         
     save_top_k_models = 2    
     gpus = 1
+    num_cpu_processes = 0 # > 1: CPU distributed data parallel (gloo) with this many local processes, gpus and apex are ignored
+    num_threads_per_process = None # None: cpu count // num_cpu_processes
     is_apex_used = True
     amp_level = 'O1'
     precision = 16
+    cpu_autocast_dtype = None # None | 'bfloat16': CPU autocast for training and serving, see precision.py
+    compile_backend = None # None | 'compile': torch.compile the model for training, see compiled.py
+    ema_decay = None # None | eg. 0.999: keep an EMA of the weights, saved as checkpoints/ema.ckpt, see averaging.py
+    ema_every_n_steps = 1
     monitor = 'val_loss'
+    metric_sync_every_n_steps = 0 # 0: metrics stay on device until epoch end | n: log running acc every n steps
+    is_confusion_tracked = False # keep a val confusion matrix on device
+    is_profiled = False # profile a window of training steps, see callbacks.ProfilerCallback
+    profile_skip_first = 10
+    profile_warmup = 2
+    profile_active = 5
 
-    root_model_folder = Path('/content/gdrive/MyDrive/SideProject/YushanChineseWordClassification/model')
+    root_model_folder = Path(ROOT) / 'model'
     today = str(date.today())
     ckpt_path = None
     version = None
@@ -84,12 +115,60 @@ class NS:
     dropout_rate = 0.3
     drop_connect_rate = 0.3
     teacher_softmax_temp = 1
+    # offline teacher logits (see teacher_cache.py)
+    is_teacher_logit_cached = False
+    teacher_model_type = 'effb0'
+    teacher_ckpt_path = None
+    teacher_logit_top_k = None # None: keep full logits | int: keep top-k logits only
+    teacher_logit_cache_folder = Path(ROOT) / 'teacher_logits'
+    # knowledge distillation into compact students (see distill.py), teacher: teacher_model_type / teacher_ckpt_path
+    distill_temperature = 4
+    distill_alpha = 0.9 # weight of the soft teacher loss, 1 - alpha for the hard label loss
+    # pseudo labels of the next iteration (see pseudo_label.py), teacher: teacher_model_type / teacher_ckpt_path
+    pseudo_label_folder = Path(ROOT) / 'pseudo_labels'
+    pseudo_label_threshold = 0.3 # minimum teacher confidence
+    pseudo_label_max_per_class = None # None: no cap | int: most confident images per class
+    pseudo_label_min_per_class = None # None: no oversampling | int: duplicate the images of smaller classes
+
+CFGs = [DCFG, MCFG, OCFG, NS]
+
+
+def load_config_file(config_path=None):
+    """Override the CFG values with a json file {"DCFG": {...}, "MCFG": {...}, ...}, default the YUSHAN_CONFIG file
+    Values of Path attributes are converted to Path, values derived at class creation (eg. OCFG.lr_group) are not
+    recomputed, so set them too. Returns the loaded dict ({} without a config file)
+    """
+    config_path = config_path or os.environ.get(CONFIG_PATH_ENV)
+    if not config_path:
+        return {}
+    with open(config_path) as in_file:
+        config = json.load(in_file)
+    CFG_dict = {CFG.__name__: CFG for CFG in CFGs}
+    for CFG_name, values in config.items():
+        assert CFG_name in CFG_dict, f"Wrong CFG name {CFG_name} in {config_path}, should be one of {list(CFG_dict)}"
+        CFG = CFG_dict[CFG_name]
+        for key, value in values.items():
+            assert hasattr(CFG, key), f"{CFG_name} has no attribute {key}, see config.py"
+            setattr(CFG, key, Path(value) if isinstance(getattr(CFG, key), Path) else value)
+    return config
+
+
+def init_config(is_user_input_needed=True):
+    """Select the model version and checkpoint, and set MCFG.target_version_folder
+    Arguments:
+        is_user_input_needed: bool, ask for the model type / version / checkpoint (ModelFileHandler.select_target_model_ver_and_ckpt),
+            False: use MCFG.version (config file) or a new f"{MCFG.today}.v1" version, and MCFG.ckpt_path as is
+    """
+    if is_user_input_needed:
+        MCFG.version, MCFG.ckpt_path, MCFG.model_type = ModelFileHandler.select_target_model_ver_and_ckpt(MCFG.root_model_folder, MCFG.model_type, MCFG.today, MCFG.is_continued_training)
+    else:
+        MCFG.version = MCFG.version or f"{MCFG.today}.v1"
+    MCFG.target_version_folder = MCFG.root_model_folder / MCFG.model_type / MCFG.version
+    # show some information
+    config = ConfigHandler.load_config(MCFG.target_version_folder)
+    print('\nModel Detail Check:\n - model ckpt path: ', MCFG.ckpt_path, '\n - model folder path: ', MCFG.target_version_folder, '\n - model other_settings: ', MCFG.other_settings)
+    if config:
+        print(' - model other_settings before: ', config['other_settings'])
+
 
-# handle MCFG
-MCFG.version, MCFG.ckpt_path, MCFG.model_type = ModelFileHandler.select_target_model_ver_and_ckpt(MCFG.root_model_folder, MCFG.model_type, MCFG.today, MCFG.is_continued_training)
-MCFG.target_version_folder = MCFG.root_model_folder / MCFG.model_type / MCFG.version
-# show some information
-config = ConfigHandler.load_config(MCFG.target_version_folder)
-print('\nModel Detail Check:\n - model ckpt path: ', MCFG.ckpt_path, '\n - model folder path: ', MCFG.target_version_folder, '\n - model other_settings: ', MCFG.other_settings)
-if config:
-    print(' - model other_settings before: ', config['other_settings'])
+load_config_file()
@@ -1,6 +1,9 @@
 # dataset.py
 import re
+import torch
 from torch.utils.data import Dataset, DataLoader, random_split
+from torch.utils.data import Sampler
+from torch.utils.data.distributed import DistributedSampler
 
 import pytorch_lightning as pl
 from nvidia.dali.pipeline import Pipeline
@@ -12,8 +15,12 @@ from nvidia.dali.plugin.pytorch import DALIClassificationIterator, DALIGenericIt
 from nvidia.dali.plugin.base_iterator import LastBatchPolicy
 
 from .preprocess import transform_func, second_source_transform_func, dali_custom_func, dali_warpaffine_transform
+from .augment import BatchAugmentCollate, AUGMENT_TIMER
+from .telemetry import InstrumentedLoader, LOADER_STATS
+from .precision import is_channels_last, channels_last_collate, NHWCLoader
 from .utils import ImageReader, NoisyStudentDataHandler, FileHandler
 from .config import DCFG, MCFG, NS
+from .pseudo_label import get_pseudo_label_manifest_path, sync_student_iter
 
 # TODO: decouple gray, add dali augmentation
 #
@@ -21,7 +28,7 @@ class BasicDataset(Dataset):
     """Parent Class for all Dataset
     Init Arguments:
         inp_dict: dict, with key value pair {'label': labels, 'image', images, ...}
-        transform: function
+        transform: function, None returns the raw image (eg. for BatchAugmentCollate)
     """
     def __init__(self, inp_dict, transform=None):
         self.labels = inp_dict['label']
@@ -42,9 +49,9 @@ class BasicDataset(Dataset):
         label = int(self.labels[index])
         
         if self.transform:            
-            transformed_image = self.transform(image=image)
+            image = self.transform(image=image)
 
-        return transformed_image, label
+        return image, label
 
 class CustomDataset(BasicDataset):
     pass
@@ -56,44 +63,120 @@ class YuShanDataset(BasicDataset):
         self.labels = inp_dict['label']        
 
 
+def instrument_loader(loader, phase):
+    """With DCFG.is_loader_instrumented, wrap the loader so every next() feeds telemetry.LOADER_STATS[phase]
+    (read by callbacks.LoaderTelemetryCallback) and turn the augmentation timer on before the workers are forked
+    """
+    if not DCFG.is_loader_instrumented:
+        return loader
+    AUGMENT_TIMER.enable()
+    return InstrumentedLoader(loader, LOADER_STATS[phase])
+
+
+class ShardSampler(Sampler):
+    """Rows rank::world_size of the dataset, in order. Unlike DistributedSampler the last shards are not padded with
+    repeated rows, so every validation sample is counted once by the all-reduced metrics (metrics.MetricAccumulator).
+    The ranks may get one batch less, fine for validation: no collective runs per step
+    """
+    def __init__(self, dataset, num_replicas=None, rank=None):
+        self.num_replicas = torch.distributed.get_world_size() if num_replicas is None else num_replicas
+        self.rank = torch.distributed.get_rank() if rank is None else rank
+        self.indices = range(self.rank, len(dataset), self.num_replicas)
+
+    def __iter__(self):
+        return iter(self.indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+
 class YushanDataModule(pl.LightningDataModule):
-    def __init__(self, train_dataset, valid_dataset):
+    def __init__(self, train_dataset, valid_dataset, collate_fn=None):
         super().__init__()
         self.train = train_dataset
         self.valid = valid_dataset
+        self.collate_fn = collate_fn
+
+    def _get_sampler(self, dataset, shuffle, is_padded=True):
+        """Shard the dataset across processes when training with (CPU) DDP
+        is_padded: every rank gets the same number of batches (training), else every row is seen once (validation)
+        """
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return DistributedSampler(dataset, shuffle=shuffle) if is_padded else ShardSampler(dataset)
+        return None
 
     def train_dataloader(self):
-        return DataLoader(self.train, batch_size=DCFG.batch_size, num_workers=DCFG.num_workers, pin_memory=DCFG.is_memory_pinned, shuffle=DCFG.is_shuffled)
+        sampler = self._get_sampler(self.train, DCFG.is_shuffled)
+        loader = DataLoader(self.train, batch_size=DCFG.batch_size, num_workers=DCFG.num_workers, pin_memory=DCFG.is_memory_pinned, shuffle=DCFG.is_shuffled if sampler is None else False, sampler=sampler, collate_fn=self.collate_fn)
+        return instrument_loader(loader, 'train')
         
     def val_dataloader(self):
-        return DataLoader(self.valid, batch_size=DCFG.batch_size, num_workers=DCFG.num_workers, pin_memory=DCFG.is_memory_pinned)        
+        sampler = self._get_sampler(self.valid, False, is_padded=False)
+        loader = DataLoader(self.valid, batch_size=DCFG.batch_size, num_workers=DCFG.num_workers, pin_memory=DCFG.is_memory_pinned, sampler=sampler, collate_fn=self.collate_fn)
+        return instrument_loader(loader, 'val')
 
 
 
 # ------------------
 # DALI
 # ------------------
+def _get_transpose_op(device):
+    """HWC -> CHW, or nothing with DCFG.memory_format = 'channels_last' (NHWC outputs, see precision.NHWCLoader)"""
+    if is_channels_last():
+        return lambda output: output
+    return ops.Transpose(device=device, perm=[2, 0, 1])
+
+def _get_output_layout():
+    return types.NHWC if is_channels_last() else types.NCHW
+
+def _wrap_dali_loader(loader):
+    return NHWCLoader(loader) if is_channels_last() else loader
+
 class BasicPipeline(Pipeline):
     def __init__(self, 
             inp_dict, 
-            batch_size=DCFG.batch_size, 
-            num_workers=DCFG.num_workers, 
+            batch_size=None, 
+            num_workers=None, 
             phase='train', 
             device_id=0,
             exec_async=True, 
             exec_pipelined=True, 
-            seed=42
+            seed=42,
+            shard_id=None,
+            num_shards=None
         ):
+        # None: read DCFG when the pipeline is built, not when the module was imported (eg. sweep.RunConfig overrides)
+        batch_size = batch_size or DCFG.batch_size
+        num_workers = DCFG.num_workers if num_workers is None else num_workers
         super().__init__(batch_size, num_workers, device_id, exec_async=exec_async, exec_pipelined=exec_pipelined, seed=seed)
-        random_shuffle = True if phase == 'train' else False
-        self.input = ops.readers.File(files=inp_dict['path'], labels=inp_dict['label'], random_shuffle=random_shuffle, name="Reader")
+        self.inp_dict = inp_dict
+        self.random_shuffle = True if phase == 'train' else False
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.input = None # file reader, created in build(), see _get_shard
         self.decode = ops.decoders.Image(device="mixed", output_type=types.RGB)
         self.device = 'gpu'
         self.resize = ops.Resize(device=self.device)
         self.crop = ops.Crop(device=self.device, crop=[224.0, 224.0], dtype=types.FLOAT)
-        self.transpose = ops.Transpose(device=self.device, perm=[2, 0, 1])
+        self.transpose = _get_transpose_op(self.device)
         self.phase = phase
     
+    def _get_shard(self):
+        """(shard_id, num_shards), one shard per DDP process: the rank / world size of the process group when the
+        pipeline is built (DaliModule.setup, inside every spawned process), unless given explicitly
+        """
+        if self.shard_id is not None and self.num_shards is not None:
+            return self.shard_id, self.num_shards
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def build(self):
+        if self.input is None:
+            shard_id, num_shards = self._get_shard()
+            self.input = ops.readers.File(files=list(self.inp_dict['path']), labels=list(self.inp_dict['label']), random_shuffle=self.random_shuffle, shard_id=shard_id, num_shards=num_shards, name="Reader")
+        super().build()
+
     def define_graph(self):
         self.jpegs, self.labels = self.input() 
         output = self.decode(self.jpegs)
@@ -107,8 +190,8 @@ class BasicCustomPipeline(BasicPipeline):
     def __init__(self, 
             inp_dict,
             custom_func=None,
-            batch_size=DCFG.batch_size, 
-            num_workers=DCFG.num_workers, 
+            batch_size=None, 
+            num_workers=None, 
             phase='train', 
             device_id=0
         ):
@@ -141,8 +224,8 @@ class AddRotateNormalizePipeline(BasicCustomPipeline):
     def __init__(self, 
             inp_dict,
             custom_func=None,  
-            batch_size=DCFG.batch_size, 
-            num_workers=DCFG.num_workers, 
+            batch_size=None, 
+            num_workers=None, 
             phase='train', 
             device_id=0
         ):        
@@ -150,7 +233,7 @@ class AddRotateNormalizePipeline(BasicCustomPipeline):
         self.rotate = ops.Rotate(device=self.device)  
         self.cmnp = ops.CropMirrorNormalize(device="gpu",
                                     dtype=types.FLOAT,
-                                    output_layout=types.NCHW,
+                                    output_layout=_get_output_layout(),
                                     image_type=types.RGB,
                                     mean=[185.39, 175.21, 177.48],
                                     std=[52.19, 53.27, 46.44]
@@ -175,8 +258,8 @@ class OtherAugPipeline(BasicCustomPipeline):
     def __init__(self, 
             inp_dict, 
             custom_func=None, 
-            batch_size=DCFG.batch_size, 
-            num_workers=DCFG.num_workers, 
+            batch_size=None, 
+            num_workers=None, 
             phase='train', 
             device_id=0
         ):        
@@ -185,7 +268,7 @@ class OtherAugPipeline(BasicCustomPipeline):
         self.color_space_conversion = ops.ColorSpaceConversion(Types.RGB, Types.GRAY, device=self.device) if 'gray' in DCFG.transform_approach else None
         self.cmnp = ops.CropMirrorNormalize(device="gpu",
                                     dtype=types.FLOAT,
-                                    output_layout=types.NCHW,
+                                    output_layout=_get_output_layout(),
                                     image_type=types.RGB,
                                     mean=[185.39, 175.21, 177.48],
                                     std=[52.19, 53.27, 46.44])
@@ -213,14 +296,14 @@ class TestNoisyStudentPipeline(BasicCustomPipeline):
             inp_dict,
             custom_func=None,
             warpaffine_transform=None,
-            batch_size=DCFG.batch_size, 
-            num_workers=DCFG.num_workers, 
+            batch_size=None, 
+            num_workers=None, 
             phase='train', 
             device_id=0
         ):        
         super().__init__(inp_dict, custom_func, batch_size, num_workers, phase, device_id)
         self.decode = ops.decoders.Image(device="cpu", output_type=types.RGB)        
-        self.transpose = ops.Transpose(device=self.device, perm=[2, 0, 1])
+        self.transpose = _get_transpose_op(self.device)
         self.phase = phase
         self.python_function = ops.PythonFunction(device="cpu", function=custom_func)
         self.fast_resize_crop = ops.FastResizeCropMirror(crop=[224.0, 224.0], mirror=0)
@@ -263,16 +346,22 @@ class TestNoisyStudentPipeline(BasicCustomPipeline):
         return (raw_output, output, self.labels)
 
 class NoisyStudentPipeline(BasicCustomPipeline):
+    """
+    Init Arguments:
+        is_raw_output: bool, also output the raw view for the teacher, False when teacher logits are cached (see teacher_cache.py)
+    """
     def __init__(self, 
             inp_dict,
             custom_func=None,
             warpaffine_transform=None,
-            batch_size=DCFG.batch_size, 
-            num_workers=DCFG.num_workers, 
+            batch_size=None, 
+            num_workers=None, 
             phase='train', 
-            device_id=0
+            device_id=0,
+            is_raw_output=True
         ):        
         super().__init__(inp_dict, custom_func, batch_size, num_workers, phase, device_id)
+        self.is_raw_output = is_raw_output
         self.fast_resize_crop = ops.FastResizeCropMirror(crop=[224.0, 224.0], mirror=0)
         self.rotate = ops.Rotate(device=self.device)  
         self.gaussian_blur = ops.GaussianBlur(device=self.device, window_size=5)
@@ -287,10 +376,11 @@ class NoisyStudentPipeline(BasicCustomPipeline):
         if self.python_function:
             output = self.python_function(output)
         
-        raw_output = self.resize(output, resize_x=248, resize_y=248)
-        raw_output = self.crop(raw_output)
-        raw_output = self.transpose(raw_output)
-        raw_output = raw_output/255.0
+        if self.is_raw_output:
+            raw_output = self.resize(output, resize_x=248, resize_y=248)
+            raw_output = self.crop(raw_output)
+            raw_output = self.transpose(raw_output)
+            raw_output = raw_output/255.0
 
         w = fn.random.uniform(range=(224.0, 320.0))
         h = fn.random.uniform(range=(224.0, 320.0))        
@@ -311,33 +401,45 @@ class NoisyStudentPipeline(BasicCustomPipeline):
             output = self.warpaffine(output, matrix=transform)
         output = self.transpose(output)
         output = output/255.0
+        if not self.is_raw_output:
+            return (output, self.labels)
         return (raw_output, output, self.labels)
 
 class DaliModule(pl.LightningDataModule):
+    """The pipelines are built in setup(), ie. in every DDP process after the spawn, so every rank reads its own shard"""
+    train_output_map = ["data", "label"]
     def __init__(self, train_pipeline, valid_pipeline):
         super().__init__()
         self.pip_train = train_pipeline
-        self.pip_train.build()
         self.pip_valid = valid_pipeline
+        self.train_loader = None
+        self.valid_loader = None
+
+    def setup(self, stage=None):
+        if self.train_loader is not None:
+            return
+        self.pip_train.build()
         self.pip_valid.build()
-        self.train_loader = DALIGenericIterator(self.pip_train, ["data", "label"] ,reader_name="Reader", last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)
-        self.valid_loader = DALIGenericIterator(self.pip_valid, ["data", "label"], reader_name="Reader", last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)
+        self.train_loader = instrument_loader(_wrap_dali_loader(DALIGenericIterator(self.pip_train, self.train_output_map, reader_name="Reader", last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)), 'train')
+        self.valid_loader = instrument_loader(_wrap_dali_loader(DALIGenericIterator(self.pip_valid, ["data", "label"], reader_name="Reader", last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)), 'val')
+
     def train_dataloader(self):
+        self.setup() # also usable without a trainer, eg. averaging.recalibrate_bn
         return self.train_loader
         
     def val_dataloader(self):
+        self.setup()
         return self.valid_loader
 
 class NoisyStudentDaliModule(DaliModule):
-    def __init__(self, train_pipeline, valid_pipeline):
-        super().__init__(train_pipeline, valid_pipeline)
-        self.train_loader = DALIGenericIterator(self.pip_train, ["raw_data", "aug_data", "label"] ,reader_name="Reader", last_batch_policy=LastBatchPolicy.PARTIAL, auto_reset=True)
+    train_output_map = ["raw_data", "aug_data", "label"]
 
-def get_input_data_and_transform_func(data_type=DCFG.data_type, is_for_testing=False):
+def get_input_data_and_transform_func(data_type=None, is_for_testing=False):
     """
     Arguments:
-        data_type: str, 'mixed' or 'cleaned' or '2nd' or 'noisy_student'
+        data_type: str, 'mixed' or 'cleaned' or '2nd' or 'noisy_student', default DCFG.data_type
     """        
+    data_type = data_type or DCFG.data_type
     train_images ,valid_images = None, None
     train_image_paths, valid_image_paths, train_int_labels, valid_int_labels = None, None, None, None
     
@@ -345,9 +447,10 @@ def get_input_data_and_transform_func(data_type=DCFG.data_type, is_for_testing=F
     if data_type == 'noisy_student':
         ( noised_image_paths, noised_int_labels,
         cleaned_image_paths, cleaned_int_labels,
-        valid_image_paths, valid_int_labels) = NoisyStudentDataHandler.get_noisy_student_data(student_iter=NS.student_iter)
-        train_image_paths = noised_image_paths + cleaned_image_paths
-        train_int_labels = noised_int_labels + cleaned_int_labels
+        valid_image_paths, valid_int_labels) = NoisyStudentDataHandler.get_noisy_student_data(
+            student_iter=sync_student_iter(), pseudo_label_manifest_path=get_pseudo_label_manifest_path(NS.student_iter))
+        train_image_paths = list(noised_image_paths) + list(cleaned_image_paths)
+        train_int_labels = list(noised_int_labels) + list(cleaned_int_labels)
     else:
         if data_type == 'raw':
             method_name = 'get_paths_and_int_labels'
@@ -383,16 +486,18 @@ def get_datasets(
         train_input_dict, 
         valid_input_dict,
         transform_func=None, 
-        is_dali_used=DCFG.is_dali_used, 
-        data_type=DCFG.data_type,
+        is_dali_used=None, 
+        data_type=None,
         **kwargs
     ):
     """
     kwargs:
         dali_custom_func: Optional
         dali_warpaffine_transform: Optional
+    None is_dali_used / data_type are read from DCFG when called
     """
-    
+    is_dali_used = DCFG.is_dali_used if is_dali_used is None else is_dali_used
+    data_type = data_type or DCFG.data_type
     dali_custom_func,  dali_warpaffine_transform = None, None    
     if "dali_custom_func" in kwargs.keys():
         dali_custom_func = kwargs["dali_custom_func"]
@@ -407,6 +512,8 @@ def get_datasets(
         train_dataset = AddRotateNormalizePipeline(train_input_dict, custom_func=dali_custom_func)
         valid_dataset = BasicCustomPipeline(valid_input_dict, custom_func=dali_custom_func, phase="valid")
     elif data_type == "mixed" or "cleaned" or "2nd":
+        # with batch augmentation the datasets return raw images, the DataLoader collate_fn augments them
+        transform_func = None if DCFG.is_batch_augmented else transform_func
         train_dataset = YuShanDataset(train_input_dict, transform=transform_func)
         valid_dataset = YuShanDataset(valid_input_dict, transform=transform_func)    
     else:
@@ -414,16 +521,24 @@ def get_datasets(
         
     return train_dataset, valid_dataset
 
-def get_datamodule(train_dataset, valid_dataset, is_dali_used=DCFG.is_dali_used, data_type=DCFG.data_type):
-    if is_dali_used:
-        return DaliModule(train_dataset, valid_dataset)
-    elif data_type == "noisy_student":
+def get_datamodule(train_dataset, valid_dataset, is_dali_used=None, data_type=None, collate_fn=None):
+    is_dali_used = DCFG.is_dali_used if is_dali_used is None else is_dali_used
+    data_type = data_type or DCFG.data_type
+    if data_type == "noisy_student":
         return NoisyStudentDaliModule(train_dataset, valid_dataset)
+    elif is_dali_used:
+        return DaliModule(train_dataset, valid_dataset)
     else:
-        return YushanDataModule(train_dataset, valid_dataset)
+        return YushanDataModule(train_dataset, valid_dataset, collate_fn=collate_fn)
 
-def create_datamodule(is_dali_used=DCFG.is_dali_used, data_type=DCFG.data_type, is_for_testing=False):
-    train_input_dict, valid_input_dict, transform_func = get_input_data_and_transform_func(data_type, is_for_testing=is_for_testing)
+def create_datamodule(is_dali_used=None, data_type=None, is_for_testing=False, input_data=None):
+    """None arguments are read from DCFG when called
+    input_data: (train_input_dict, valid_input_dict, transform_func) of get_input_data_and_transform_func(data_type),
+                eg. read once for a whole sweep (sweep.load_shared_input_data), None: read here
+    """
+    is_dali_used = DCFG.is_dali_used if is_dali_used is None else is_dali_used
+    data_type = data_type or DCFG.data_type
+    train_input_dict, valid_input_dict, transform_func = input_data or get_input_data_and_transform_func(data_type, is_for_testing=is_for_testing)
     kwargs = {"dali_custom_func": dali_custom_func, "dali_warpaffine_transform": dali_warpaffine_transform}
     train_dataset, valid_dataset = get_datasets(
         train_input_dict, 
@@ -434,6 +549,10 @@ def create_datamodule(is_dali_used=DCFG.is_dali_used, data_type=DCFG.data_type,
         **kwargs
         ) 
 
-    datamodule = get_datamodule(train_dataset, valid_dataset, is_dali_used=is_dali_used)    
+    if DCFG.is_batch_augmented:
+        collate_fn = BatchAugmentCollate(transform_func.pipeline)
+    else: # the augmented images are NHWC in memory, stack them as NHWC batches
+        collate_fn = channels_last_collate if is_channels_last() else None
+    datamodule = get_datamodule(train_dataset, valid_dataset, is_dali_used=is_dali_used, data_type=data_type, collate_fn=collate_fn)    
     print(f"Using dali: {is_dali_used}, module type: {datamodule.__class__}")
     return datamodule
\ No newline at end of file
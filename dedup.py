@@ -0,0 +1,367 @@
+# dedup.py
+import os
+import csv
+import json
+import time
+from itertools import combinations
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+
+from .manifest import Manifest
+
+"""
+Near-duplicate index of the image corpus: perceptual hashes, Hamming-radius search, duplicate clusters, leakage.
+
+    store = hash_manifest(Manifest.from_csv(ROOT + '/all_data.csv'), ROOT + '/data_txt/dedup')  # bulk, incremental
+    cluster_ids = find_duplicate_clusters(store, radius=4)
+    report_duplicates(store, cluster_ids, 'duplicates.csv')
+    report_leakage(store, train_manifest, valid_manifest, radius=4, output_path='leakage.csv')
+    FileHandler._make_manifests_once(dedup_folder=ROOT + '/data_txt/dedup')  # ManifestBuilder drops the duplicates
+
+Hashes: 64-bit dHash (grayscale 9x8, sign of the horizontal gradient) or pHash (sign of the 8x8 low frequencies of the
+32x32 DCT against their median), computed by a process pool, one cv2 thread per process. The hash store keeps the
+hash of every path (paths.manifest, hashes.npy uint64, is_valid.npy bool, meta.json written last), later runs only
+hash the new paths.
+
+Search (MultiIndexHash): the 64 bits are split into num_chunks chunks, each one indexed by a sorted array. Two hashes
+within Hamming distance r have at least one chunk within r // num_chunks (pigeonhole), so probing every chunk key
+with all its flips of at most r // num_chunks bits finds every neighbour (exact recall), and only the candidates are
+compared bit by bit. Identical hashes are collapsed first, so big groups of exact duplicates (eg. blank crops) do not
+produce quadratic candidate lists. Clusters are the connected components of the pairs within the radius.
+"""
+
+HASH_METHODS = ('dhash', 'phash')
+HASH_BITS = 64
+_POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+
+# --------------------------
+# Hashing
+# --------------------------
+def _bits_to_hash(bits):
+    """bool [N, 64] -> uint64 [N]"""
+    return np.packbits(bits.reshape(len(bits), HASH_BITS), axis=1).view('>u8').reshape(-1).astype(np.uint64)
+
+def dhash(image):
+    small = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    return small[:, 1:] > small[:, :-1]
+
+def phash(image):
+    small = cv2.resize(image, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low = cv2.dct(small)[:8, :8]
+    return low > np.median(low)
+
+def _hash_paths(paths, method):
+    """Worker: (uint64 hashes, is_valid) of image paths, unreadable images are invalid"""
+    cv2.setNumThreads(1)
+    hash_func = dhash if method == 'dhash' else phash
+    bits = np.zeros((len(paths), HASH_BITS), dtype=bool)
+    is_valid = np.zeros(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        image = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+        if image is not None and image.size:
+            bits[i] = hash_func(image).reshape(-1)
+            is_valid[i] = True
+    return _bits_to_hash(bits), is_valid
+
+def hash_paths(paths, method='dhash', num_workers=None, chunk_size=2000):
+    """Bulk hashing with a process pool, returns (uint64 hashes [N], is_valid bool [N])"""
+    assert method in HASH_METHODS, f"method should be one of {HASH_METHODS}"
+    num_workers = num_workers or os.cpu_count() or 1
+    chunks = [paths[i:i+chunk_size] for i in range(0, len(paths), chunk_size)]
+    if num_workers == 1 or len(chunks) <= 1:
+        results = [_hash_paths(chunk, method) for chunk in chunks]
+    else:
+        with ProcessPoolExecutor(num_workers) as executor:
+            results = list(executor.map(_hash_paths, chunks, [method]*len(chunks)))
+    if not results:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    return np.concatenate([result[0] for result in results]), np.concatenate([result[1] for result in results])
+
+
+class HashStore:
+    """Perceptual hash of every unique path of a corpus manifest, see module docstring for the layout"""
+    def __init__(self, manifest, hashes, is_valid, method='dhash'):
+        self.manifest = manifest
+        self.hashes = hashes
+        self.is_valid = is_valid
+        self.method = method
+
+    def __len__(self):
+        return len(self.manifest)
+
+    @staticmethod
+    def exists(folder):
+        return (Path(folder) / 'meta.json').exists()
+
+    @classmethod
+    def load(cls, folder):
+        folder = Path(folder)
+        with open(folder / 'meta.json') as in_file:
+            meta = json.load(in_file)
+        return cls(Manifest.load(folder / 'paths.manifest', mmap_mode=None), np.load(folder / 'hashes.npy'), np.load(folder / 'is_valid.npy'), meta['method'])
+
+    def save(self, folder):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        if (folder / 'meta.json').exists():
+            (folder / 'meta.json').unlink()
+        self.manifest.save(folder / 'paths.manifest')
+        np.save(folder / 'hashes.npy', self.hashes)
+        np.save(folder / 'is_valid.npy', self.is_valid)
+        with open(folder / 'meta.json', 'w') as out_file:
+            json.dump({'method': self.method, 'num_paths': len(self)}, out_file)
+
+    def get_rows(self, paths):
+        """Store rows of paths, -1 for unknown paths"""
+        path2row = {path: i for i, path in enumerate(self.manifest.path_table)}
+        return np.array([path2row.get(path, -1) for path in paths], dtype=np.int64)
+
+
+def hash_manifest(manifest, folder=None, method='dhash', num_workers=None):
+    """Hash store of the unique paths of manifest, only the paths missing from the store in folder are hashed"""
+    start = time.time()
+    path_ids = np.asarray(manifest.path_ids)
+    unique_path_ids, first_rows = np.unique(path_ids, return_index=True)
+    path_table = manifest.path_table
+    paths = [path_table[i] for i in unique_path_ids]
+    labels = np.asarray(manifest.labels)[first_rows]
+
+    old_store = HashStore.load(folder) if folder and HashStore.exists(folder) else None
+    hashes, is_valid = np.zeros(len(paths), dtype=np.uint64), np.zeros(len(paths), dtype=bool)
+    is_known = np.zeros(len(paths), dtype=bool)
+    if old_store is not None and old_store.method == method:
+        old_rows = old_store.get_rows(paths)
+        is_known = old_rows >= 0
+        hashes[is_known], is_valid[is_known] = old_store.hashes[old_rows[is_known]], old_store.is_valid[old_rows[is_known]]
+    new_ids = np.flatnonzero(~is_known)
+    hashes[new_ids], is_valid[new_ids] = hash_paths([paths[i] for i in new_ids], method, num_workers)
+
+    store = HashStore(Manifest.from_paths_and_labels(paths, labels), hashes, is_valid, method)
+    if folder:
+        store.save(folder)
+    print(f"{method} of {len(paths)} images ({len(new_ids)} hashed, {int((~is_valid).sum())} unreadable), time: {time.time() - start:.1f}s")
+    return store
+
+# --------------------------
+# Search
+# --------------------------
+def hamming_distance(a, b):
+    xor = np.atleast_1d(np.bitwise_xor(a, b)).astype(np.uint64)
+    if hasattr(np, 'bitwise_count'): # numpy >= 2.0
+        return np.bitwise_count(xor).astype(np.int64)
+    return _POPCOUNT_TABLE[xor.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def _expand_group_pairs(order, starts_a, counts_a, starts_b, counts_b):
+    """Every (member of group a, member of group b) pair of every group pair, vectorized"""
+    sizes = counts_a*counts_b
+    total = int(sizes.sum())
+    if not total:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    group = np.repeat(np.arange(len(sizes)), sizes)
+    offsets = np.arange(total) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    return order[starts_a[group] + offsets//counts_b[group]], order[starts_b[group] + offsets % counts_b[group]]
+
+
+class MultiIndexHash:
+    """Hamming-radius search over uint64 hashes, see module docstring
+    Init Arguments:
+        hashes: uint64 array
+        num_chunks: 64 // num_chunks bits per chunk key, 4 (16-bit keys) suits up to millions of hashes
+    """
+    def __init__(self, hashes, num_chunks=4):
+        assert HASH_BITS % num_chunks == 0, f"num_chunks should divide {HASH_BITS}"
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.num_chunks = num_chunks
+        self.chunk_bits = HASH_BITS//num_chunks
+        self.tables = []
+        for j in range(num_chunks):
+            keys = self._get_keys(self.hashes, j)
+            order = np.argsort(keys, kind='stable')
+            self.tables.append((keys[order], order))
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def _get_keys(self, hashes, j):
+        return ((hashes >> np.uint64(j*self.chunk_bits)) & np.uint64((1 << self.chunk_bits) - 1)).astype(np.int64)
+
+    def _get_probe_masks(self, radius):
+        """Chunk xor masks of at most radius // num_chunks flipped bits"""
+        masks = [0]
+        for num_flips in range(1, radius//self.num_chunks + 1):
+            masks += [sum(1 << bit for bit in bits) for bits in combinations(range(self.chunk_bits), num_flips)]
+        return masks
+
+    def query(self, hash_value, radius=4):
+        """(ids, distances) of the hashes within radius of hash_value, closest first"""
+        hash_value = np.uint64(hash_value)
+        candidates = []
+        for j, (sorted_keys, order) in enumerate(self.tables):
+            key = int(self._get_keys(np.array([hash_value]), j)[0])
+            for mask in self._get_probe_masks(radius):
+                start, end = np.searchsorted(sorted_keys, [key ^ mask, (key ^ mask) + 1])
+                candidates.append(order[start:end])
+        ids = np.unique(np.concatenate(candidates)) if candidates else np.zeros(0, dtype=np.int64)
+        distances = hamming_distance(self.hashes[ids], hash_value)
+        is_near = distances <= radius
+        ids, distances = ids[is_near], distances[is_near]
+        order = np.argsort(distances, kind='stable')
+        return ids[order], distances[order]
+
+    def _get_near_pairs(self, order, starts_a, counts_a, starts_b, counts_b, radius, max_pairs=4_000_000):
+        """Candidate pairs of the group pairs, expanded max_pairs at a time and filtered on the real distance"""
+        lefts, rights = [], []
+        sizes = np.cumsum(counts_a*counts_b)
+        batch_ends = np.searchsorted(sizes, np.arange(max_pairs, sizes[-1] + max_pairs, max_pairs), side='right') if len(sizes) else []
+        batch_start = 0
+        for batch_end in np.unique(np.maximum(batch_ends, 1)):
+            batch = slice(batch_start, batch_end)
+            left, right = _expand_group_pairs(order, starts_a[batch], counts_a[batch], starts_b[batch], counts_b[batch])
+            is_near = (left != right) & (hamming_distance(self.hashes[left], self.hashes[right]) <= radius)
+            lefts.append(np.minimum(left, right)[is_near])
+            rights.append(np.maximum(left, right)[is_near])
+            batch_start = batch_end
+        return lefts, rights
+
+    def get_pairs(self, radius=4):
+        """Every (i, j), i < j, of hashes within radius, as two int64 arrays"""
+        lefts, rights = [], []
+        for sorted_keys, order in self.tables:
+            unique_keys, starts, counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+            for mask in self._get_probe_masks(radius):
+                if mask == 0:
+                    is_group = counts > 1
+                    group_pairs = (starts[is_group], counts[is_group], starts[is_group], counts[is_group])
+                else:
+                    partner_keys = unique_keys ^ mask
+                    partner_ids = np.minimum(np.searchsorted(unique_keys, partner_keys), len(unique_keys) - 1)
+                    is_pair = (unique_keys[partner_ids] == partner_keys) & (unique_keys < partner_keys) # each group pair once
+                    group_pairs = (starts[is_pair], counts[is_pair], starts[partner_ids[is_pair]], counts[partner_ids[is_pair]])
+                near_lefts, near_rights = self._get_near_pairs(order, *group_pairs, radius)
+                lefts += near_lefts
+                rights += near_rights
+        if not lefts:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pair_codes = np.unique(np.concatenate(lefts)*len(self) + np.concatenate(rights)) # pairs found through several chunks
+        return pair_codes//len(self), pair_codes % len(self)
+
+# --------------------------
+# Clusters
+# --------------------------
+def _connected_components(num_nodes, left, right):
+    """Vectorized union-find: every node gets the smallest node id of its component (min-label propagation with
+    pointer jumping)
+    """
+    roots = np.arange(num_nodes)
+    while True:
+        new_roots = roots.copy()
+        min_roots = np.minimum(roots[left], roots[right])
+        np.minimum.at(new_roots, left, min_roots)
+        np.minimum.at(new_roots, right, min_roots)
+        new_roots = new_roots[new_roots] # pointer jumping
+        if np.array_equal(new_roots, roots):
+            return roots
+        roots = new_roots
+
+def find_duplicate_clusters(store, radius=4, num_chunks=4):
+    """Cluster id of every store row (the smallest row id of its cluster), unreadable images stay alone"""
+    start = time.time()
+    valid_rows = np.flatnonzero(store.is_valid)
+    unique_hashes, inverse = np.unique(store.hashes[valid_rows], return_inverse=True)
+    left, right = MultiIndexHash(unique_hashes, num_chunks).get_pairs(radius)
+    hash_roots = _connected_components(len(unique_hashes), left, right)
+    # identical hashes share their unique hash node, the cluster id is the smallest row of the component
+    cluster_rows = np.full(len(unique_hashes), len(store), dtype=np.int64)
+    np.minimum.at(cluster_rows, hash_roots[inverse], valid_rows)
+    cluster_ids = np.arange(len(store))
+    cluster_ids[valid_rows] = cluster_rows[hash_roots[inverse]]
+    num_duplicates = len(store) - len(np.unique(cluster_ids))
+    print(f"{num_duplicates} duplicates of {len(store)} images within radius {radius} ({len(left)} near hash pairs), time: {time.time() - start:.1f}s")
+    return cluster_ids
+
+def get_duplicate_paths(store, cluster_ids, is_conflict_dropped=False):
+    """Paths to exclude: every cluster member but the first one (the kept representative), or the whole cluster
+    when its members have different labels and is_conflict_dropped
+    """
+    rows = np.arange(len(store))
+    is_duplicate = cluster_ids != rows
+    if is_conflict_dropped:
+        labels = np.asarray(store.manifest.labels)
+        is_conflict = labels != labels[cluster_ids]
+        conflict_clusters = np.unique(cluster_ids[is_conflict])
+        is_duplicate |= np.isin(cluster_ids, conflict_clusters)
+    path_table = store.manifest.path_table
+    return [path_table[i] for i in np.flatnonzero(is_duplicate)]
+
+# --------------------------
+# Reports
+# --------------------------
+def report_duplicates(store, cluster_ids, output_path=None):
+    """One csv row per member of every cluster of 2+ images, biggest clusters first
+    Returns:
+        dict summary
+    """
+    cluster_sizes = np.bincount(cluster_ids, minlength=len(store))
+    rows = np.flatnonzero(cluster_sizes[cluster_ids] > 1)
+    labels = np.asarray(store.manifest.labels)
+    rows = rows[np.lexsort((rows, cluster_ids[rows], -cluster_sizes[cluster_ids[rows]]))]
+    clusters = np.unique(cluster_ids[rows])
+    num_labels = {int(cluster): len(np.unique(labels[cluster_ids == cluster])) for cluster in clusters} if len(clusters) < 100_000 else {}
+    summary = {
+        'num_images': len(store),
+        'num_clusters': len(clusters),
+        'num_images_in_clusters': len(rows),
+        'num_removable': len(rows) - len(clusters),
+        'num_conflicting_clusters': sum(count > 1 for count in num_labels.values()),
+        'max_cluster_size': int(cluster_sizes.max()) if len(store) else 0,
+    }
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        path_table = store.manifest.path_table
+        with open(output_path, 'w', newline='', encoding='utf-8') as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['cluster_id', 'cluster_size', 'num_labels', 'path', 'int_label', 'hash'])
+            for row in rows:
+                cluster = int(cluster_ids[row])
+                writer.writerow([cluster, int(cluster_sizes[cluster]), num_labels.get(cluster, ''), path_table[row], int(labels[row]), f"{int(store.hashes[row]):016x}"])
+    print(summary)
+    return summary
+
+def report_leakage(store, train_manifest, valid_manifest, radius=4, num_chunks=4, output_path=None):
+    """Valid images with a near duplicate in the train manifest, every (valid, train) pair written to output_path
+    The paths of both manifests should be in the store (see hash_manifest)
+    Returns:
+        dict summary
+    """
+    train_paths, valid_paths = train_manifest.path_table, valid_manifest.path_table
+    train_rows, valid_rows = store.get_rows(train_paths), store.get_rows(valid_paths)
+    assert (train_rows >= 0).all() and (valid_rows >= 0).all(), "hash the train and valid manifests first (hash_manifest)"
+    train_rows, valid_rows = train_rows[store.is_valid[train_rows]], valid_rows[store.is_valid[valid_rows]]
+    index = MultiIndexHash(store.hashes[train_rows], num_chunks)
+    path_table, labels = store.manifest.path_table, np.asarray(store.manifest.labels)
+    pairs = []
+    for valid_row in valid_rows:
+        ids, distances = index.query(store.hashes[valid_row], radius)
+        pairs += [(valid_row, train_rows[i], distance) for i, distance in zip(ids, distances)]
+    leaked_rows = {valid_row for valid_row, _, _ in pairs}
+    summary = {
+        'num_valid': len(valid_rows),
+        'num_leaked_valid': len(leaked_rows),
+        'leaked_fraction': len(leaked_rows)/max(1, len(valid_rows)),
+        'num_pairs': len(pairs),
+        'num_label_mismatch_pairs': int(sum(labels[valid_row] != labels[train_row] for valid_row, train_row, _ in pairs)),
+    }
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, 'w', newline='', encoding='utf-8') as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['valid_path', 'valid_label', 'train_path', 'train_label', 'distance'])
+            for valid_row, train_row, distance in pairs:
+                writer.writerow([path_table[valid_row], int(labels[valid_row]), path_table[train_row], int(labels[train_row]), int(distance)])
+    print(summary)
+    return summary
@@ -0,0 +1,162 @@
+# distill.py
+import os
+import csv
+import time
+from datetime import date
+
+from .config import DCFG, MCFG, NS
+
+"""
+Knowledge distillation into small CPU-serving students, and the accuracy / latency table to pick the serving model.
+
+    1) distill_students(['effb0_w0.5', 'mobilenet_v3_large', 'mobilenet_v3_small']) trains every student with
+       model.DistillClassifier against the NS.teacher_model_type / NS.teacher_ckpt_path teacher, one version folder
+       per student (root_model_folder/student/{today}.distill). distill_trial also runs as a sweep.SweepRunner trial.
+    2) make_pareto_table(candidates) measures the single-image (batch 1) CPU latency and size of every candidate,
+       reads its best val_acc from the metrics index, and marks the Pareto front: the models that no other model beats
+       on both accuracy and latency. The serving model is the most accurate one of the front within the latency budget.
+
+Student types: any torchvision model name, or a narrower / shallower EfficientNet "effb0_w0.5" / "effb0_w0.75_d0.8"
+(width / depth multipliers of the b0 baseline, trained from scratch, see model._get_raw_model).
+"""
+
+def get_teacher_model(teacher_model_type=None, teacher_ckpt_path=None):
+    from .model import get_model
+    teacher_model_type = teacher_model_type or NS.teacher_model_type
+    teacher_ckpt_path = teacher_ckpt_path or NS.teacher_ckpt_path
+    assert teacher_ckpt_path, "set NS.teacher_ckpt_path to the trained teacher checkpoint"
+    return get_model(raw_model_type=teacher_model_type, model_class_name='DaliEffClassifier', ckpt_path=teacher_ckpt_path, is_continued_training=False)
+
+def get_student_model(student_model_type, teacher_model, is_pretrained=None):
+    """DistillClassifier of student_model_type with the teacher set"""
+    from .model import get_model
+    student_model = get_model(raw_model_type=student_model_type, is_pretrained=is_pretrained, model_class_name='DistillClassifier', ckpt_path=None, is_continued_training=False)
+    student_model.set_teacher_model(teacher_model)
+    return student_model
+
+def distill_trial(run_config, max_epochs, ckpt_path=None):
+    """sweep.SweepRunner trial, run_config overrides model_type with the student type, eg. {'model_type': 'mobilenet_v3_small'}
+    Returns:
+        dict {'metric': value of MCFG.monitor, 'ckpt_path': last checkpoint to resume from}
+    """
+    from .dataset import create_datamodule
+    from .train import single_train
+    from .sweep import get_shared_input_data
+
+    MCFG.max_epochs = max_epochs
+    MCFG.is_continued_training = ckpt_path is not None
+    MCFG.ckpt_path = ckpt_path
+    trial_name = f"{run_config.sweep_id}_{run_config.name}" if run_config.sweep_id else run_config.name # distill_students: no sweep
+    MCFG.version = f"{date.today()}.distill_{trial_name}"
+    MCFG.target_version_folder = MCFG.root_model_folder / MCFG.model_type / MCFG.version
+    model = get_student_model(MCFG.model_type, get_teacher_model())
+    datamodule = create_datamodule(is_dali_used=DCFG.is_dali_used, data_type=DCFG.data_type, input_data=get_shared_input_data())
+    trainer, model = single_train(model, datamodule, is_user_input_needed=False)
+    last_ckpt_path = MCFG.target_version_folder / "checkpoints" / "last.ckpt"
+    trainer.save_checkpoint(last_ckpt_path)
+    return {'metric': float(trainer.callback_metrics[MCFG.monitor]), 'ckpt_path': str(last_ckpt_path), 'version_folder': str(MCFG.target_version_folder)}
+
+def distill_students(student_model_types, max_epochs=None):
+    """Train every student one after another in this process
+    Returns:
+        {student type: distill_trial output}
+    """
+    from .sweep import RunConfig
+    outputs = {}
+    for student_model_type in student_model_types:
+        run_config = RunConfig(student_model_type, {'model_type': student_model_type, 'model_class_name': 'DistillClassifier'})
+        run_config.apply()
+        outputs[student_model_type] = distill_trial(run_config, max_epochs or MCFG.max_epochs)
+        print(f"{student_model_type}: {MCFG.monitor} {outputs[student_model_type]['metric']}")
+    return outputs
+
+# --------------------------
+# Accuracy / latency table
+# --------------------------
+def measure_cpu_latency(model, input_shape=(1, 3, 224, 224), num_threads=1, num_warmup=5, num_runs=30):
+    """Single-image CPU latency of model (ms), the serving setting: batch 1, no_grad, num_threads intra-op threads
+    Returns:
+        {'median_ms', 'p90_ms'}
+    """
+    import torch
+    previous_num_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads)
+    model = model.cpu().eval()
+    x = torch.rand(*input_shape)
+    times = []
+    try:
+        with torch.no_grad():
+            for i in range(num_warmup + num_runs):
+                start = time.perf_counter()
+                model(x)
+                if i >= num_warmup:
+                    times.append(1000*(time.perf_counter() - start))
+    finally:
+        torch.set_num_threads(previous_num_threads)
+    times.sort()
+    return {'median_ms': times[len(times)//2], 'p90_ms': times[int(0.9*(len(times) - 1))]}
+
+def get_pareto_front(rows, accuracy_key='val_acc', latency_key='median_ms'):
+    """Names of the rows that no other row beats on both accuracy (higher) and latency (lower)"""
+    front = []
+    for row in rows:
+        is_dominated = any(
+            other[accuracy_key] >= row[accuracy_key] and other[latency_key] <= row[latency_key] and
+            (other[accuracy_key] > row[accuracy_key] or other[latency_key] < row[latency_key])
+            for other in rows if other is not row
+        )
+        if not is_dominated:
+            front.append(row['name'])
+    return front
+
+def make_pareto_table(candidates, output_path=None, target_metric="val_acc", num_threads=1, latency_budget_ms=None):
+    """
+    Arguments:
+        candidates: list of dict {'name', 'model_type', 'ckpt_path'} and optionally 'val_acc' (else the best target_metric
+            of the checkpoint's version folder from the metrics index), eg. the teacher and the distill_students outputs
+        output_path: str or Path, csv of the table
+        latency_budget_ms: float, the recommended model is the most accurate Pareto model within it
+    Returns:
+        list of row dicts sorted by latency, name of the recommended model
+    """
+    from pathlib import Path
+    from .model import get_pred_model
+    from .utils import ModelFileHandler
+
+    rows = []
+    for candidate in candidates:
+        model = get_pred_model(candidate['model_type'], MCFG.root_model_folder, best_model_ckpt=candidate['ckpt_path'])
+        val_acc = candidate.get('val_acc')
+        if val_acc is None:
+            version_folder = Path(candidate['ckpt_path']).parent.parent # version_folder/checkpoints/*.ckpt
+            val_acc, _, _ = ModelFileHandler.get_best_metrics_record(version_folder, target_metric)
+        latency = measure_cpu_latency(model.model, num_threads=num_threads)
+        rows.append({
+            'name': candidate['name'],
+            'model_type': candidate['model_type'],
+            'val_acc': float(val_acc) if val_acc is not None else float('nan'),
+            'params_m': sum(param.numel() for param in model.model.parameters())/1e6,
+            **latency,
+            'ckpt_path': str(candidate['ckpt_path']),
+        })
+        del model
+
+    front = get_pareto_front([row for row in rows if row['val_acc'] == row['val_acc']])
+    for row in rows:
+        row['is_pareto'] = row['name'] in front
+    rows.sort(key=lambda row: row['median_ms'])
+    within_budget = [row for row in rows if row['is_pareto'] and (latency_budget_ms is None or row['median_ms'] <= latency_budget_ms)]
+    recommended = max(within_budget, key=lambda row: row['val_acc'])['name'] if within_budget else None
+
+    print(f"{'name':<28}{'val_acc':>9}{'params(M)':>11}{'median(ms)':>12}{'p90(ms)':>10}  pareto")
+    for row in rows:
+        print(f"{row['name']:<28}{row['val_acc']:>9.4f}{row['params_m']:>11.2f}{row['median_ms']:>12.2f}{row['p90_ms']:>10.2f}  {'*' if row['is_pareto'] else ''}")
+    print(f"recommended serving model: {recommended} (latency budget: {latency_budget_ms} ms, {num_threads} thread(s))")
+
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, 'w', newline='') as out_file:
+            writer = csv.DictWriter(out_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows, recommended
@@ -0,0 +1,282 @@
+# evaluate.py
+import os
+import csv
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from .config import DCFG, MCFG
+from .manifest import Manifest
+from .precision import prepare_model, is_channels_last, channels_last_collate
+
+"""
+Offline evaluation outside Lightning: any checkpoint or exported artifact, a whole manifest, one report.
+
+    evaluator = Evaluator(load_eval_model('.../checkpoints/epoch=9.ckpt'), 'valid.manifest', cache_folder='.../eval')
+    predictions = evaluator.run()            # model runs only if the cache is missing / stale
+    report = predictions.report()            # top1, top5, per-class recall of the 801 classes (isnull included), confusion
+    predictions.report(indices=...)          # any slice of the rows, from the cache, no model run
+    predictions.save_report(folder)
+
+Loading (load_eval_model): a Lightning checkpoint (.ckpt, through model.get_model, optionally wrapped in
+compiled.CompiledModel) or a TorchScript artifact (.pt / .ts, eg. the cached graphs of CompiledModel).
+
+CPU utilization: the images are decoded and preprocessed (preprocess.preprocess, the inference view) by num_workers
+DataLoader processes (1 cv2 / torch thread each), the model uses the remaining cores for its intra-op threads,
+so decoding and the forward passes overlap and every core is busy.
+
+The cache (cache_folder) keeps the label, the top-k class ids and their probabilities of every row:
+    labels.npy int16 [N], topk_ids.npy int16 [N, k], topk_probs.npy float16 [N, k],
+    meta.json {'cache_key', 'manifest', 'num_rows', 'fingerprint', 'top_k'}, fingerprint: Manifest.fingerprint, a rewritten manifest is predicted again
+The confusion matrix is sparse: (label, prediction, count) triplets of the non-zero cells only.
+"""
+
+TOP_K = 5
+
+
+class ManifestImageDataset(Dataset):
+    """(preprocessed image [C, 224, 224], row index) of every manifest row"""
+    def __init__(self, manifest, transform=None):
+        from .preprocess import preprocess
+        self.manifest = manifest
+        self.transform = transform or preprocess
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, index):
+        from .utils import ImageReader
+        image = ImageReader.read_image_RGB_cv2(self.manifest.path(index))
+        return self.transform(image), index
+
+
+def _init_decode_worker(worker_id):
+    import cv2
+    cv2.setNumThreads(1)
+    torch.set_num_threads(1)
+
+
+def get_saved_model_config(ckpt_path):
+    """(model_type, model_class_name) saved in the hyperparameters of a Lightning checkpoint (None when missing)"""
+    hparams = torch.load(ckpt_path, map_location='cpu').get('hyper_parameters', {})
+    return hparams.get('model_type'), hparams.get('model_class_name')
+
+
+def load_eval_model(artifact_path, raw_model_type=None, model_class_name=None, compile_backend=None, device='cpu'):
+    """Eval model of a checkpoint (.ckpt) or a TorchScript artifact (.pt / .ts)
+    Arguments:
+        raw_model_type, model_class_name: None: read from the checkpoint hyperparameters, else MCFG
+        compile_backend: None | 'trace' | 'compile', checkpoints only, see compiled.CompiledModel
+    A checkpoint of a pruned version (pruning_plan.json next to its checkpoints folder) is rebuilt with prune.load_pruned_model
+    """
+    artifact_path = Path(artifact_path)
+    if artifact_path.suffix in ('.pt', '.ts'):
+        return torch.jit.load(str(artifact_path), map_location=device).eval()
+    from .model import get_model
+    from .prune import get_pruning_plan_path, load_pruned_model
+    if raw_model_type is None or model_class_name is None:
+        saved_model_type, saved_class_name = get_saved_model_config(artifact_path)
+        raw_model_type = raw_model_type or saved_model_type or MCFG.model_type
+        model_class_name = model_class_name or saved_class_name
+    if get_pruning_plan_path(artifact_path) is not None:
+        model = load_pruned_model(artifact_path, raw_model_type=raw_model_type, model_class_name=model_class_name or MCFG.model_class_name)
+    else:
+        model = get_model(raw_model_type=raw_model_type, is_pretrained=False, model_class_name=model_class_name, ckpt_path=artifact_path, is_continued_training=False)
+    model = prepare_model(model.to(device)).eval()
+    if compile_backend:
+        from .compiled import CompiledModel
+        model = CompiledModel(model, backend=compile_backend, buckets=(DCFG.batch_size,))
+    return model
+
+
+def _get_default_workers():
+    num_cores = os.cpu_count() or 1
+    num_workers = max(1, num_cores//4) if num_cores > 1 else 0
+    return num_workers, max(1, num_cores - num_workers)
+
+
+class Evaluator:
+    """
+    Init Arguments:
+        model: callable [N, C, H, W] -> logits, see load_eval_model
+        manifest: Manifest or manifest folder
+        batch_size, num_workers (decoding processes), num_threads (torch intra-op): None for all the cores
+        cache_folder: folder of the cached predictions, None: not cached
+        cache_key: str identifying the model in the cache meta, eg. the checkpoint path (required with a cache)
+        transform: function(image) -> [C, 224, 224] tensor, default preprocess.preprocess
+    """
+    def __init__(self, model, manifest, batch_size=None, num_workers=None, num_threads=None, cache_folder=None, cache_key=None, device='cpu', transform=None):
+        self.model = model
+        self.transform = transform
+        self.manifest_path = None if isinstance(manifest, Manifest) else str(manifest)
+        self.manifest = manifest if isinstance(manifest, Manifest) else Manifest.load(manifest)
+        self.batch_size = batch_size or DCFG.batch_size
+        default_workers, default_threads = _get_default_workers()
+        self.num_workers = default_workers if num_workers is None else num_workers
+        self.num_threads = num_threads or default_threads
+        self.cache_folder = Path(cache_folder) if cache_folder else None
+        assert self.cache_folder is None or cache_key, "cache_key is needed to cache the predictions"
+        self.cache_key = cache_key
+        self.device = device
+
+    def _get_meta(self):
+        return {'cache_key': str(self.cache_key), 'manifest': self.manifest_path, 'num_rows': len(self.manifest), 'fingerprint': self.manifest.fingerprint(), 'top_k': TOP_K}
+
+    def _get_loader(self):
+        return DataLoader(
+            ManifestImageDataset(self.manifest, self.transform),
+            batch_size=self.batch_size,
+            num_workers=self.num_workers,
+            collate_fn=channels_last_collate if is_channels_last() else None,
+            worker_init_fn=_init_decode_worker,
+            prefetch_factor=4 if self.num_workers else None,
+            shuffle=False,
+        )
+
+    @torch.no_grad()
+    def _predict(self):
+        num_rows = len(self.manifest)
+        topk_ids = np.zeros((num_rows, TOP_K), dtype=np.int16)
+        topk_probs = np.zeros((num_rows, TOP_K), dtype=np.float16)
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(self.num_threads)
+        start = time.perf_counter()
+        try:
+            for x, ids in self._get_loader():
+                probs = torch.softmax(self.model(x.float().to(self.device)).float(), dim=1)
+                values, indices = probs.topk(TOP_K, dim=1)
+                topk_ids[ids.numpy()] = indices.cpu().numpy()
+                topk_probs[ids.numpy()] = values.cpu().numpy()
+        finally:
+            torch.set_num_threads(num_threads)
+        elapsed = time.perf_counter() - start
+        print(f"evaluated {num_rows} images in {elapsed:.1f}s ({num_rows/max(elapsed, 1e-9):.1f} images/s, "
+              f"{self.num_workers} decoding workers, {self.num_threads} threads)")
+        return Predictions(np.asarray(self.manifest.labels, dtype=np.int16), topk_ids, topk_probs)
+
+    def run(self, is_cache_refreshed=False):
+        """Predictions of every manifest row, read from the cache when its meta matches"""
+        meta = self._get_meta()
+        if self.cache_folder and not is_cache_refreshed and Predictions.is_valid(self.cache_folder, meta):
+            print(f"predictions loaded from {self.cache_folder}")
+            return Predictions.load(self.cache_folder)
+        predictions = self._predict()
+        if self.cache_folder:
+            predictions.save(self.cache_folder, meta)
+        return predictions
+
+
+class Predictions:
+    """Cached top-k predictions of a manifest, every report is computed from them without the model"""
+    def __init__(self, labels, topk_ids, topk_probs, class_num=DCFG.class_num):
+        self.labels = labels
+        self.topk_ids = topk_ids
+        self.topk_probs = topk_probs
+        self.class_num = class_num
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def preds(self):
+        return self.topk_ids[:, 0]
+
+    def save(self, folder, meta):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        if (folder / 'meta.json').exists():
+            (folder / 'meta.json').unlink()
+        for name in ('labels', 'topk_ids', 'topk_probs'):
+            np.save(folder / f'{name}.npy', getattr(self, name))
+        with open(folder / 'meta.json', 'w') as out_file: # written last, marks a complete cache
+            json.dump(meta, out_file)
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        folder = Path(folder)
+        return cls(*[np.load(folder / f'{name}.npy', mmap_mode=mmap_mode) for name in ('labels', 'topk_ids', 'topk_probs')])
+
+    @staticmethod
+    def is_valid(folder, meta):
+        meta_path = Path(folder) / 'meta.json'
+        if not meta_path.exists():
+            return False
+        with open(meta_path) as in_file:
+            return json.load(in_file) == meta
+
+    def get_confusion(self, indices=None):
+        """Sparse confusion matrix: labels, preds, counts of the non-zero cells"""
+        labels = np.asarray(self.labels if indices is None else self.labels[indices], dtype=np.int64)
+        preds = np.asarray(self.preds if indices is None else self.preds[indices], dtype=np.int64)
+        cells, counts = np.unique(labels*self.class_num + preds, return_counts=True)
+        return cells//self.class_num, cells % self.class_num, counts
+
+    def report(self, indices=None):
+        """
+        Arguments:
+            indices: rows of the slice (int array or bool mask), None: every row
+        Returns:
+            dict of num_samples, top1, top5, per-class recall / support [class_num] (recall nan without support),
+            mean_class_recall and the sparse confusion (labels, preds, counts)
+        """
+        labels = np.asarray(self.labels if indices is None else self.labels[indices], dtype=np.int64)
+        topk_ids = np.asarray(self.topk_ids if indices is None else self.topk_ids[indices], dtype=np.int64)
+        is_top1 = topk_ids[:, 0] == labels
+        is_top5 = (topk_ids == labels[:, None]).any(axis=1)
+        support = np.bincount(labels, minlength=self.class_num)
+        hits = np.bincount(labels[is_top1], minlength=self.class_num)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            recall = np.where(support > 0, hits/support, np.nan)
+        return {
+            'num_samples': len(labels),
+            'top1': float(is_top1.mean()) if len(labels) else float('nan'),
+            'top5': float(is_top5.mean()) if len(labels) else float('nan'),
+            'mean_class_recall': float(np.nanmean(recall)) if support.any() else float('nan'),
+            'recall': recall,
+            'support': support,
+            'confusion': self.get_confusion(indices),
+        }
+
+    def save_report(self, folder, indices=None, name='report'):
+        """{name}.json (summary), {name}_per_class.csv (recall of every class) and {name}_confusion.csv
+        (off-diagonal cells, most frequent first)
+        """
+        from .utils import int_label2word
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        report = self.report(indices)
+        summary = {key: report[key] for key in ('num_samples', 'top1', 'top5', 'mean_class_recall')}
+        with open(folder / f'{name}.json', 'w') as out_file:
+            json.dump(summary, out_file, indent=4)
+        with open(folder / f'{name}_per_class.csv', 'w', newline='', encoding='utf-8') as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['int_label', 'word', 'support', 'recall'])
+            for label in range(self.class_num):
+                writer.writerow([label, int_label2word(label), int(report['support'][label]), report['recall'][label]])
+        labels, preds, counts = report['confusion']
+        is_error = labels != preds
+        order = np.argsort(-counts[is_error], kind='stable')
+        with open(folder / f'{name}_confusion.csv', 'w', newline='', encoding='utf-8') as out_file:
+            writer = csv.writer(out_file)
+            writer.writerow(['label', 'label_word', 'pred', 'pred_word', 'count'])
+            for label, pred, count in zip(labels[is_error][order], preds[is_error][order], counts[is_error][order]):
+                writer.writerow([int(label), int_label2word(int(label)), int(pred), int_label2word(int(pred)), int(count)])
+        print(summary)
+        return summary
+
+
+def evaluate(args):
+    """main.py -s evaluate -c artifact -i manifest [--report-folder folder]: cached predictions and reports in
+    report_folder (default: next to the artifact, eval_{manifest name})
+    """
+    artifact_path, manifest_path = Path(args.checkpoint_path), Path(args.input_path)
+    report_folder = Path(getattr(args, 'report_folder', None) or artifact_path.parent / f"eval_{manifest_path.stem}")
+    model = load_eval_model(artifact_path, raw_model_type=args.model_type, compile_backend=getattr(args, 'compile_backend', None))
+    evaluator = Evaluator(model, manifest_path, cache_folder=report_folder / artifact_path.stem, cache_key=f"{artifact_path.resolve()}@{artifact_path.stat().st_mtime}")
+    predictions = evaluator.run()
+    predictions.save_report(report_folder, name=artifact_path.stem)
+    return predictions
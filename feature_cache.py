@@ -0,0 +1,262 @@
+# feature_cache.py
+import json
+import time
+import hashlib
+import random
+from pathlib import Path
+import numpy as np
+import torch
+from torch import nn
+from torch.utils.data import Dataset, DataLoader
+import pytorch_lightning as pl
+
+from .model import BasicClassifier
+from .dataset import YuShanDataset
+from .manifest import get_paths_fingerprint
+from .preprocess import teacher_view_transform
+from .config import DCFG, OCFG
+
+"""
+Frozen EfficientNet trunk cache for head-only / last-blocks fine-tuning and lr sweeps.
+
+The EfficientNet is split into a frozen prefix and a trainable suffix (split_efficientnet). The prefix runs once over
+the dataset (non augmented, or a fixed augmentation with a seed) and its outputs are written to a memory-mapped
+FeatureStore. Training then only runs the suffix on cached features:
+    num_trainable_blocks=0: pooled features [N, 1280] (b0), the suffix is dropout + _fc
+    num_trainable_blocks=k: activations before the last k MBConv blocks, the suffix is those blocks + conv head + _fc
+The prefix and suffix share their modules with the original model, so the trained suffix is already in place.
+
+FeatureStore folder layout:
+    meta.json:    {'num_samples', 'paths', 'num_trainable_blocks', 'model', 'weights', 'transform', 'feature_shape'}
+                  paths: fingerprint of the paths and labels, weights: checkpoint path@mtime or hash of the prefix weights
+    features.npy: float16, [num_samples, *feature_shape]
+    labels.npy:   int16, [num_samples]
+"""
+
+# --------------------------
+# Split model
+# --------------------------
+class EfficientNetPrefix(nn.Module):
+    """Stem + the first num_frozen_blocks MBConv blocks (+ conv head and pooling when every block is frozen)"""
+    def __init__(self, eff_model, num_frozen_blocks):
+        super().__init__()
+        self._conv_stem, self._bn0, self._swish = eff_model._conv_stem, eff_model._bn0, eff_model._swish
+        self._blocks = eff_model._blocks[:num_frozen_blocks]
+        self.total_blocks = len(eff_model._blocks)
+        self.drop_connect_rate = eff_model._global_params.drop_connect_rate
+        self.is_pooled = num_frozen_blocks == self.total_blocks
+        if self.is_pooled:
+            self._conv_head, self._bn1, self._avg_pooling = eff_model._conv_head, eff_model._bn1, eff_model._avg_pooling
+
+    def forward(self, x):
+        x = self._swish(self._bn0(self._conv_stem(x)))
+        for idx, block in enumerate(self._blocks):
+            drop_connect_rate = self.drop_connect_rate * float(idx) / self.total_blocks if self.drop_connect_rate else None
+            x = block(x, drop_connect_rate=drop_connect_rate)
+        if self.is_pooled:
+            x = self._swish(self._bn1(self._conv_head(x)))
+            x = self._avg_pooling(x).flatten(start_dim=1)
+        return x
+
+
+class EfficientNetSuffix(nn.Module):
+    """The last MBConv blocks (if any) + conv head + pooling + dropout + _fc"""
+    def __init__(self, eff_model, num_frozen_blocks):
+        super().__init__()
+        self._blocks = eff_model._blocks[num_frozen_blocks:]
+        self.block_offset = num_frozen_blocks
+        self.total_blocks = len(eff_model._blocks)
+        self.drop_connect_rate = eff_model._global_params.drop_connect_rate
+        self.is_pooled_input = num_frozen_blocks == self.total_blocks
+        if not self.is_pooled_input:
+            self._conv_head, self._bn1, self._avg_pooling, self._swish = eff_model._conv_head, eff_model._bn1, eff_model._avg_pooling, eff_model._swish
+        self._dropout, self._fc = eff_model._dropout, eff_model._fc
+
+    def forward(self, x):
+        if not self.is_pooled_input:
+            for idx, block in enumerate(self._blocks, start=self.block_offset):
+                drop_connect_rate = self.drop_connect_rate * float(idx) / self.total_blocks if self.drop_connect_rate else None
+                x = block(x, drop_connect_rate=drop_connect_rate)
+            x = self._swish(self._bn1(self._conv_head(x)))
+            x = self._avg_pooling(x).flatten(start_dim=1)
+        return self._fc(self._dropout(x))
+
+
+def split_efficientnet(eff_model, num_trainable_blocks=0):
+    """Returns (frozen prefix, trainable suffix), both sharing modules with eff_model"""
+    num_frozen_blocks = len(eff_model._blocks) - num_trainable_blocks
+    assert 0 <= num_frozen_blocks <= len(eff_model._blocks), f"num_trainable_blocks should be between 0 and {len(eff_model._blocks)}"
+    return EfficientNetPrefix(eff_model, num_frozen_blocks), EfficientNetSuffix(eff_model, num_frozen_blocks)
+
+# --------------------------
+# Feature store
+# --------------------------
+class FeatureStore(Dataset):
+    """Memory-mapped prefix outputs, usable directly as a Dataset of (feature, label)"""
+    def __init__(self, folder, mmap_mode='r'):
+        self.folder = Path(folder)
+        with open(self.folder / 'meta.json') as in_file:
+            self.meta = json.load(in_file)
+        self.features = np.load(self.folder / 'features.npy', mmap_mode=mmap_mode)
+        self.labels = np.load(self.folder / 'labels.npy', mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.asarray(self.features[index], dtype=np.float32)), int(self.labels[index])
+
+    @staticmethod
+    def is_valid(folder, meta):
+        """meta may leave out the entries only known after the extraction (feature_shape)"""
+        meta_path = Path(folder) / 'meta.json'
+        if not meta_path.exists():
+            return False
+        with open(meta_path) as in_file:
+            stored_meta = json.load(in_file)
+        return all(stored_meta.get(name) == value for name, value in meta.items())
+
+
+def _get_weights_hash(module):
+    s = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        s.update(name.encode('utf-8'))
+        s.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return s.hexdigest()
+
+
+def _seed_worker(worker_id):
+    """Fixed augmentation: every worker gets its own but reproducible numpy / random seed"""
+    seed = torch.initial_seed() % 2**32
+    np.random.seed(seed)
+    random.seed(seed)
+
+
+@torch.no_grad()
+def extract_features(
+        eff_model,
+        input_dict,
+        folder,
+        num_trainable_blocks=0,
+        transform=teacher_view_transform,
+        seed=42,
+        weights_key=None,
+        batch_size=DCFG.batch_size,
+        num_workers=DCFG.num_workers,
+        device=DCFG.device
+    ):
+    """Run the frozen prefix once over input_dict and write the outputs to a FeatureStore
+    Arguments:
+        eff_model: EfficientNet, eg. EfficientClassifier().model
+        transform: function, teacher_view_transform (no augmentation) or an augmentation like transform_func,
+                   the random augmentation is fixed by seed
+        weights_key: str identifying the weights, eg. pseudo_label.get_teacher_key(ckpt_path), default: hash of the prefix weights
+    """
+    folder = Path(folder)
+    prefix, _ = split_efficientnet(eff_model, num_trainable_blocks)
+    meta = {
+        'num_samples': len(input_dict['path']),
+        'paths': get_paths_fingerprint(input_dict['path'], input_dict['label']),
+        'num_trainable_blocks': num_trainable_blocks,
+        'model': f'{type(eff_model).__name__}, {len(eff_model._blocks)} blocks',
+        'weights': weights_key or _get_weights_hash(prefix),
+        'transform': f'{transform.__name__}, seed {seed}',
+    }
+    if FeatureStore.is_valid(folder, meta):
+        print(f'features already cached in {folder}')
+        return FeatureStore(folder)
+
+    start = time.time()
+    prefix.eval().to(device)
+    torch.manual_seed(seed)
+    dataset = YuShanDataset({'image': None, 'path': input_dict['path'], 'label': list(range(meta['num_samples']))}, transform=transform)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=DCFG.is_memory_pinned, shuffle=False, worker_init_fn=_seed_worker)
+    sample_shape = list(prefix(dataset[0][0].unsqueeze(0).float().to(device)).shape[1:])
+    meta['feature_shape'] = sample_shape
+    folder.mkdir(parents=True, exist_ok=True)
+    if (folder / 'meta.json').exists():
+        (folder / 'meta.json').unlink()
+    features = np.lib.format.open_memmap(folder / 'features.npy', mode='w+', dtype=np.float16, shape=(meta['num_samples'], *sample_shape))
+    torch.manual_seed(seed) # the sample shape forward above may have used the generator, the worker seeds derive from it
+    if not num_workers: # the batches are made in this process, worker_init_fn is not called
+        _seed_worker(0)
+    for x, ids in loader:
+        features[ids.numpy()] = prefix(x.float().to(device)).cpu().numpy().astype(np.float16)
+    features.flush()
+    np.save(folder / 'labels.npy', np.asarray(input_dict['label'], dtype=np.int16))
+    with open(folder / 'meta.json', 'w') as out_file:
+        json.dump(meta, out_file)
+    print(f'features {sample_shape} of {meta["num_samples"]} samples cached in {folder}, time: {time.time() - start:.1f}s')
+    return FeatureStore(folder)
+
+# --------------------------
+# Training on cached features
+# --------------------------
+class CachedFeatureClassifier(BasicClassifier):
+    """Trains an EfficientNetSuffix on FeatureStore batches, works with train.single_train"""
+    def __init__(self, raw_model):
+        super().__init__(raw_model)
+
+    def _get_params_group(self):
+        head_params_id = list(map(id, self.model._fc.parameters()))
+        block_params = filter(lambda p: id(p) not in head_params_id, self.model.parameters())
+        params_group = [
+                        {'params': block_params, 'lr': OCFG.lr_group[1]},
+                        {'params': self.model._fc.parameters(), 'lr': OCFG.lr_group[2]}
+        ]
+        return params_group
+
+
+class FeatureStoreDataModule(pl.LightningDataModule):
+    def __init__(self, train_store, valid_store, batch_size=DCFG.batch_size, num_workers=0):
+        super().__init__()
+        self.train = train_store
+        self.valid = valid_store
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+
+    def train_dataloader(self):
+        return DataLoader(self.train, batch_size=self.batch_size, num_workers=self.num_workers, shuffle=True)
+
+    def val_dataloader(self):
+        return DataLoader(self.valid, batch_size=self.batch_size, num_workers=self.num_workers)
+
+
+def _load_store_as_tensors(store, device):
+    return torch.from_numpy(np.asarray(store.features)).to(device), torch.from_numpy(np.asarray(store.labels, dtype=np.int64)).to(device)
+
+
+def sweep_head_lr(make_suffix, train_store, valid_store, lrs, max_epochs=5, batch_size=1024, device=DCFG.device):
+    """Plain torch loop over in-memory features, much faster than going through Lightning for small heads
+    Arguments:
+        make_suffix: function returning a freshly initialized head, eg. lambda: nn.Sequential(nn.Dropout(0.2), nn.Linear(1280, DCFG.class_num))
+        lrs: list of float, Adam learning rates to try
+    Returns:
+        list of dict {'lr', 'epoch', 'val_acc', 'val_loss', 'time'}
+    """
+    train_x, train_y = _load_store_as_tensors(train_store, device)
+    valid_x, valid_y = _load_store_as_tensors(valid_store, device)
+    criterion = nn.CrossEntropyLoss()
+    results = []
+    for lr in lrs:
+        suffix = make_suffix().to(device)
+        optimizer = torch.optim.Adam(suffix.parameters(), lr=lr, weight_decay=OCFG.weight_decay)
+        start = time.time()
+        for epoch in range(max_epochs):
+            suffix.train()
+            for batch_ids in torch.randperm(len(train_y), device=device).split(batch_size):
+                loss = criterion(suffix(train_x[batch_ids].float()), train_y[batch_ids])
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+            suffix.eval()
+            total_loss, total_corrects = 0.0, 0
+            with torch.no_grad():
+                for batch_ids in torch.arange(len(valid_y), device=device).split(batch_size):
+                    logits = suffix(valid_x[batch_ids].float())
+                    total_loss += criterion(logits, valid_y[batch_ids]).item()*len(batch_ids)
+                    total_corrects += (logits.argmax(dim=1) == valid_y[batch_ids]).sum().item()
+            results.append({'lr': lr, 'epoch': epoch, 'val_acc': total_corrects/len(valid_y), 'val_loss': total_loss/len(valid_y), 'time': time.time() - start})
+            print(results[-1])
+    return results
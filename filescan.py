@@ -0,0 +1,124 @@
+# filescan.py
+import os
+import re
+import time
+import pickle
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+LABEL_PATTERN = re.compile("[\u4e00-\u9fa5]{1}")
+
+
+def _get_label(file_name):
+    """Same rule as the old os.walk scan: the first chinese character, files marked 'modified' are skipped"""
+    re_result = LABEL_PATTERN.search(file_name)
+    if re_result and 'modified' not in file_name:
+        return re_result.group(0)
+    return None
+
+
+class ImageFolderScanner:
+    """Concurrent, incremental replacement of the os.walk scan in FileHandler._make_raw_df_once
+
+    Directories are listed with os.scandir by a thread pool (listing and stat release the GIL, so this scales
+    on slow network mounts). A persistent index keeps, per directory,
+        (dir mtime_ns, sub directory names, {file name: (mtime_ns, size, label)})
+    Later scans only run the label regex for added or changed files. If is_dir_mtime_trusted, a directory
+    whose mtime did not change is not listed again at all: adding, removing or renaming files always changes
+    the directory mtime, but rewriting a file in place does not, so pass False to also catch in-place changes.
+    """
+    def __init__(self, root_paths, index_path=None, num_workers=16, is_dir_mtime_trusted=True):
+        self.root_paths = [str(root_path) for root_path in root_paths]
+        self.index_path = Path(index_path) if index_path else None
+        self.num_workers = num_workers
+        self.is_dir_mtime_trusted = is_dir_mtime_trusted
+        self.index = self._load_index()
+        self.stats = {}
+
+    def _load_index(self):
+        if self.index_path and self.index_path.exists():
+            with open(self.index_path, 'rb') as in_file:
+                return pickle.load(in_file)
+        return {}
+
+    def _save_index(self):
+        if self.index_path:
+            self.index_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.index_path.with_suffix('.tmp')
+            with open(tmp_path, 'wb') as out_file:
+                pickle.dump(self.index, out_file, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.index_path)
+
+    def _scan_dir(self, dir_path):
+        """Returns (dir_path, index entry, number of files relabelled, is listing skipped)"""
+        old_entry = self.index.get(dir_path)
+        dir_mtime = os.stat(dir_path).st_mtime_ns
+        if self.is_dir_mtime_trusted and old_entry and old_entry[0] == dir_mtime:
+            return dir_path, old_entry, 0, True
+
+        old_files = old_entry[2] if old_entry else {}
+        sub_dirs, files, num_relabelled = [], {}, 0
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    sub_dirs.append(entry.name)
+                    continue
+                try:
+                    if entry.is_dir(): # symlinked directory, not followed (like os.walk), so no symlink cycle
+                        continue
+                    stat = entry.stat()
+                except OSError: # broken symlink
+                    continue
+                old_file = old_files.get(entry.name)
+                if old_file and old_file[0] == stat.st_mtime_ns and old_file[1] == stat.st_size:
+                    files[entry.name] = old_file
+                else:
+                    files[entry.name] = (stat.st_mtime_ns, stat.st_size, _get_label(entry.name))
+                    num_relabelled += 1
+        return dir_path, (dir_mtime, sub_dirs, files), num_relabelled, False
+
+    def scan(self):
+        """Walk every root path, update and save the index, returns the new index"""
+        start = time.time()
+        new_index = {}
+        num_relabelled, num_skipped = 0, 0
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            pending = {executor.submit(self._scan_dir, root_path) for root_path in self.root_paths if os.path.isdir(root_path)}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    dir_path, entry, dir_num_relabelled, is_skipped = future.result()
+                    new_index[dir_path] = entry
+                    num_relabelled += dir_num_relabelled
+                    num_skipped += is_skipped
+                    pending |= {executor.submit(self._scan_dir, os.path.join(dir_path, sub_dir)) for sub_dir in entry[1]}
+
+        old_files = {(dir_path, name) for dir_path, entry in self.index.items() for name in entry[2]}
+        new_files = {(dir_path, name) for dir_path, entry in new_index.items() for name in entry[2]}
+        self.stats = {
+            'directories': len(new_index),
+            'directories_not_listed': num_skipped,
+            'files': len(new_files),
+            'added': len(new_files - old_files),
+            'removed': len(old_files - new_files),
+            'relabelled': num_relabelled,
+            'time': time.time() - start,
+        }
+        print(f'scan done: {self.stats}')
+        self.index = new_index
+        self._save_index()
+        return new_index
+
+    def get_paths_and_labels(self):
+        """Labelled image paths sorted by path"""
+        rows = sorted(
+            (os.path.join(dir_path, name), file_info[2])
+            for dir_path, entry in self.index.items()
+            for name, file_info in entry[2].items() if file_info[2] is not None
+        )
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def get_df(self):
+        import pandas as pd
+        image_paths, labels = self.get_paths_and_labels()
+        return pd.DataFrame({'path': image_paths, 'label': labels})
@@ -10,10 +10,11 @@ from flask import jsonify
 
 import numpy as np
 import datetime
+import torch
 
 from utils.utils import int_label2word, save_image
-from utils.model import get_best_model
-from utils.preprocess import preprocess
+from utils.model import get_best_model, prepare_cpu_model, get_autocast, trace_model
+from utils.preprocess import preprocess, preprocess_tta
 
 app = Flask(__name__)
 
@@ -62,7 +63,12 @@ def predict(image):
 
     ####### PUT YOUR MODEL INFERENCING CODE HERE #######
     tensor = preprocess(image)
-    pred = model(tensor).argmax(axis=1).detach().numpy()
+    with torch.no_grad(), get_autocast(options.autocast_dtype):
+        logits = model(tensor).float()
+        # TTA only for the low-confidence images: all views in one batched forward, mean logits
+        if options.tta and torch.softmax(logits, dim=1).max() < options.tta_threshold:
+            logits = model(preprocess_tta(image)).float().mean(dim=0, keepdim=True)
+    pred = logits.argmax(axis=1).numpy()
     prediction = int_label2word(int(pred))
 
     ####################################################
@@ -125,10 +131,16 @@ if __name__ == "__main__":
     arg_parser.add_argument('-p', '--port', default=8080, help='port')
     arg_parser.add_argument('-d', '--debug', default=True, help='debug')
     arg_parser.add_argument('-m', '--model-name', default="efficientnet-b0", type=str, help='model_name')
+    arg_parser.add_argument('--channels-last', action='store_true', help='channels_last (NHWC) model weights')
+    arg_parser.add_argument('--autocast-dtype', default=None, choices=['bfloat16'], help='CPU autocast dtype, default float32')
+    arg_parser.add_argument('--trace', action='store_true', help='serve a frozen TorchScript graph of the model')
+    arg_parser.add_argument('--tta', action='store_true', help='test-time augmentation of the low-confidence images')
+    arg_parser.add_argument('--tta-threshold', default=0.8, type=float, help='images whose confidence is below get the TTA views')
     options = arg_parser.parse_args()
 
     model = get_best_model(options.model_name)  
-    model.eval()
-    model.cpu()
+    prepare_cpu_model(model, is_channels_last=options.channels_last)
+    if options.trace:
+        model = trace_model(model, is_channels_last=options.channels_last, autocast_dtype=options.autocast_dtype)
 
     app.run(host='0.0.0.0', debug=options.debug, port=options.port)
\ No newline at end of file
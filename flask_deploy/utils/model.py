@@ -4,6 +4,7 @@ from efficientnet_pytorch import EfficientNet
 import torch.nn as nn
 import pytorch_lightning as pl
 import os
+from contextlib import nullcontext
 
 CLASS_NUM = 801
 class EffClassifier(pl.LightningModule):
@@ -24,4 +25,28 @@ def get_best_model(model_name):
     
     raw_model = EfficientNet.from_pretrained(model_name)
     model = EffClassifier.load_from_checkpoint(best_model_ckpt_path, map_location='cpu', **{"raw_model": raw_model})
-    return model
\ No newline at end of file
+    return model
+
+def prepare_cpu_model(model, is_channels_last=False):
+    """eval mode on CPU, channels_last weights for the NHWC inputs of preprocess()"""
+    model.eval()
+    model.cpu()
+    if is_channels_last:
+        model.to(memory_format=torch.channels_last)
+    return model
+
+def get_autocast(autocast_dtype=None):
+    """CPU autocast context, eg. autocast_dtype 'bfloat16', a no-op for None"""
+    if autocast_dtype is None:
+        return nullcontext()
+    return torch.autocast('cpu', dtype=getattr(torch, autocast_dtype))
+
+def trace_model(model, is_channels_last=False, autocast_dtype=None, image_size=224):
+    """Frozen TorchScript graph traced once at startup on the single-image shape (the TTA batch of views runs on it too)"""
+    model.model.set_swish(memory_efficient=False) # the memory efficient swish can not be traced
+    example = torch.rand(1, 3, image_size, image_size)
+    if is_channels_last:
+        example = example.contiguous(memory_format=torch.channels_last)
+    with torch.no_grad(), get_autocast(autocast_dtype):
+        traced = torch.jit.trace(model.model, example)
+    return torch.jit.optimize_for_inference(torch.jit.freeze(traced.eval()))
@@ -25,5 +25,30 @@ def preprocess(image):
     dh_half, dw_half = _calculate_dhdw_half(h, w)
     image = cv2.copyMakeBorder(image, dh_half, dh_half, dw_half, dw_half, cv2.BORDER_REPLICATE)
     image = cv2.resize(image, (248, 248))[12:236, 12:236]
-    tensor = torch.tensor(image, dtype=torch.float)
-    return tensor.permute(2, 0, 1).div(255.0).unsqueeze(0)
\ No newline at end of file
+    # [1, C, H, W] view of the HWC image: NHWC (channels_last) in memory, no transpose copy
+    tensor = torch.from_numpy(np.ascontiguousarray(image)).unsqueeze(0).permute(0, 3, 1, 2)
+    return tensor.float().div_(255.0)
+
+# (border, resize size, rot90 k) of the TTA views, the first one is preprocess()
+TTA_VIEWS = [
+    (cv2.BORDER_REPLICATE, 248, 0),
+    (cv2.BORDER_REPLICATE, 248, 1),
+    (cv2.BORDER_REPLICATE, 248, 3),
+    (cv2.BORDER_WRAP, 248, 0),
+    (cv2.BORDER_REPLICATE, 272, 0),
+    (cv2.BORDER_REPLICATE, 232, 0),
+]
+
+def preprocess_tta(image, views=TTA_VIEWS):
+    """K views of one BGR image stacked as one batch [K, C, 224, 224] (NHWC in memory), see tta.py of the package"""
+    h, w, c = image.shape
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    dh_half, dw_half = _calculate_dhdw_half(h, w)
+    crops = []
+    for border, size, k in views:
+        padded = cv2.copyMakeBorder(image, dh_half, dh_half, dw_half, dw_half, border)
+        y1 = (size - 224)//2
+        crop = cv2.resize(padded, (size, size))[y1:y1+224, y1:y1+224]
+        crops.append(np.rot90(crop, k))
+    tensor = torch.from_numpy(np.ascontiguousarray(np.stack(crops))).permute(0, 3, 1, 2)
+    return tensor.float().div_(255.0)
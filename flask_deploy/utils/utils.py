@@ -1,8 +1,15 @@
-import os 
+import os
+from functools import lru_cache
 import cv2
 import numpy as np
 
-def _get_word_classes_dict(training_data_dict_path="/home/luhsuanwen/project/flask_deploy/training data dict.txt"):
+# the label file is next to server.py, or set WORD_CLASSES_PATH
+TRAINING_DATA_DICT_PATH = os.environ.get(
+    "WORD_CLASSES_PATH",
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "training data dict.txt")
+)
+
+def _get_word_classes_dict(training_data_dict_path=TRAINING_DATA_DICT_PATH):
     assert os.path.exists(training_data_dict_path), 'file does not exists'
 
     with open(training_data_dict_path, 'r') as file:
@@ -11,6 +18,11 @@ def _get_word_classes_dict(training_data_dict_path="/home/luhsuanwen/project/fla
     word_classes.append('isnull')
     return word_classes
 
+@lru_cache(maxsize=None)
+def get_word_classes():
+    """Read on the first call, not when the server imports this module"""
+    return _get_word_classes_dict()
+
 def save_image(image, ts):
     folder = "test_data_saved"
     cv2.imwrite(os.path.join(folder, ts+".jpg"), image)
@@ -18,17 +30,11 @@ def save_image(image, ts):
 # data functions
 def word2int_label(label):
     """Transform word classes into integer labels (0~800)"""
-    word2int_label_dict = dict(zip(word_classes, range(len(word_classes))))
-    return word2int_label_dict[label]
+    word_classes = get_word_classes()
+    return dict(zip(word_classes, range(len(word_classes))))[label]
 
 def int_label2word(int_label):
     """Transform integer labels into word classes"""
     if isinstance(int_label, str):
         int_label = int(int_label)
-    int_label2word_dict = dict(zip(range(len(word_classes)), word_classes))
-    return int_label2word_dict[int_label]
-
-
-
-
-word_classes = _get_word_classes_dict()
\ No newline at end of file
+    return get_word_classes()[int_label]
@@ -0,0 +1,361 @@
+# label_noise.py
+import os
+import csv
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from .config import DCFG
+from .manifest import Manifest, PathIndex
+from .precision import is_channels_last, channels_last_collate
+from .evaluate import ManifestImageDataset, _init_decode_worker, _get_default_workers
+
+"""
+Label noise detection from the embeddings of a trained classifier, a ranked review list instead of the hand-made
+df_revised.csv / df_checked.csv passes.
+
+    store = extract_embeddings(model, manifest, folder, key)   # one batched pass, memory-mapped EmbeddingStore
+    scores = score_label_noise(store)                          # centroids + k-NN label agreement, whole corpus
+    write_review_list(store, scores, 'review.csv', checked_paths=...)
+
+Embeddings: the input of the final linear layer (EfficientNet _fc: pooled features, [N, 1280] for b0), captured
+by a forward hook while the model also gives its own prediction. Every unique path is embedded once (the oversampled
+rows of a manifest would be their own nearest neighbors).
+
+Scores of a sample with label y (embeddings L2 normalized, PCA reduced to dim, L2 normalized again):
+    centroid_margin: cos(x, centroid y) - max cos(x, other centroid), negative when another class is closer
+    knn_agreement:   similarity weighted share of the k nearest neighbors (self excluded) labeled y
+    knn_pred:        similarity weighted majority label of the neighbors, the suggested label
+A sample is a suspect when knn_agreement < agreement_threshold and knn_pred != y. Suspects are ranked by the number
+of other signals agreeing with knn_pred (nearest centroid, model prediction), then by knn_agreement and centroid_margin.
+Reasons: 'isnull' (the neighbors are isnull images), 'not_null' (an isnull image among real classes), 'relabel'.
+
+Cost: the k-NN runs as blocked matrix products [block, dim] @ [dim, N] + topk, about N^2*dim multiply-adds
+(300k images at dim 128: a few minutes on a multi-core CPU), memory stays at block*N floats.
+
+EmbeddingStore folder layout:
+    meta.json:       {'key', 'manifest', 'num_samples', 'fingerprint', 'dim'}, fingerprint: Manifest.fingerprint
+    embeddings.npy:  float16, [N, dim]
+    labels.npy:      int16, [N]
+    preds.npy:       int16, [N], model top-1
+    label_probs.npy: float16, [N], model probability of the label
+    rows.npy:        int64, [N], manifest row of every sample (first row of every unique path)
+"""
+
+NULL_LABEL = DCFG.class_num - 1 # 'isnull', the last word class
+EMBEDDING_FOLDER_NAME = 'embeddings'
+REVIEW_LIST_NAME = 'label_noise_review.csv'
+
+# --------------------------
+# Embeddings
+# --------------------------
+def get_head(model):
+    """Final linear layer of a classifier (EfficientNet _fc, ResNet fc, torchvision students classifier.3...), searched in
+    the raw model of a Lightning classifier, so the teacher of a DistillClassifier is excluded
+    """
+    from .model import _get_head_name
+    raw_model = getattr(model, 'model', model)
+    head_name = getattr(model, 'head_name', None) or _get_head_name(raw_model) # DistillClassifier.head_name
+    return raw_model.get_submodule(head_name)
+
+
+def get_unique_rows(manifest):
+    """First manifest row of every unique path"""
+    _, rows = np.unique(np.asarray(manifest.path_ids), return_index=True)
+    return np.sort(rows)
+
+
+class EmbeddingStore:
+    """Memory-mapped embeddings of the unique paths of a manifest, see module docstring for the layout"""
+    NAMES = ('embeddings', 'labels', 'preds', 'label_probs', 'rows')
+    def __init__(self, folder, mmap_mode='r'):
+        self.folder = Path(folder)
+        with open(self.folder / 'meta.json') as in_file:
+            self.meta = json.load(in_file)
+        for name in self.NAMES:
+            setattr(self, name, np.load(self.folder / f'{name}.npy', mmap_mode=mmap_mode))
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def is_valid(folder, meta):
+        meta_path = Path(folder) / 'meta.json'
+        if not meta_path.exists():
+            return False
+        with open(meta_path) as in_file:
+            stored_meta = json.load(in_file)
+        return all(stored_meta.get(name) == value for name, value in meta.items())
+
+
+@torch.no_grad()
+def extract_embeddings(model, manifest, folder, key, batch_size=None, num_workers=None, num_threads=None, device='cpu', transform=None, is_refreshed=False):
+    """Penultimate embeddings of every unique path of manifest in one pass, written to an EmbeddingStore
+    Arguments:
+        model: eval classifier, eg. evaluate.load_eval_model(ckpt_path) (not a TorchScript artifact, the head is hooked)
+        key: str identifying the model, eg. checkpoint path@mtime, the store is reused when key and manifest match
+        batch_size, num_workers, num_threads, transform: see evaluate.Evaluator
+    """
+    manifest_path = None if isinstance(manifest, Manifest) else str(manifest)
+    manifest = manifest if isinstance(manifest, Manifest) else Manifest.load(manifest)
+    folder = Path(folder)
+    rows = get_unique_rows(manifest)
+    meta = {'key': str(key), 'manifest': manifest_path, 'num_samples': len(rows), 'fingerprint': manifest.fingerprint()}
+    if not is_refreshed and EmbeddingStore.is_valid(folder, meta):
+        print(f"embeddings loaded from {folder}")
+        return EmbeddingStore(folder)
+
+    default_workers, default_threads = _get_default_workers()
+    num_workers = default_workers if num_workers is None else num_workers
+    loader = DataLoader(
+        ManifestImageDataset(manifest.subset(rows), transform),
+        batch_size=batch_size or DCFG.batch_size,
+        num_workers=num_workers,
+        collate_fn=channels_last_collate if is_channels_last() else None,
+        worker_init_fn=_init_decode_worker,
+        prefetch_factor=4 if num_workers else None,
+        shuffle=False,
+    )
+    head = get_head(model)
+    captured = {}
+    handle = head.register_forward_hook(lambda module, inputs, output: captured.__setitem__('x', inputs[0]))
+
+    folder.mkdir(parents=True, exist_ok=True)
+    if (folder / 'meta.json').exists():
+        (folder / 'meta.json').unlink()
+    labels = np.asarray(manifest.labels[rows], dtype=np.int16)
+    embeddings = np.lib.format.open_memmap(folder / 'embeddings.npy', mode='w+', dtype=np.float16, shape=(len(rows), head.in_features))
+    preds = np.zeros(len(rows), dtype=np.int16)
+    label_probs = np.zeros(len(rows), dtype=np.float16)
+    labels_t = torch.from_numpy(labels.astype(np.int64))
+    previous_threads = torch.get_num_threads()
+    torch.set_num_threads(num_threads or default_threads)
+    start = time.perf_counter()
+    try:
+        for x, ids in loader:
+            probs = torch.softmax(model(x.float().to(device)).float(), dim=1).cpu()
+            embeddings[ids.numpy()] = captured['x'].float().flatten(1).cpu().numpy()
+            preds[ids.numpy()] = probs.argmax(dim=1).numpy()
+            label_probs[ids.numpy()] = probs.gather(1, labels_t[ids].unsqueeze(1)).squeeze(1).numpy()
+    finally:
+        handle.remove()
+        torch.set_num_threads(previous_threads)
+    embeddings.flush()
+    for name, value in (('labels', labels), ('preds', preds), ('label_probs', label_probs), ('rows', rows.astype(np.int64))):
+        np.save(folder / f'{name}.npy', value)
+    meta['dim'] = head.in_features
+    with open(folder / 'meta.json', 'w') as out_file: # written last, marks a complete store
+        json.dump(meta, out_file)
+    elapsed = time.perf_counter() - start
+    print(f"embeddings [{len(rows)}, {head.in_features}] extracted in {elapsed:.1f}s ({len(rows)/max(elapsed, 1e-9):.1f} images/s), saved to {folder}")
+    return EmbeddingStore(folder)
+
+# --------------------------
+# Scores
+# --------------------------
+def _normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def reduce_embeddings(embeddings, dim=128, num_fit_samples=50000, block_size=65536, seed=0):
+    """L2 normalized, PCA projected (fitted on num_fit_samples rows) and L2 normalized again embeddings, float32 [N, dim]
+    dim None (or >= the embedding size): no projection
+    """
+    num_samples, num_features = embeddings.shape
+    rng = np.random.default_rng(seed)
+    projection = None
+    if dim and dim < num_features:
+        fit_rows = np.sort(rng.choice(num_samples, min(num_samples, num_fit_samples), replace=False))
+        fit_x = _normalize(np.asarray(embeddings[fit_rows], dtype=np.float32))
+        mean = fit_x.mean(axis=0)
+        fit_x -= mean
+        _, eigenvectors = np.linalg.eigh(fit_x.T @ fit_x) # [D, D] covariance, much cheaper than the svd of fit_x
+        projection = (mean, np.ascontiguousarray(eigenvectors[:, ::-1][:, :dim]))
+    reduced = np.empty((num_samples, dim if projection else num_features), dtype=np.float32)
+    for start in range(0, num_samples, block_size):
+        x = _normalize(np.asarray(embeddings[start:start + block_size], dtype=np.float32))
+        if projection:
+            x = (x - projection[0]) @ projection[1]
+        reduced[start:start + block_size] = _normalize(x)
+    return reduced
+
+
+def get_class_centroids(x, labels, class_num=DCFG.class_num):
+    """L2 normalized mean embedding of every class, zeros for the classes without samples"""
+    sums = torch.zeros(class_num, x.shape[1]).index_add_(0, torch.from_numpy(np.asarray(labels, dtype=np.int64)), torch.from_numpy(x))
+    return _normalize(sums.numpy())
+
+
+def _get_block_size(num_columns, max_block_bytes):
+    return max(1, int(max_block_bytes // (4*max(1, num_columns))))
+
+
+def score_centroids(x, labels, centroids, max_block_bytes=2**28):
+    """centroid_margin [N] and centroid_pred [N] (nearest centroid), see module docstring"""
+    x_t, centroids_t = torch.from_numpy(x), torch.from_numpy(centroids)
+    labels_t = torch.from_numpy(np.asarray(labels, dtype=np.int64))
+    margins = np.empty(len(x), dtype=np.float32)
+    preds = np.empty(len(x), dtype=np.int64)
+    block_size = _get_block_size(len(centroids), max_block_bytes)
+    for start in range(0, len(x), block_size):
+        sims = x_t[start:start + block_size] @ centroids_t.T
+        block_labels = labels_t[start:start + block_size].unsqueeze(1)
+        own_sims = sims.gather(1, block_labels).squeeze(1)
+        other_sims = sims.scatter(1, block_labels, float('-inf')).max(dim=1).values
+        margins[start:start + block_size] = (own_sims - other_sims).numpy()
+        preds[start:start + block_size] = sims.argmax(dim=1).numpy()
+    return margins, preds
+
+
+def score_knn(x, labels, k=10, class_num=DCFG.class_num, max_block_bytes=2**28):
+    """Blocked exact k-NN over the whole corpus (self excluded)
+    Returns:
+        knn_agreement [N], knn_pred [N] and knn_pred_share [N] (weighted share of the suggested label)
+    """
+    num_samples = len(x)
+    k = min(k, num_samples - 1)
+    assert k > 0, "at least 2 samples are needed"
+    x_t = torch.from_numpy(x)
+    labels_t = torch.from_numpy(np.asarray(labels, dtype=np.int64))
+    agreement = np.empty(num_samples, dtype=np.float32)
+    knn_preds = np.empty(num_samples, dtype=np.int64)
+    pred_shares = np.empty(num_samples, dtype=np.float32)
+    block_size = _get_block_size(num_samples, max_block_bytes)
+    for start in range(0, num_samples, block_size):
+        end = min(start + block_size, num_samples)
+        sims = x_t[start:end] @ x_t.T
+        block_ids = torch.arange(end - start)
+        sims[block_ids, block_ids + start] = float('-inf')
+        values, ids = sims.topk(k, dim=1)
+        votes = torch.zeros(end - start, class_num).scatter_add_(1, labels_t[ids], values.clamp(min=0) + 1e-6)
+        total_votes = votes.sum(dim=1)
+        agreement[start:end] = (votes.gather(1, labels_t[start:end].unsqueeze(1)).squeeze(1)/total_votes).numpy()
+        pred_votes, preds = votes.max(dim=1)
+        knn_preds[start:end] = preds.numpy()
+        pred_shares[start:end] = (pred_votes/total_votes).numpy()
+    return agreement, knn_preds, pred_shares
+
+
+def score_label_noise(store, k=10, dim=128, agreement_threshold=0.3, class_num=DCFG.class_num, max_block_bytes=2**28):
+    """Centroid and k-NN scores of every sample of an EmbeddingStore, see module docstring
+    Returns:
+        dict of [N] arrays: centroid_margin, centroid_pred, knn_agreement, knn_pred, knn_pred_share, is_suspect,
+        num_agreeing_signals (nearest centroid and model prediction equal to knn_pred) and rank (suspects first, 0 is
+        the most likely label error)
+    """
+    timings = {}
+    def timed(stage, func):
+        start = time.perf_counter()
+        output = func()
+        timings[stage] = time.perf_counter() - start
+        print(f'- {stage}: {timings[stage]:.2f}s')
+        return output
+
+    labels = np.asarray(store.labels, dtype=np.int64)
+    x = timed('reduce', lambda: reduce_embeddings(store.embeddings, dim))
+    centroids = timed('centroids', lambda: get_class_centroids(x, labels, class_num))
+    centroid_margin, centroid_pred = timed('centroid scores', lambda: score_centroids(x, labels, centroids, max_block_bytes))
+    knn_agreement, knn_pred, knn_pred_share = timed('knn scores', lambda: score_knn(x, labels, k, class_num, max_block_bytes))
+
+    is_suspect = (knn_agreement < agreement_threshold) & (knn_pred != labels)
+    num_agreeing_signals = (centroid_pred == knn_pred).astype(np.int64) + (np.asarray(store.preds) == knn_pred)
+    order = np.lexsort((centroid_margin, knn_agreement, -num_agreeing_signals, ~is_suspect))
+    rank = np.empty(len(labels), dtype=np.int64)
+    rank[order] = np.arange(len(labels))
+    print(f"{int(is_suspect.sum())} suspects out of {len(labels)} samples ({is_suspect.mean():.2%}), "
+          f"knn: k={k}, dim={x.shape[1]}, total time: {sum(timings.values()):.1f}s")
+    return {
+        'centroid_margin': centroid_margin,
+        'centroid_pred': centroid_pred,
+        'knn_agreement': knn_agreement,
+        'knn_pred': knn_pred,
+        'knn_pred_share': knn_pred_share,
+        'is_suspect': is_suspect,
+        'num_agreeing_signals': num_agreeing_signals,
+        'rank': rank,
+    }
+
+
+def get_reasons(labels, suggested_labels):
+    """'isnull' (suggested isnull), 'not_null' (labeled isnull) or 'relabel' of every sample"""
+    labels, suggested_labels = np.asarray(labels), np.asarray(suggested_labels)
+    return np.where(suggested_labels == NULL_LABEL, 'isnull', np.where(labels == NULL_LABEL, 'not_null', 'relabel'))
+
+# --------------------------
+# Review list
+# --------------------------
+def load_checked_paths(csv_path):
+    """PathIndex of the path column of a hand checked csv (eg. df_checked.csv)"""
+    import pandas as pd
+    return PathIndex(pd.read_csv(csv_path, usecols=['path'])['path'])
+
+
+def write_review_list(store, scores, output_path, manifest=None, checked_paths=None, max_rows=None):
+    """Suspects of score_label_noise, most likely label errors first, written as a csv
+    Arguments:
+        manifest: Manifest of the store (default: loaded from the store meta)
+        checked_paths: PathIndex of already reviewed paths (see load_checked_paths), left out of the list
+        max_rows: int, only the top max_rows suspects
+    Returns:
+        dict summary
+    """
+    from .utils import int_label2word
+    manifest = manifest or Manifest.load(store.meta['manifest'])
+    suspect_ids = np.flatnonzero(scores['is_suspect'])
+    suspect_ids = suspect_ids[np.argsort(scores['rank'][suspect_ids])]
+    path_table = manifest.path_table
+    path_ids = np.asarray(manifest.path_ids)[np.asarray(store.rows)[suspect_ids]]
+    paths = [path_table[path_id] for path_id in path_ids.tolist()]
+    if checked_paths is not None:
+        is_unchecked = ~checked_paths.contains(paths)
+        suspect_ids, paths = suspect_ids[is_unchecked], [path for path, is_kept in zip(paths, is_unchecked) if is_kept]
+    if max_rows:
+        suspect_ids, paths = suspect_ids[:max_rows], paths[:max_rows]
+
+    labels = np.asarray(store.labels, dtype=np.int64)[suspect_ids]
+    suggested_labels = scores['knn_pred'][suspect_ids]
+    reasons = get_reasons(labels, suggested_labels)
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w', newline='', encoding='utf-8') as out_file:
+        writer = csv.writer(out_file)
+        writer.writerow([
+            'rank', 'path', 'int_label', 'label', 'suggested_int_label', 'suggested_label', 'reason', 'knn_agreement',
+            'knn_pred_share', 'centroid_margin', 'centroid_pred', 'model_pred', 'model_label_prob', 'num_agreeing_signals'
+        ])
+        for i, (sample_id, path) in enumerate(zip(suspect_ids.tolist(), paths)):
+            label, suggested_label = int(labels[i]), int(suggested_labels[i])
+            writer.writerow([
+                i, path, label, int_label2word(label), suggested_label, int_label2word(suggested_label), reasons[i],
+                f"{scores['knn_agreement'][sample_id]:.4f}", f"{scores['knn_pred_share'][sample_id]:.4f}",
+                f"{scores['centroid_margin'][sample_id]:.4f}", int(scores['centroid_pred'][sample_id]),
+                int(store.preds[sample_id]), f"{float(store.label_probs[sample_id]):.4f}",
+                int(scores['num_agreeing_signals'][sample_id]),
+            ])
+    summary = {
+        'num_samples': len(store),
+        'num_suspects': int(scores['is_suspect'].sum()),
+        'num_listed': len(suspect_ids),
+        **{f'num_{reason}': int((reasons == reason).sum()) for reason in ('relabel', 'isnull', 'not_null')},
+    }
+    print(summary)
+    return summary
+
+
+def detect_label_noise(args):
+    """main.py -s label_noise -c checkpoint -i manifest [--report-folder folder]: embeddings, scores and the review list
+    in report_folder (default: next to the checkpoint, noise_{manifest name}), df_checked.csv paths left out if it exists
+    """
+    from .utils import ROOT
+    from .evaluate import load_eval_model
+    ckpt_path, manifest_path = Path(args.checkpoint_path), Path(args.input_path)
+    report_folder = Path(getattr(args, 'report_folder', None) or ckpt_path.parent / f"noise_{manifest_path.stem}")
+    model = load_eval_model(ckpt_path, raw_model_type=args.model_type)
+    store = extract_embeddings(model, manifest_path, report_folder / EMBEDDING_FOLDER_NAME, key=f"{ckpt_path.resolve()}@{ckpt_path.stat().st_mtime}")
+    scores = score_label_noise(store)
+    checked_csv_path = Path(ROOT) / 'df_checked.csv'
+    checked_paths = load_checked_paths(checked_csv_path) if checked_csv_path.exists() else None
+    return write_review_list(store, scores, report_folder / REVIEW_LIST_NAME, checked_paths=checked_paths)
@@ -1,7 +1,3 @@
-# running on colab
-from google.colab import drive
-drive.mount('/content/gdrive')
-
 import os
 import random
 import numpy as np
@@ -9,6 +5,17 @@ import torch
 from argparse import ArgumentParser
 from train import train
 from predict import predict
+from evaluate import evaluate
+from pseudo_label import generate_pseudo_labels
+from label_noise import detect_label_noise
+
+def mount_drive_on_colab():
+    """Mount Google Drive when running on colab (the default ROOT, see utils.ROOT), nothing elsewhere"""
+    try:
+        from google.colab import drive
+    except ImportError:
+        return
+    drive.mount('/content/gdrive')
 
 def seed_torch(seed=1029):
     random.seed(seed)
@@ -26,26 +33,45 @@ def make_parser():
     parser = ArgumentParser(
         description="Usage: python3 main.py -s stage [-i image_path] [-m model_type] [-c checkpoint_path] [-t target_metric]\n if u want to train model please modify config.py first")
     parser.add_argument(
-        '--stage', '-s', type=str, default='train', required=True, choices=["train", "predict"]
-        help='train or eval stage')
+        '--stage', '-s', type=str, default='train', required=True, choices=["train", "predict", "evaluate", "pseudo_label", "label_noise"],
+        help='train, predict, evaluate (checkpoint / TorchScript artifact on a manifest, see evaluate.py) or pseudo_label '
+             '(next noisy student iteration from the -c teacher, default NS.teacher_ckpt_path, see pseudo_label.py) or label_noise '
+             '(ranked review list of the suspected label errors of the -i manifest, see label_noise.py) stage')
     parser.add_argument(
         '--input-path', '-i', type=str, default='',
-        help='/path/to/ur/image/or/image/folder')
+        help='/path/to/ur/image/or/image/folder, or /path/to/the.manifest to evaluate')
     parser.add_argument(
-        '--model-type', '-m', type=str, default='effcientnet',
-        help='model type use for predicting, eg. efficientnet or noisy_student or resnet')
+        '--model-type', '-m', type=str, default=None,
+        help='model type use for predicting, eg. effb0 or noisy_student_b0 or resnet, default: the type saved in the '
+             'checkpoint (evaluate, label_noise) or MCFG.model_type')
     parser.add_argument(
         '--checkpoint-path', '-c', type=str, default='',
         help='/path/to/ur/checkpoint/file/path')
     parser.add_argument(
-        '--target-metric', '-t', type=str, default='val_loss', choices=["val_loss", "val_acc"]
+        '--target-metric', '-t', type=str, default='val_loss', choices=["val_loss", "val_acc"],
         help='target metrics used for evaluating the best model')
+    parser.add_argument(
+        '--compile-backend', type=str, default=None, choices=["eager", "trace", "compile"],
+        help='predict with a traced / torch.compile graph, see compiled.py')
+    parser.add_argument(
+        '--report-folder', type=str, default=None,
+        help='evaluation / label noise reports and cached predictions / embeddings, default: next to the checkpoint')
+    parser.add_argument(
+        '--tta', action='store_true',
+        help='test-time augmentation, rotated / wrap border / rescaled views of the low-confidence images, see tta.py')
+    parser.add_argument(
+        '--tta-threshold', type=float, default=0.8,
+        help='only images whose confidence is below get the TTA views, 1.0: every image')
+    parser.add_argument(
+        '--tta-max-fraction', type=float, default=None,
+        help='at most this fraction of every batch gets the TTA views (least confident first)')
     
     
 
     return parser
 
 if __name__ == '__main__':
+    mount_drive_on_colab()
     seed_torch()
     parser = make_parser()
     args = parser.parse_args()
@@ -54,3 +80,9 @@ if __name__ == '__main__':
         model, trainer, data_module = train()
     elif args.stage == "predict":
         predict(args)
+    elif args.stage == "evaluate":
+        evaluate(args)
+    elif args.stage == "pseudo_label":
+        generate_pseudo_labels(teacher_ckpt_path=args.checkpoint_path or None)
+    elif args.stage == "label_noise":
+        detect_label_noise(args)
@@ -0,0 +1,469 @@
+# manifest.py
+import os
+import time
+import hashlib
+from collections.abc import Sequence
+from pathlib import Path
+import numpy as np
+
+"""
+Columnar manifest replacing the "path label" txt files and the path/int_label csv files.
+
+A manifest is a folder holding one .npy file per column, so every column can be memory-mapped:
+    path_blob:    uint8, utf-8 bytes of all unique paths joined by '\\n' (the interned path table)
+    path_offsets: int64, start offset of every unique path in path_blob (every path counts one separator byte)
+    path_ids:     int32, row -> index into the path table (oversampled rows share one entry)
+    labels:       int16, row -> int label
+"""
+
+MANIFEST_SUFFIX = '.manifest'
+PATH_SEP = '\n'
+COLUMNS = ['path_blob', 'path_offsets', 'path_ids', 'labels']
+
+
+class Manifest:
+    """Compact path/label table, see module docstring for the on-disk layout"""
+    __slots__ = ['path_blob', 'path_offsets', 'path_ids', 'labels', '_path_table']
+    def __init__(self, path_blob, path_offsets, path_ids, labels):
+        assert len(path_ids) == len(labels), 'path_ids and labels should have the same length'
+        self.path_blob = path_blob
+        self.path_offsets = path_offsets
+        self.path_ids = path_ids
+        self.labels = labels
+        self._path_table = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    @property
+    def num_unique_paths(self):
+        return len(self.path_offsets) - 1
+
+    @property
+    def path_table(self):
+        """All unique paths, decoded once and cached"""
+        if self._path_table is None:
+            self._path_table = bytes(self.path_blob).decode('utf-8').split(PATH_SEP) if self.num_unique_paths else []
+        return self._path_table
+
+    def get_unique_path(self, path_id):
+        """Decode a single path without decoding the whole path table"""
+        if self._path_table is not None:
+            return self._path_table[path_id]
+        start, end = self.path_offsets[path_id], self.path_offsets[path_id+1] - 1 # drop the separator
+        return bytes(self.path_blob[start:end]).decode('utf-8')
+
+    def path(self, index):
+        return self.get_unique_path(int(self.path_ids[index]))
+
+    @property
+    def paths(self):
+        path_table = self.path_table
+        return [path_table[path_id] for path_id in self.path_ids.tolist()]
+
+    def to_paths_and_labels(self):
+        """Same outputs as FileHandler.read_path_and_label_from_txt: (paths, labels) as (Sequence[str], list[int]),
+        the paths are a lazy ManifestPaths view, nothing is decoded until a path is read
+        """
+        return ManifestPaths(self), self.labels.tolist()
+
+    def fingerprint(self):
+        """Hash of the columns, changes when a row path or label changes (the caches keyed on a manifest use it)"""
+        s = hashlib.sha1()
+        for name in COLUMNS:
+            s.update(np.ascontiguousarray(getattr(self, name)).tobytes())
+        return s.hexdigest()
+
+    def subset(self, indices):
+        """Rows selected by indices, sharing the same path table"""
+        manifest = type(self)(self.path_blob, self.path_offsets, np.asarray(self.path_ids[indices], dtype=np.int32), np.asarray(self.labels[indices], dtype=np.int16))
+        manifest._path_table = self._path_table
+        return manifest
+
+    # --------------------
+    #  Building
+    # --------------------
+    @classmethod
+    def from_paths_and_labels(cls, paths, labels):
+        path2id = {}
+        path_ids = np.fromiter((path2id.setdefault(path, len(path2id)) for path in paths), dtype=np.int32)
+        labels = np.asarray(labels).astype(np.int16)
+        assert len(path_ids) == len(labels), f'unmatched numbers of paths and labels: {len(path_ids)}, {len(labels)}'
+
+        unique_paths = list(path2id.keys())
+        assert not any(PATH_SEP in path for path in unique_paths), 'paths should not contain line breaks'
+        encoded_lengths = np.fromiter((len(path.encode('utf-8')) + 1 for path in unique_paths), dtype=np.int64, count=len(unique_paths))
+        path_offsets = np.zeros(len(unique_paths) + 1, dtype=np.int64)
+        np.cumsum(encoded_lengths, out=path_offsets[1:])
+        path_blob = np.frombuffer(PATH_SEP.join(unique_paths).encode('utf-8'), dtype=np.uint8)
+
+        manifest = cls(path_blob, path_offsets, path_ids, labels)
+        manifest._path_table = unique_paths
+        return manifest
+
+    @classmethod
+    def concat(cls, manifests):
+        paths, labels = [], []
+        for manifest in manifests:
+            manifest_paths, manifest_labels = manifest.to_paths_and_labels()
+            paths += manifest_paths
+            labels += manifest_labels
+        return cls.from_paths_and_labels(paths, labels)
+
+    # --------------------
+    #  Saving / Loading
+    # --------------------
+    def save(self, folder):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        for name in COLUMNS:
+            np.save(folder / f'{name}.npy', np.ascontiguousarray(getattr(self, name)))
+
+    @classmethod
+    def load(cls, folder, mmap_mode='r'):
+        """Load a manifest folder, the columns are memory-mapped unless mmap_mode=None"""
+        folder = Path(folder)
+        assert folder.exists(), f'manifest {folder} does not exist'
+        columns = [np.load(folder / f'{name}.npy', mmap_mode=mmap_mode) for name in COLUMNS]
+        return cls(*columns)
+
+    # --------------------
+    #  Converters
+    # --------------------
+    @classmethod
+    def from_txt(cls, txt_path):
+        """Read the legacy "path label" txt files, the label is taken after the last space so paths may contain spaces"""
+        with open(txt_path, encoding='utf-8') as in_file:
+            lines = in_file.read().splitlines()
+        rows = [line.rpartition(' ') for line in lines if line]
+        paths = [row[0] for row in rows]
+        labels = np.array([row[2] for row in rows]).astype(np.int16) if rows else np.zeros(0, dtype=np.int16)
+        return cls.from_paths_and_labels(paths, labels)
+
+    def to_txt(self, txt_path):
+        with open(txt_path, 'w', encoding='utf-8') as out_file:
+            out_file.writelines(f'{path} {label}\n' for path, label in zip(self.paths, self.labels.tolist()))
+
+    @classmethod
+    def from_csv(cls, csv_path, path_column='path', label_column='int_label'):
+        import pandas as pd
+        df = pd.read_csv(csv_path, usecols=[path_column, label_column])
+        return cls.from_paths_and_labels(df[path_column].to_list(), df[label_column].to_numpy())
+
+    def to_csv(self, csv_path, path_column='path', label_column='int_label'):
+        import pandas as pd
+        pd.DataFrame({path_column: self.paths, label_column: self.labels}).to_csv(csv_path, index=False)
+
+
+class ManifestPaths(Sequence):
+    """Read-only view of the row paths of a manifest: indexing decodes a single path, iterating decodes the path
+    table once, slicing gives a view of the subset. Concatenation (+) with a list or another view gives a list.
+    """
+    __slots__ = ['manifest']
+    def __init__(self, manifest):
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ManifestPaths(self.manifest.subset(index))
+        return self.manifest.path(index)
+
+    def __iter__(self):
+        path_table = self.manifest.path_table
+        return (path_table[path_id] for path_id in self.manifest.path_ids.tolist())
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+
+def get_paths_fingerprint(paths, labels=None):
+    """Hash of a path list (and labels), for the caches keyed on the paths they were computed from.
+    A ManifestPaths view is hashed through its manifest columns, without decoding the paths
+    """
+    s = hashlib.sha1()
+    if isinstance(paths, ManifestPaths):
+        s.update(paths.manifest.fingerprint().encode('utf-8'))
+    else:
+        for path in paths:
+            s.update(path.encode('utf-8'))
+            s.update(PATH_SEP.encode('utf-8'))
+    if labels is not None:
+        s.update(np.asarray(labels, dtype=np.int64).tobytes())
+    return s.hexdigest()
+
+
+def get_manifest_path(file_path):
+    """/path/to/train_images.txt -> /path/to/train_images.manifest"""
+    return Path(file_path).with_suffix(MANIFEST_SUFFIX)
+
+
+def load_manifest_if_existing(file_path, mmap_mode='r'):
+    """Return the manifest next to a txt/csv file, or None if it has not been converted yet"""
+    manifest_path = get_manifest_path(file_path)
+    return Manifest.load(manifest_path, mmap_mode=mmap_mode) if manifest_path.exists() else None
+
+
+def convert_to_manifest(file_path, **kwargs):
+    """Convert a legacy txt or csv file into a manifest saved next to it"""
+    file_path = Path(file_path)
+    start = time.time()
+    if file_path.suffix == '.csv':
+        manifest = Manifest.from_csv(file_path, **kwargs)
+    else:
+        manifest = Manifest.from_txt(file_path)
+    manifest_path = get_manifest_path(file_path)
+    manifest.save(manifest_path)
+    print(f'{file_path.name} -> {manifest_path.name}, rows: {len(manifest)}, unique paths: {manifest.num_unique_paths}, time: {time.time() - start:.3f}s')
+    return manifest_path
+
+
+def convert_folder_to_manifests(folder, suffixes=('.txt',)):
+    """Convert every legacy file in a folder, eg. ROOT/data_txt"""
+    return [convert_to_manifest(os.path.join(folder, name)) for name in sorted(os.listdir(folder)) if name.endswith(suffixes)]
+
+
+# --------------------------
+# Building manifests from csv
+# --------------------------
+class PathIndex:
+    """Hashed set of paths, the hash table is built once and reused for every chunk"""
+    __slots__ = ['index']
+    def __init__(self, paths=()):
+        import pandas as pd
+        self.index = pd.Index(pd.unique(pd.Series(list(paths), dtype=object)))
+
+    def __len__(self):
+        return len(self.index)
+
+    def contains(self, paths):
+        """Vectorized membership test, returns a bool array"""
+        if len(self.index) == 0:
+            return np.zeros(len(paths), dtype=bool)
+        return self.index.get_indexer(paths) >= 0
+
+    def union(self, other):
+        path_index = PathIndex()
+        path_index.index = self.index.append(other.index).unique()
+        return path_index
+
+
+class StreamingGroupSampler:
+    """Per-label streaming replacement for df.groupby(label).sample(k, ...)
+
+    Chunks are merged into a fixed-size sample per label so the full csv never has to be kept in memory.
+    Arguments:
+        k: int, sample size per label
+        replace: bool, sample with replacement (like groupby().sample(k, replace=True))
+        is_oversampled: bool, only used when replace=False, labels with fewer than k rows are tiled first
+                        like FileHandler._average_copy_grouped_df_func used to do, so every label ends up with k rows
+    """
+    def __init__(self, k, rng, replace=False, is_oversampled=False):
+        self.k = k
+        self.rng = rng
+        self.replace = replace
+        self.is_oversampled = is_oversampled
+        self.counts = {}
+        self.samples = {}
+
+    def update(self, label, items):
+        """Merge a new batch of items (np.ndarray) of one label into its current sample"""
+        m = len(items)
+        if m == 0:
+            return
+        n = self.counts.get(label, 0)
+        self.counts[label] = n + m
+        if self.replace:
+            # every slot is an independent size-1 reservoir: it is taken from the new batch with prob m/(n+m)
+            new_items = items[self.rng.integers(m, size=self.k)]
+            if n == 0:
+                self.samples[label] = new_items
+            else:
+                is_replaced = self.rng.random(self.k) < m / (n + m)
+                self.samples[label] = np.where(is_replaced, new_items, self.samples[label])
+        else:
+            # uniform sample without replacement: the number taken from the new batch is hypergeometric
+            old_items = self.samples.get(label, items[:0])
+            size = min(n + m, self.k)
+            num_new = self.rng.hypergeometric(m, n, size) if n else size
+            new_items = items[self.rng.choice(m, num_new, replace=False)]
+            old_items = old_items[self.rng.choice(len(old_items), size - num_new, replace=False)]
+            self.samples[label] = np.concatenate([old_items, new_items])
+
+    def update_chunk(self, paths, labels):
+        """paths, labels: np.ndarray of one chunk"""
+        order = np.argsort(labels, kind='stable')
+        labels, paths = labels[order], paths[order]
+        unique_labels, starts = np.unique(labels, return_index=True)
+        for label, items in zip(unique_labels.tolist(), np.split(paths, starts[1:])):
+            self.update(label, items)
+
+    def get_paths_and_labels(self):
+        paths, labels = [], []
+        for label in sorted(self.samples):
+            items = self.samples[label]
+            if not self.replace and self.is_oversampled and len(items) < self.k:
+                num_copies = self.k//len(items) + 1
+                items = items[self.rng.choice(len(items)*num_copies, self.k, replace=False) % len(items)]
+            paths += items.tolist()
+            labels += [label]*len(items)
+        return paths, labels
+
+
+class ManifestBuilder:
+    """Build the valid / raw / mixed / cleaned / noised train manifests in one run.
+
+    all_data.csv is streamed once in chunks, df_revised.csv (the hand revised part) is streamed a few times,
+    df_checked.csv is only read for its path column. Exclusions use PathIndex instead of isin(list).
+    Arguments:
+        seed: int, every output gets its own random generator spawned from this seed so the results are deterministic
+        excluded_paths: paths dropped from every csv before sampling, eg. the near duplicates of dedup.get_duplicate_paths
+    """
+    def __init__(self,
+            df_all_path,
+            df_revised_path,
+            df_checked_path,
+            output_folder,
+            seed=42,
+            chunksize=200_000,
+            valid_num_per_class=12,
+            valid_null_num=50,
+            train_num_per_class=100,
+            cleaned_num_per_class=60,
+            noised_num_per_class=100,
+            is_txt_saved=True,
+            excluded_paths=None
+        ):
+        self.df_all_path = df_all_path
+        self.df_revised_path = df_revised_path
+        self.df_checked_path = df_checked_path
+        self.output_folder = Path(output_folder)
+        self.chunksize = chunksize
+        self.valid_num_per_class = valid_num_per_class
+        self.valid_null_num = valid_null_num
+        self.train_num_per_class = train_num_per_class
+        self.cleaned_num_per_class = cleaned_num_per_class
+        self.noised_num_per_class = noised_num_per_class
+        self.is_txt_saved = is_txt_saved
+        self.excluded_index = PathIndex(excluded_paths) if excluded_paths is not None and len(excluded_paths) else None
+        self.rngs = dict(zip(
+            ['valid', 'valid_null', 'raw', 'mixed', 'cleaned', 'noised'],
+            [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(6)]
+        ))
+        self.timings = {}
+
+    def _read_csv_chunks(self, path, usecols):
+        import pandas as pd
+        chunks = pd.read_csv(path, usecols=usecols, chunksize=self.chunksize)
+        if self.excluded_index is None:
+            return chunks
+        return (chunk[~self.excluded_index.contains(chunk['path'])] for chunk in chunks)
+
+    def _timed(self, stage, func):
+        start = time.time()
+        output = func()
+        self.timings[stage] = time.time() - start
+        print(f'- {stage}: {self.timings[stage]:.2f}s')
+        return output
+
+    @staticmethod
+    def _split_null(chunk):
+        """Return (not null and not deleted rows, null rows) of a df_revised chunk"""
+        null_cond = (chunk['label'] == 'isnull').to_numpy()
+        not_null_cond = (chunk['is_deleted'] == False).to_numpy() & ~null_cond
+        return chunk[not_null_cond], chunk[null_cond]
+
+    def _load_checked_paths(self):
+        paths = []
+        for chunk in self._read_csv_chunks(self.df_checked_path, ['path']):
+            paths += chunk['path'].to_list()
+        return PathIndex(paths)
+
+    def _sample_valid(self):
+        valid_sampler = StreamingGroupSampler(self.valid_num_per_class, self.rngs['valid'])
+        valid_null_sampler = StreamingGroupSampler(self.valid_null_num, self.rngs['valid_null'])
+        for chunk in self._read_csv_chunks(self.df_revised_path, ['path', 'label', 'int_label', 'is_deleted']):
+            df_not_null, df_null = self._split_null(chunk)
+            valid_sampler.update_chunk(df_not_null['path'].to_numpy(), df_not_null['int_label'].to_numpy())
+            valid_null_sampler.update_chunk(df_null['path'].to_numpy(), df_null['int_label'].to_numpy())
+        valid_paths, valid_labels = valid_sampler.get_paths_and_labels()
+        valid_null_paths, valid_null_labels = valid_null_sampler.get_paths_and_labels()
+        return valid_paths + valid_null_paths, valid_labels + valid_null_labels
+
+    def _stream_revised(self, valid_index, mixed_sampler, cleaned_sampler):
+        train_null_paths, train_null_labels = [], []
+        for chunk in self._read_csv_chunks(self.df_revised_path, ['path', 'label', 'int_label', 'is_deleted']):
+            chunk = chunk[~valid_index.contains(chunk['path'])]
+            df_not_null, df_null = self._split_null(chunk)
+            not_null_paths, not_null_labels = df_not_null['path'].to_numpy(), df_not_null['int_label'].to_numpy()
+            mixed_sampler.update_chunk(not_null_paths, not_null_labels)
+            cleaned_sampler.update_chunk(not_null_paths, not_null_labels)
+            train_null_paths += df_null['path'].to_list()
+            train_null_labels += df_null['int_label'].to_list()
+        return train_null_paths, train_null_labels
+
+    def _stream_all(self, valid_index, checked_index, raw_sampler, mixed_sampler, noised_sampler):
+        for chunk in self._read_csv_chunks(self.df_all_path, ['path', 'int_label']):
+            paths, labels = chunk['path'].to_numpy(), chunk['int_label'].to_numpy()
+            not_valid_cond = ~valid_index.contains(paths)
+            raw_sampler.update_chunk(paths[not_valid_cond], labels[not_valid_cond])
+            not_checked_cond = ~checked_index.contains(paths)
+            mixed_sampler.update_chunk(paths[not_checked_cond], labels[not_checked_cond])
+            noised_sampler.update_chunk(paths[not_checked_cond], labels[not_checked_cond])
+
+    def _collect_revised_not_used(self, used_index):
+        paths, labels = [], []
+        for chunk in self._read_csv_chunks(self.df_revised_path, ['path', 'int_label']):
+            chunk = chunk[~used_index.contains(chunk['path'])]
+            paths += chunk['path'].to_list()
+            labels += chunk['int_label'].to_list()
+        return paths, labels
+
+    def _save(self, name, paths, labels):
+        manifest = Manifest.from_paths_and_labels(paths, labels)
+        manifest_path = self.output_folder / f'{name}{MANIFEST_SUFFIX}'
+        manifest.save(manifest_path)
+        if self.is_txt_saved:
+            manifest.to_txt(self.output_folder / f'{name}.txt')
+        print(f'{name}: {len(manifest)} rows, {manifest.num_unique_paths} unique paths')
+        return manifest_path
+
+    def build(self):
+        """Returns a dict of {output name: manifest path}"""
+        self.timings = {}
+        self.output_folder.mkdir(parents=True, exist_ok=True)
+        start = time.time()
+        k = self.train_num_per_class
+        raw_sampler = StreamingGroupSampler(k, self.rngs['raw'], is_oversampled=True)
+        mixed_sampler = StreamingGroupSampler(k, self.rngs['mixed'], is_oversampled=True)
+        cleaned_sampler = StreamingGroupSampler(self.cleaned_num_per_class, self.rngs['cleaned'], replace=True)
+        noised_sampler = StreamingGroupSampler(self.noised_num_per_class, self.rngs['noised'], replace=True)
+
+        checked_index = self._timed('load checked paths', self._load_checked_paths)
+        valid_paths, valid_labels = self._timed('sample valid', self._sample_valid)
+        valid_index = PathIndex(valid_paths)
+        train_null_paths, train_null_labels = self._timed('stream df_revised', lambda: self._stream_revised(valid_index, mixed_sampler, cleaned_sampler))
+        self._timed('stream all_data', lambda: self._stream_all(valid_index, checked_index, raw_sampler, mixed_sampler, noised_sampler))
+
+        raw_paths, raw_labels = raw_sampler.get_paths_and_labels()
+        mixed_paths, mixed_labels = mixed_sampler.get_paths_and_labels()
+        cleaned_paths, cleaned_labels = cleaned_sampler.get_paths_and_labels()
+        cleaned_paths, cleaned_labels = train_null_paths + cleaned_paths, train_null_labels + cleaned_labels
+        noised_paths, noised_labels = noised_sampler.get_paths_and_labels()
+        revised_not_used_paths, revised_not_used_labels = self._timed('collect not used revised', lambda: self._collect_revised_not_used(valid_index.union(PathIndex(cleaned_paths))))
+
+        outputs = self._timed('save manifests', lambda: {
+            'valid': self._save('valid_balanced_images', valid_paths, valid_labels),
+            'raw': self._save('raw_train_balanced_images', raw_paths + train_null_paths, raw_labels + train_null_labels),
+            'mixed': self._save('mixed_train_balanced_images', mixed_paths + train_null_paths, mixed_labels + train_null_labels),
+            'cleaned': self._save('cleaned_train_balanced_images', cleaned_paths, cleaned_labels),
+            'noised': self._save('noised_train_balanced_images', noised_paths + revised_not_used_paths, noised_labels + revised_not_used_labels),
+        })
+        self.timings['total'] = time.time() - start
+        print(f'- total: {self.timings["total"]:.2f}s')
+        return outputs
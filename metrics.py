@@ -0,0 +1,66 @@
+# metrics.py
+import torch
+from torch import nn
+
+from .config import DCFG
+
+
+class MetricAccumulator(nn.Module):
+    """Running classification metrics kept on the model device.
+
+    update() only launches tensor ops, nothing is copied back to the host, so training steps never wait on the device.
+    compute() is the only sync point, call it at epoch end (or every n steps for logging).
+    The buffers are not persistent, so checkpoints keep the same state_dict keys.
+    """
+    def __init__(self, class_num=DCFG.class_num, is_confusion_tracked=False):
+        super().__init__()
+        self.class_num = class_num
+        self.is_confusion_tracked = is_confusion_tracked
+        self.register_buffer('corrects', torch.zeros((), dtype=torch.long), persistent=False)
+        self.register_buffer('total', torch.zeros((), dtype=torch.long), persistent=False)
+        self.register_buffer('loss_sum', torch.zeros((), dtype=torch.float64), persistent=False)
+        self.register_buffer('confusion', torch.zeros(class_num*class_num if is_confusion_tracked else 0, dtype=torch.long), persistent=False)
+
+    @torch.no_grad()
+    def update(self, preds, targets, loss=None):
+        """
+        Arguments:
+            preds, targets: LongTensor, [batch_size]
+            loss: Tensor, mean loss of the batch, it is weighted by the batch size
+        """
+        batch_size = targets.shape[0]
+        self.corrects += torch.sum(preds == targets)
+        self.total += batch_size
+        if loss is not None:
+            self.loss_sum += loss.detach().double()*batch_size
+        if self.is_confusion_tracked:
+            self.confusion += torch.bincount(targets*self.class_num + preds, minlength=self.class_num*self.class_num)
+
+    def _get_reduced_buffers(self):
+        """Sum the buffers over every DDP process (gloo on CPU), every rank has to call this"""
+        buffers = [self.corrects, self.total, self.loss_sum, self.confusion]
+        if torch.distributed.is_available() and torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1:
+            buffers = [buffer.clone() for buffer in buffers]
+            for buffer in filter(lambda buffer: buffer.numel(), buffers):
+                torch.distributed.all_reduce(buffer, op=torch.distributed.ReduceOp.SUM)
+        return buffers
+
+    @torch.no_grad()
+    def compute(self):
+        """Returns dict {'acc', 'loss', 'total'} of python numbers (+ 'confusion', a [class_num, class_num] cpu tensor),
+        reduced over all processes when training with DDP
+        """
+        corrects, total, loss_sum, confusion = self._get_reduced_buffers()
+        total = int(total)
+        outputs = {
+            'acc': int(corrects)/total if total else 0.0,
+            'loss': float(loss_sum)/total if total else 0.0,
+            'total': total,
+        }
+        if self.is_confusion_tracked:
+            outputs['confusion'] = confusion.view(self.class_num, self.class_num).cpu()
+        return outputs
+
+    def reset(self):
+        for buffer in (self.corrects, self.total, self.loss_sum, self.confusion):
+            buffer.zero_()
@@ -0,0 +1,206 @@
+# metrics_index.py
+import os
+import re
+import time
+import struct
+import sqlite3
+from pathlib import Path
+
+"""
+Persistent index of the tensorboard scalars of a model root folder (root_model_folder/model_type/version/...),
+a replacement of the EventAccumulator.Reload() scans in ModelFileHandler.get_best_metrics_record.
+
+Event files are append-only TFRecord files, so the index keeps, per file, how many bytes were already read and
+update() only parses the records appended since then (a file that shrank is read again from the start, removed
+files are dropped). Queries are plain SQL over
+    files:   path, version_folder, size, mtime_ns, offset
+    scalars: path, version_folder, tag, step, value, wall_time
+stored in <root>/metrics_index.sqlite.
+"""
+
+DB_NAME = 'metrics_index.sqlite'
+# 前兩項為舊紀錄之兼容
+DESIRED_METRICS = ["train_epoch_acc", "val_epoch_acc", "train_acc_epoch", "val_acc_epoch", "train_loss_epoch", "val_loss_epoch", "epoch"]
+
+_HEADER_SIZE = 12 # uint64 length + uint32 masked crc of the length
+_FOOTER_SIZE = 4 # uint32 masked crc of the data
+
+
+def _read_scalar_events(path, offset):
+    """Parse the complete records appended after offset
+    Returns:
+        list of (tag, step, value, wall_time), offset after the last complete record
+    """
+    from tensorboard.compat.proto import event_pb2
+    from tensorboard.util import tensor_util
+
+    rows = []
+    with open(path, 'rb') as in_file:
+        in_file.seek(offset)
+        while True:
+            header = in_file.read(_HEADER_SIZE)
+            if len(header) < _HEADER_SIZE:
+                break
+            length = struct.unpack('<Q', header[:8])[0]
+            data = in_file.read(length)
+            footer = in_file.read(_FOOTER_SIZE)
+            if len(data) < length or len(footer) < _FOOTER_SIZE: # record still being written
+                break
+            offset += _HEADER_SIZE + length + _FOOTER_SIZE
+            event = event_pb2.Event.FromString(data)
+            if not event.HasField('summary'):
+                continue
+            for value in event.summary.value:
+                if value.HasField('simple_value'):
+                    scalar = value.simple_value
+                elif value.HasField('tensor') and not value.tensor.tensor_shape.dim:
+                    scalar = float(tensor_util.make_ndarray(value.tensor))
+                else:
+                    continue
+                rows.append((value.tag, event.step, scalar, event.wall_time))
+    return rows, offset
+
+
+def get_target_metric_tag(tags, target_metric):
+    """Same matching as the old scan: "val_loss" (or "val_loss_epoch") matches val_loss_epoch or val_epoch_loss"""
+    trn_val, l_acc = target_metric.replace("_epoch", "").split("_")[:2]
+    matched = [
+        tag for tag in tags
+        if re.search("(%s){1}_(%s){1}_(epoch){1}"%(trn_val, l_acc), tag) or re.search("(%s){1}_(epoch){1}_(%s){1}"%(trn_val, l_acc), tag)
+    ]
+    return matched[0] if matched else None
+
+
+class MetricsIndex:
+    """
+    Init Arguments:
+        root_folder: str or Path, the model root (MCFG.root_model_folder), the index file is written there
+    """
+    def __init__(self, root_folder, db_path=None):
+        self.root_folder = Path(root_folder).resolve()
+        self.db_path = Path(db_path) if db_path else self.root_folder / DB_NAME
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(str(self.db_path), timeout=30)
+        self.connection.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY, version_folder TEXT, size INTEGER, mtime_ns INTEGER, offset INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS scalars (
+                path TEXT, version_folder TEXT, tag TEXT, step INTEGER, value REAL, wall_time REAL
+            );
+            CREATE INDEX IF NOT EXISTS scalars_version_tag ON scalars (version_folder, tag, value);
+            CREATE INDEX IF NOT EXISTS scalars_path_step ON scalars (path, step);
+        """)
+        self.stats = {}
+
+    def _get_version_folder(self, path):
+        """root/model_type/version/... -> root/model_type/version"""
+        relative_parts = Path(path).relative_to(self.root_folder).parts
+        return str(self.root_folder.joinpath(*relative_parts[:2]))
+
+    def update(self, folder=None):
+        """Index the new / appended / removed event files under folder (default: the whole root)"""
+        start = time.time()
+        folder = Path(folder).resolve() if folder else self.root_folder
+        event_paths = {}
+        for dir_path, _, file_names in os.walk(folder):
+            for file_name in file_names:
+                if 'tfevent' in file_name:
+                    path = os.path.join(dir_path, file_name)
+                    stat = os.stat(path)
+                    event_paths[path] = (stat.st_size, stat.st_mtime_ns)
+
+        prefix = str(folder).rstrip(os.sep) + os.sep
+        known = {
+            path: (size, mtime_ns, offset)
+            for path, size, mtime_ns, offset in self.connection.execute(
+                "SELECT path, size, mtime_ns, offset FROM files WHERE substr(path, 1, ?) = ?", (len(prefix), prefix)
+            )
+        }
+        num_parsed_files, num_new_rows = 0, 0
+        with self.connection:
+            for path in set(known) - set(event_paths):
+                self.connection.execute("DELETE FROM scalars WHERE path = ?", (path,))
+                self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+
+            for path, (size, mtime_ns) in event_paths.items():
+                old_size, old_mtime_ns, offset = known.get(path, (None, None, 0))
+                if old_size == size and old_mtime_ns == mtime_ns:
+                    continue
+                if old_size is not None and size < offset: # rewritten
+                    self.connection.execute("DELETE FROM scalars WHERE path = ?", (path,))
+                    offset = 0
+                version_folder = self._get_version_folder(path)
+                rows, offset = _read_scalar_events(path, offset)
+                self.connection.executemany(
+                    "INSERT INTO scalars VALUES (?, ?, ?, ?, ?, ?)",
+                    [(path, version_folder, tag, step, value, wall_time) for tag, step, value, wall_time in rows]
+                )
+                self.connection.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (path, version_folder, size, mtime_ns, offset))
+                num_parsed_files += 1
+                num_new_rows += len(rows)
+
+        self.stats = {
+            'event_files': len(event_paths),
+            'parsed_files': num_parsed_files,
+            'new_scalars': num_new_rows,
+            'removed_files': len(set(known) - set(event_paths)),
+            'time': time.time() - start,
+        }
+        return self.stats
+
+    def get_tags(self, version_folder):
+        return [tag for tag, in self.connection.execute("SELECT DISTINCT tag FROM scalars WHERE version_folder = ?", (str(Path(version_folder).resolve()),))]
+
+    def get_best_metrics_record(self, version_folder, target_metric="val_loss"):
+        """Best value of target_metric in version_folder and the desired metrics logged at the same step of the same file
+        Returns:
+            (best value, record str, epoch), (None, "", -1) when the metric was never logged (or only as NaN)
+        """
+        version_folder = str(Path(version_folder).resolve())
+        target_tag = get_target_metric_tag(self.get_tags(version_folder), target_metric)
+        if target_tag is None:
+            return None, "", -1
+        order = "DESC" if "acc" in target_metric else "ASC"
+        row = self.connection.execute( # NaN values are stored as NULL, which would sort first with ASC
+            f"SELECT path, step, value FROM scalars WHERE version_folder = ? AND tag = ? AND value IS NOT NULL ORDER BY value {order} LIMIT 1",
+            (version_folder, target_tag)
+        ).fetchone()
+        if row is None:
+            return None, "", -1
+        path, step, best_value = row
+        matched = dict(self.connection.execute(
+            f"SELECT tag, value FROM scalars WHERE path = ? AND step = ? AND tag IN ({','.join('?'*len(DESIRED_METRICS))})",
+            (path, step, *DESIRED_METRICS)
+        ).fetchall())
+        best_record = "".join(f"{tag}: {matched[tag]}, " for tag in DESIRED_METRICS if tag in matched)
+        epoch = int(matched["epoch"]) if "epoch" in matched else -1
+        return best_value, best_record, epoch
+
+    def get_best_versions(self, model_folder, target_metric="val_loss"):
+        """[(best value, version folder, epoch)] of every version under model_folder, best first"""
+        model_folder = str(Path(model_folder).resolve())
+        version_folders = [
+            version_folder for version_folder, in self.connection.execute(
+                "SELECT DISTINCT version_folder FROM files WHERE substr(version_folder, 1, ?) = ?", (len(model_folder) + 1, model_folder + os.sep)
+            )
+        ]
+        version_metrics = []
+        for version_folder in version_folders:
+            best_value, _, epoch = self.get_best_metrics_record(version_folder, target_metric)
+            if best_value is not None:
+                version_metrics.append((best_value, Path(version_folder), epoch))
+        return sorted(version_metrics, key=lambda elems: elems[0], reverse="acc" in target_metric)
+
+    def close(self):
+        self.connection.close()
+
+
+_INDEXES = {}
+
+def get_metrics_index(root_folder):
+    """One open MetricsIndex per model root"""
+    root_folder = str(Path(root_folder).resolve())
+    if root_folder not in _INDEXES:
+        _INDEXES[root_folder] = MetricsIndex(root_folder)
+    return _INDEXES[root_folder]
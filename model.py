@@ -13,6 +13,9 @@ import torchvision
 from .config import MCFG, DCFG, OCFG, NS
 CFGs = [MCFG, DCFG, OCFG, NS]
 from .utils import ModelFileHandler
+from .metrics import MetricAccumulator
+from .precision import autocast, is_channels_last, prepare_model
+from .compiled import compile_for_training
 
 MODEL_BACKBONES = ["eff", "res", "custom"]
 
@@ -31,12 +34,41 @@ def _get_raw_model(
         raw_model = EfficientNet.from_pretrained(f"efficientnet-b{eff_ver}", dropout_rate=dropout_rate, drop_connect_rate=drop_connect_rate)
     elif 'eff' in raw_model_type:
         eff_type = re.search("b[0-7]{1}", raw_model_type).group(0)
-        raw_model = EfficientNet.from_pretrained(f"efficientnet-{eff_type}")        
+        width, depth = _get_eff_scaling(raw_model_type)
+        if width is None and depth is None:
+            raw_model = EfficientNet.from_pretrained(f"efficientnet-{eff_type}")        
+        else: # narrower / shallower EfficientNet, eg. effb0_w0.5 or effb0_w0.75_d0.8, no pretrained weights for these
+            eff_params = EfficientNet.from_name(f"efficientnet-{eff_type}")._global_params
+            raw_model = EfficientNet.from_name(
+                f"efficientnet-{eff_type}", 
+                width_coefficient=width or eff_params.width_coefficient, 
+                depth_coefficient=depth or eff_params.depth_coefficient
+            )
     else: # model in torchvision.models 
         raw_model = getattr(torchvision.models, raw_model_type)(pretrained=is_pretrained)    
     print(f"Get {raw_model_type}, model type: {raw_model.__class__}")
     return raw_model
 
+def _get_eff_scaling(raw_model_type):
+    """"effb0_w0.5_d0.8" -> (0.5, 0.8), None for the unset ones"""
+    width = re.search("_w([0-9.]+)", raw_model_type)
+    depth = re.search("_d([0-9.]+)", raw_model_type)
+    return float(width.group(1)) if width else None, float(depth.group(1)) if depth else None
+
+def _get_head_name(raw_model):
+    """Attribute path of the last nn.Linear (the classifier layer), eg. "_fc", "fc" or "classifier.3"
+    """
+    head_names = [name for name, module in raw_model.named_modules() if isinstance(module, nn.Linear)]
+    assert head_names, f"no nn.Linear layer in {raw_model.__class__}"
+    return head_names[-1]
+
+def _replace_head(raw_model, class_num):
+    head_name = _get_head_name(raw_model)
+    parent_name, _, attr_name = head_name.rpartition('.')
+    parent = raw_model.get_submodule(parent_name) if parent_name else raw_model
+    setattr(parent, attr_name, nn.Linear(getattr(parent, attr_name).in_features, class_num))
+    return head_name
+
 class BasicClassifier(pl.LightningModule):
     """Parent Class for all lightning modules"""
     def __init__(self, raw_model=None):
@@ -46,13 +78,23 @@ class BasicClassifier(pl.LightningModule):
             config_dict = { k:v for k, v in CFG.__dict__.items() \
                            if not k.startswith("_") or isinstance(v, (str, list, int, float)) }
             self.save_hyperparameters(config_dict)
-        self.train_total_corrects = 0
-        self.train_total_epoch_size = 0
-        self.val_total_corrects = 0
-        self.val_total_epoch_size = 0
+        self.train_metrics = MetricAccumulator()
+        self.val_metrics = MetricAccumulator(is_confusion_tracked=MCFG.is_confusion_tracked)
+        self._compiled_model = None
 
     def forward(self, x):
-        return self.model(x)
+        """channels_last / CPU autocast as configured (see precision.py), float32 logits"""
+        if is_channels_last() and x.dim() == 4:
+            x = x.contiguous(memory_format=torch.channels_last) # no-op for the NHWC batches of the loaders
+        with autocast(x.device.type):
+            logits = (self._compiled_model or self.model)(x)
+        return logits.float()
+
+    def on_fit_start(self):
+        prepare_model(self)
+        if MCFG.compile_backend == 'compile' and self._compiled_model is None:
+            # not registered as a sub-module (object.__setattr__), the checkpoint keys stay model.*
+            object.__setattr__(self, '_compiled_model', compile_for_training(self.model))
 
     def process_batch(self, batch):
       x, y = batch
@@ -61,26 +103,30 @@ class BasicClassifier(pl.LightningModule):
     def cross_entropy_loss(self, logits, labels):
         return nn.CrossEntropyLoss()(logits, labels)
 
+    def _log_running_metrics(self, metrics, prefix, batch_idx):
+        """Sync the running metrics only every MCFG.metric_sync_every_n_steps steps (0: epoch end only)"""
+        if MCFG.metric_sync_every_n_steps and batch_idx % MCFG.metric_sync_every_n_steps == 0:
+            self.log(f'{prefix}_acc_running', metrics.compute()['acc'], on_step=True, on_epoch=False, prog_bar=True, logger=True)
+
     def training_step(self, train_batch, batch_idx):               
         x, y = self.process_batch(train_batch)
         logits = self.forward(x)
         loss = self.cross_entropy_loss(logits, y)
         _, y_hat = torch.max(logits, dim=1)        
 
-        self.train_total_corrects += torch.sum(y_hat == y).item()
-        self.train_total_epoch_size += y.shape[0]
+        self.train_metrics.update(y_hat, y, loss)
+        self._log_running_metrics(self.train_metrics, 'train', batch_idx)
 
         self.log('train_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
         return {'loss': loss}
 
     def training_epoch_end(self, outputs):        
         print(f"current epoch: {self.current_epoch}")
-        loss = sum([x['loss'] for x in outputs])/self.train_total_epoch_size
-        acc = self.train_total_corrects/self.train_total_epoch_size                
-        print(f"- train_acc_epoch: {acc}, train_loss: {loss}, total epoch size: {self.train_total_epoch_size}")
-        self.log('train_acc_epoch', acc)
+        metrics = self.train_metrics.compute()
+        print(f"- train_acc_epoch: {metrics['acc']}, train_loss: {metrics['loss']}, total epoch size: {metrics['total']}")
+        self.log('train_acc_epoch', metrics['acc'])
 
-        self.train_total_corrects = self.train_total_epoch_size = 0
+        self.train_metrics.reset()
 
     def validation_step(self, val_batch, batch_idx):              
         x, y = self.process_batch(val_batch)
@@ -88,19 +134,19 @@ class BasicClassifier(pl.LightningModule):
         loss = self.cross_entropy_loss(logits, y)
         _, y_hat = torch.max(logits, dim=1)
         
-        self.val_total_corrects += torch.sum(y_hat == y).item()
-        self.val_total_epoch_size += y.shape[0]
+        self.val_metrics.update(y_hat, y, loss)
 
         self.log('val_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
         return {'loss': loss}
 
     def validation_epoch_end(self, outputs):        
-        loss = sum([x['loss'] for x in outputs])/self.val_total_epoch_size
-        acc = self.val_total_corrects/self.val_total_epoch_size                
-        print(f'- val_acc_epoch: {acc}, val_loss: {loss}, total epoch size: {self.val_total_epoch_size}')        
-        self.log('val_acc_epoch', acc)    
+        metrics = self.val_metrics.compute()
+        print(f"- val_acc_epoch: {metrics['acc']}, val_loss: {metrics['loss']}, total epoch size: {metrics['total']}")        
+        self.log('val_acc_epoch', metrics['acc'])    
+        if 'confusion' in metrics:
+            self.val_confusion = metrics['confusion']
 
-        self.val_total_corrects = self.val_total_epoch_size = 0
+        self.val_metrics.reset()
         
     def configure_optimizers(self):
         if OCFG.has_differ_lr:
@@ -272,12 +318,28 @@ class NoisyStudentDaliEffClassifier(DaliEffClassifier):
     def __init__(self, raw_model):
         super().__init__(raw_model)
         self.teacher_model = None
-        self.real_label_total_corrects = 0
+        self.train_logit_cache = None
+        self.valid_logit_cache = None
+        self.val_real_label_metrics = MetricAccumulator()
 
     def set_teacher_model(self, teacher_model):
         self.teacher_model = teacher_model
         self.teacher_model.eval()
 
+    def set_teacher_logit_cache(self, train_logit_cache, valid_logit_cache):
+        """Use precomputed teacher logits (see teacher_cache.py) instead of running the teacher model,
+        the batches then carry sample ids in place of labels
+        """
+        self.train_logit_cache = train_logit_cache
+        self.valid_logit_cache = valid_logit_cache
+
+    def _get_teacher_logits_and_labels(self, logit_cache, teacher_x, y):
+        """Returns teacher logits and real labels, y holds sample ids when logit_cache is used"""
+        if logit_cache is not None:
+            return logit_cache.get_logits(y, device=self.device), logit_cache.get_labels(y, device=self.device)
+        with torch.no_grad():
+            return self.teacher_model(teacher_x), y
+
     def _handle_teacher_label_logits(self, label_logits):    
         return F.softmax(label_logits / NS.teacher_softmax_temp)
 
@@ -286,60 +348,143 @@ class NoisyStudentDaliEffClassifier(DaliEffClassifier):
         return torch.sum(target_prob*-F.log_softmax(logits))
     
     def process_batch_train(self, batch):
+        if self.train_logit_cache is not None: # no raw view needed
+            x, y = batch[0]['data'], batch[0]['label'].squeeze(-1)
+            return None, x.float(), y.long()
         raw_x, x, y = batch[0]['raw_data'], batch[0]['aug_data'], batch[0]['label'].squeeze(-1)
         return raw_x.float(), x.float(), y.long()
 
     def process_batch(self, batch):
-        x, y = batch[0]['data'], batch[0]['label']
+        x, y = batch[0]['data'], batch[0]['label'].squeeze(-1)
         return x.float(), y.long()
 
     def training_step(self, train_batch, batch_idx):               
         raw_x, x, y = self.process_batch_train(train_batch)
         logits = self.forward(x)
-        label_logits = self.teacher_model(raw_x)
+        label_logits, y = self._get_teacher_logits_and_labels(self.train_logit_cache, raw_x, y)
         loss = self.cross_entropy_loss(logits, label_logits)
         _, pred = torch.max(logits, dim=1)
         _, label = torch.max(label_logits, dim=1)         
                 
-        self.train_total_corrects += torch.sum(pred == label).item()
-        self.train_total_epoch_size += y.shape[0]
+        self.train_metrics.update(pred, label, loss/y.shape[0]) # the soft target loss is summed over the batch
+        self._log_running_metrics(self.train_metrics, 'train', batch_idx)
 
         self.log('train_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
         return {'loss': loss}
 
     def training_epoch_end(self, outputs):        
-        print(f"current epoch: {self.current_epoch}, total epoch size: {self.train_total_epoch_size}")
-        loss = sum([x['loss'] for x in outputs])/self.train_total_epoch_size
-        acc = self.train_total_corrects/self.train_total_epoch_size
-        print(f"- train_acc_epoch: {acc}, train_loss: {loss}")
-        self.log('train_acc_epoch', acc)                
+        metrics = self.train_metrics.compute()
+        print(f"current epoch: {self.current_epoch}, total epoch size: {metrics['total']}")
+        print(f"- train_acc_epoch: {metrics['acc']}, train_loss: {metrics['loss']}")
+        self.log('train_acc_epoch', metrics['acc'])                
 
-        self.train_total_corrects = self.train_total_epoch_size = 0
+        self.train_metrics.reset()
 
     def validation_step(self, val_batch, batch_idx):              
         x, y = self.process_batch(val_batch)
         logits = self.forward(x)
-        label_logits = self.teacher_model(x)
+        label_logits, y = self._get_teacher_logits_and_labels(self.valid_logit_cache, x, y)
         loss = self.cross_entropy_loss(logits, label_logits)
         _, pred = torch.max(logits, dim=1)
         _, label = torch.max(label_logits, dim=1) 
 
-        self.val_total_corrects += torch.sum(pred == label).item()
-        self.real_label_total_corrects += torch.sum(pred == y).item()
-        self.val_total_epoch_size += y.shape[0]
+        self.val_metrics.update(pred, label, loss/y.shape[0])
+        self.val_real_label_metrics.update(pred, y)
 
         self.log('val_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
         return {'loss': loss}
 
     def validation_epoch_end(self, outputs):
-        print(f"current epoch: {self.current_epoch}, total epoch size: {self.val_total_epoch_size}")
-        loss = sum([x['loss'] for x in outputs])/self.val_total_epoch_size
-        acc = self.val_total_corrects/self.val_total_epoch_size
-        real_label_acc = self.real_label_total_corrects/self.val_total_epoch_size
-        print(f'- val_acc_epoch: {acc}, val_loss: {loss}, real_label_acc_epoch: {real_label_acc}')
-        self.log('val_acc_epoch', acc)   
+        metrics = self.val_metrics.compute()
+        real_label_acc = self.val_real_label_metrics.compute()['acc']
+        print(f"current epoch: {self.current_epoch}, total epoch size: {metrics['total']}")
+        print(f"- val_acc_epoch: {metrics['acc']}, val_loss: {metrics['loss']}, real_label_acc_epoch: {real_label_acc}")
+        self.log('val_acc_epoch', metrics['acc'])   
                 
-        self.val_total_corrects = self.val_total_epoch_size = self.real_label_total_corrects = 0                        
+        self.val_metrics.reset()
+        self.val_real_label_metrics.reset()
+
+# ------------------
+# Distillation
+# ------------------
+
+class DistillClassifier(BasicClassifier):
+    """Knowledge distillation of a (big) teacher into a compact student, see distill.py
+    The raw model can be any torchvision model (eg. mobilenet_v3_small, shufflenet_v2_x1_0) or EfficientNet
+    (eg. effb0_w0.5), its last nn.Linear is replaced. Torch DataLoader (x, y) and DALI batches both work.
+    loss = alpha*T^2*KL(teacher_T || student_T) + (1 - alpha)*CE(student, y), T: NS.distill_temperature, alpha: NS.distill_alpha
+    Validation is on the real labels only, so val_acc_epoch compares with the teacher and the other students.
+    """
+    def __init__(self, raw_model):
+        super().__init__(raw_model)
+        self.head_name = _replace_head(self.model, DCFG.class_num)
+        self.teacher_model = None
+
+    def set_teacher_model(self, teacher_model):
+        self.teacher_model = teacher_model
+        self.teacher_model.eval()
+        for param in self.teacher_model.parameters():
+            param.requires_grad = False
+
+    def train(self, mode=True):
+        super().train(mode)
+        if self.teacher_model is not None: # the teacher stays in eval mode (BN statistics, dropout)
+            self.teacher_model.eval()
+        return self
+
+    def on_save_checkpoint(self, checkpoint):
+        # the checkpoint only holds the student, it is loaded like any other classifier
+        checkpoint['state_dict'] = {k: v for k, v in checkpoint['state_dict'].items() if not k.startswith('teacher_model.')}
+
+    def on_load_checkpoint(self, checkpoint):
+        """The teacher is not in the checkpoints, put the weights of the set teacher back for the strict load
+        (resume_from_checkpoint, eg. the successive halving rungs of distill.distill_trial)
+        """
+        if self.teacher_model is not None:
+            checkpoint['state_dict'].update({f'teacher_model.{k}': v for k, v in self.teacher_model.state_dict().items()})
+
+    def process_batch(self, batch):
+        if isinstance(batch, (list, tuple)) and isinstance(batch[0], dict): # DALI
+            x, y = batch[0]['data'], batch[0]['label'].squeeze(-1)
+        else:
+            x, y = batch
+        return x.float(), y.long()
+
+    def distillation_loss(self, logits, teacher_logits, labels):
+        temperature, alpha = NS.distill_temperature, NS.distill_alpha
+        soft_loss = F.kl_div(F.log_softmax(logits/temperature, dim=1), F.softmax(teacher_logits/temperature, dim=1), reduction='batchmean')
+        return alpha*temperature**2*soft_loss + (1 - alpha)*F.cross_entropy(logits, labels)
+
+    def training_step(self, train_batch, batch_idx):
+        assert self.teacher_model is not None, "call set_teacher_model() first"
+        x, y = self.process_batch(train_batch)
+        logits = self.forward(x)
+        with torch.no_grad():
+            teacher_logits = self.teacher_model(x)
+        loss = self.distillation_loss(logits, teacher_logits, y)
+        _, y_hat = torch.max(logits, dim=1)
+
+        self.train_metrics.update(y_hat, y, loss)
+        self._log_running_metrics(self.train_metrics, 'train', batch_idx)
+
+        self.log('train_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
+        return {'loss': loss}
+
+    def validation_epoch_end(self, outputs):
+        super().validation_epoch_end(outputs)
+        val_dataloader = self.trainer.datamodule.val_dataloader()
+        if hasattr(val_dataloader, 'reset'): # DALI iterator
+            val_dataloader.reset()
+
+    def _get_params_group(self):
+        head = self.model.get_submodule(self.head_name)
+        head_params_id = list(map(id, head.parameters()))
+        base_params = filter(lambda p: id(p) not in head_params_id, self.model.parameters())
+        params_group = [
+                        {'params': base_params, 'lr': OCFG.lr_group[1]},
+                        {'params': head.parameters(), 'lr': OCFG.lr_group[2]}
+        ]
+        return params_group
 
 class Differ_lr_Experiment_DaliEffClassifier(DaliEffClassifier):
     """Differ lr 
@@ -369,17 +514,23 @@ class Differ_lr_Experiment_DaliEffClassifier(DaliEffClassifier):
         return params_group
 
 def get_model(
-        raw_model_type=MCFG.model_type,
-        is_pretrained=MCFG.is_pretrained,
-        model_class_name=MCFG.model_class_name,
-        ckpt_path=MCFG.ckpt_path, 
-        is_continued_training=MCFG.is_continued_training,
+        raw_model_type=None,
+        is_pretrained=None,
+        model_class_name=None,
+        ckpt_path=None, 
+        is_continued_training=None,
         **kwargs
     ):
     """
     Arguments:
         classifier_name: str, full classifer class name        
+        None arguments are read from MCFG when called, ie. after config.init_config() selected the version / checkpoint
     """
+    raw_model_type = raw_model_type or MCFG.model_type
+    is_pretrained = MCFG.is_pretrained if is_pretrained is None else is_pretrained
+    model_class_name = model_class_name or MCFG.model_class_name
+    is_continued_training = MCFG.is_continued_training if is_continued_training is None else is_continued_training
+    ckpt_path = ckpt_path or (MCFG.ckpt_path if is_continued_training else None)
     g = globals().copy()
     model_class_names = [k for k in g.keys() if not k.startswith('_') and 'Classifier' in k]
     assert model_class_name in model_class_names, f"Wrong classifier class name, should be one of {model_class_names}"
@@ -400,9 +551,14 @@ def get_pred_model(raw_model_type, root_model_folder, target_metric="val_loss_ep
     raw_model = _get_raw_model(raw_model_type=raw_model_type)
     if "res" in raw_model_type:
         model_class_name = "ResNetClassifier"
-    elif re.search("eff|noisy_student|ns") in raw_model_type:
+    elif re.search("eff|noisy_student|ns", raw_model_type):
         model_class_name = "EfficientClassifier"
+    elif hasattr(torchvision.models, raw_model_type): # distilled mobile students, see distill.py
+        model_class_name = "DistillClassifier"
     else:
         raise ValueError("invalid model type input, please enter againg")
+    from .prune import get_pruning_plan_path, load_pruned_model
+    if get_pruning_plan_path(best_model_ckpt) is not None: # fine-tuned after pruning, see prune.prune_and_finetune
+        return load_pruned_model(best_model_ckpt, raw_model_type=raw_model_type, model_class_name=model_class_name)
     model = get_model(raw_model_type=raw_model_type, model_class_name=model_class_name, ckpt_path=best_model_ckpt)
     return model
@@ -28,33 +28,46 @@ def hook_fn(m, i, o):
 
 
 # profiler
-def pytorch_profiler(model, criterion, optimizer, datamodule):    
+def pytorch_profiler(model, criterion, optimizer, datamodule, num_steps=5, device=None):
+    """Quick profile of a few plain training steps outside of Lightning,
+    for real training runs use callbacks.ProfilerCallback (MCFG.is_profiled)
+    """
+    import torch
+    device = torch.device(device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+    is_cuda_used = device.type == 'cuda'
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if is_cuda_used:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
     def trace_handler(prof):
-            print(prof.key_averages().table(
-                sort_by="self_cuda_time_total", row_limit=-1))
-        
+        sort_by = "self_cuda_time_total" if is_cuda_used else "self_cpu_time_total"
+        print(prof.key_averages().table(sort_by=sort_by, row_limit=30))
+
+    model = model.to(device)
+    model.train()
     with torch.profiler.profile(
-        activities=[
-            torch.profiler.ProfilerActivity.CPU,
-            torch.profiler.ProfilerActivity.CUDA
-                    ],
+        activities=activities,
         schedule=torch.profiler.schedule(
-            wait=0,
-            warmup=0,
-            active=1),
-        on_trace_ready=trace_handler
+            wait=1,
+            warmup=1,
+            active=num_steps),
+        on_trace_ready=trace_handler,
+        profile_memory=True
         # on_trace_ready=torch.profiler.tensorboard_trace_handler('./log')
     ) as profiler:
-            # for step, data in enumerate(train_dataloader, 0):
             for step, data in enumerate(datamodule.train_dataloader()):
+                if step >= num_steps + 2:
+                    break
                 print("step:{}".format(step))
-                # inputs, labels = data[0].to(dcfg.device), data[1].to(dcfg.device)
-                inputs, labels = data[0]['data'].to(dcfg.device), data[0]['label'].to(DCFG.device)
-                model = model.to(DCFG.device)
+                if isinstance(data[0], dict): # dali output
+                    inputs, labels = data[0]['data'], data[0]['label']
+                else:
+                    inputs, labels = data[0], data[1]
+                inputs, labels = inputs.to(device), labels.to(device)
                 outputs = model(inputs)
-                loss = criterion(outputs, labels.long().squeeze(-1))
+                loss = criterion(outputs, labels.long().view(-1))
 
                 optimizer.zero_grad()
                 loss.backward()
                 optimizer.step()
-                profiler.step()
\ No newline at end of file
+                profiler.step()
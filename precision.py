@@ -0,0 +1,92 @@
+# precision.py
+from contextlib import nullcontext
+
+import torch
+
+from .config import DCFG, MCFG
+
+"""
+Memory format and CPU precision of the model and its inputs, for training (BasicClassifier) and serving (predict.py,
+tta.py...).
+
+    DCFG.memory_format = 'channels_last': the model weights are channels_last (NHWC in memory) and the loaders hand
+        over NHWC batches without a transpose copy:
+            torch DataLoader: the augmentation / preprocess tensors are permuted views of the HWC images, stacked as
+                NHWC by channels_last_collate
+            DALI: the pipelines output NHWC (no Transpose op, CropMirrorNormalize output_layout NHWC), NHWCLoader turns
+                every batch into a [N, C, H, W] channels_last view
+        Logically every tensor stays [N, C, H, W], only the strides change, so the models do not change.
+    MCFG.cpu_autocast_dtype = 'bfloat16': CPU forward passes run under torch.autocast('cpu', bfloat16) (conv / linear in
+        bf16, the rest in float32), the logits are returned in float32. GPU precision stays MCFG.precision / apex.
+
+See benchmark.benchmark_memory_format for the parity and the speed of every combination.
+"""
+
+MEMORY_FORMATS = {'contiguous': torch.contiguous_format, 'channels_last': torch.channels_last}
+IMAGE_KEYS = ('data', 'raw_data', 'aug_data')
+
+
+def get_memory_format(memory_format=None):
+    return MEMORY_FORMATS[memory_format or DCFG.memory_format]
+
+def is_channels_last(memory_format=None):
+    return (memory_format or DCFG.memory_format) == 'channels_last'
+
+def get_autocast_dtype(dtype=None):
+    dtype = dtype or MCFG.cpu_autocast_dtype
+    return getattr(torch, dtype) if isinstance(dtype, str) else dtype
+
+def autocast(device_type='cpu', dtype=None):
+    """torch.autocast on CPU with MCFG.cpu_autocast_dtype, a no-op on GPU or when it is None"""
+    dtype = get_autocast_dtype(dtype)
+    if dtype is None or device_type != 'cpu':
+        return nullcontext()
+    return torch.autocast('cpu', dtype=dtype)
+
+def to_memory_format(x, memory_format=None):
+    """Model (in place) or 4-D tensor to the memory format, other tensors are returned as is"""
+    memory_format = get_memory_format(memory_format)
+    if isinstance(x, torch.nn.Module):
+        return x.to(memory_format=memory_format)
+    return x.contiguous(memory_format=memory_format) if x.dim() == 4 else x
+
+def prepare_model(model, memory_format=None):
+    """Model for the configured memory format (serving or before training)"""
+    return to_memory_format(model, memory_format) if is_channels_last(memory_format) else model
+
+# --------------------------
+# Loaders
+# --------------------------
+def channels_last_collate(samples):
+    """DataLoader collate_fn of (image [C, H, W], label) samples stacking the images as NHWC
+    The images are permuted views of HWC arrays (preprocess / augment), so every image is one contiguous copy
+    """
+    images, labels = zip(*samples)
+    batch = torch.stack([image.permute(1, 2, 0) for image in images]).permute(0, 3, 1, 2)
+    return batch, torch.as_tensor(labels)
+
+def nhwc_to_nchw_view(x):
+    """[N, H, W, C] -> [N, C, H, W] channels_last view, no copy"""
+    return x.permute(0, 3, 1, 2)
+
+class NHWCLoader:
+    """Wrapper of a DALIGenericIterator whose pipeline outputs NHWC images, every image output (IMAGE_KEYS) becomes a
+    [N, C, H, W] channels_last view, everything else (reset, len...) is delegated to the iterator
+    """
+    def __init__(self, loader):
+        self.loader = loader
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield [
+                {key: nhwc_to_nchw_view(value) if key in IMAGE_KEYS else value for key, value in device_batch.items()}
+                for device_batch in batch
+            ]
@@ -1,33 +1,63 @@
-import torch
 import os
 
-from .model import get_pred_model
-from .preprocess import preprocess
 from .utils import ImageReader, int_label2word
 from .config import MCFG
 
+# torch, the model and the preprocessing are imported when predicting, `import predict` stays fast,
+# see benchmark.benchmark_import_time
+
 def prepare_image(image_path, is_image_showed=True):
+    from .preprocess import preprocess
     test_image = ImageReader.read_image_RGB_cv2(image_path)
     return preprocess(test_image).unsqueeze(0)
-    
-def single_predict(image_path, model):
+
+def single_predict(image_path, model, device="cpu"):
+    import torch
     test_tensor = prepare_image(image_path)
-    logits = F.softmax(model(test_tensor.float.to(device)))
-    prediction = int(torch.argmax(logits))
-    confidence = logits[prediction]
+    with torch.no_grad():
+        probs = torch.softmax(model(test_tensor.float().to(device)), dim=1)[0]
+    prediction = int(torch.argmax(probs))
+    confidence = float(probs[prediction])
     word = int_label2word(prediction)
     print(f"Prediction: {word}, Class Number: {prediction}, confidence: {confidence}")
     return word, prediction, confidence
-    
+
+
+def tta_predict(image_paths, predictor, batch_size=32):
+    """Batched TTA predictions of image paths, see tta.TTAPredictor"""
+    results = []
+    for i in range(0, len(image_paths), batch_size):
+        batch_paths = image_paths[i:i+batch_size]
+        images = [ImageReader.read_image_RGB_cv2(image_path) for image_path in batch_paths]
+        predictions, confidences, is_tta, _ = predictor.predict_batch(images)
+        for image_path, prediction, confidence, is_image_tta in zip(batch_paths, predictions, confidences, is_tta):
+            word = int_label2word(int(prediction))
+            print(f"{image_path} Prediction: {word}, Class Number: {prediction}, confidence: {confidence}, tta: {is_image_tta}")
+            results.append((word, int(prediction), float(confidence)))
+    print(f"TTA on {predictor.stats['tta_images']}/{predictor.stats['images']} images")
+    return results
+
 
 def predict(args):
-    device = "cuda:0" if torch.cuda.is_available() and args.is_gpu_used else "cpu"
-    model = get_pred_model(args.model_type, MCFG.root_model_folder, target_metric=args.target_metric, best_ckpt_path=args.checkpoint_path)
+    import torch
+    from .model import get_pred_model
+    from .precision import prepare_model
+    device = "cuda:0" if torch.cuda.is_available() and getattr(args, 'is_gpu_used', True) else "cpu"
+    model = get_pred_model(args.model_type or MCFG.model_type, MCFG.root_model_folder, target_metric=args.target_metric, best_model_ckpt=args.checkpoint_path or None)
     model.to(device)
+    prepare_model(model) # DCFG.memory_format, the forward applies MCFG.cpu_autocast_dtype
     model.eval()
+    if getattr(args, 'compile_backend', None): # traced / compiled graph per batch-size bucket, see compiled.py
+        from .compiled import CompiledModel, DEFAULT_BUCKETS
+        model = CompiledModel(model, backend=args.compile_backend, buckets=(1,) if not getattr(args, 'tta', False) else DEFAULT_BUCKETS)
     assert os.path.exists(args.input_path)
+    if getattr(args, 'tta', False):
+        from .tta import TTAPredictor
+        predictor = TTAPredictor(model, confidence_threshold=args.tta_threshold, max_tta_fraction=args.tta_max_fraction, device=device)
+        image_paths = [os.path.join(args.input_path, image_name) for image_name in sorted(os.listdir(args.input_path))] if os.path.isdir(args.input_path) else [args.input_path]
+        return tta_predict(image_paths, predictor)
     if os.path.isdir(args.input_path):
-        for image_path in os.listdir(args.input_path):
-            single_predict(image_path, model)
-    else: 
-        single_predict(args.input_path, model)
\ No newline at end of file
+        for image_name in os.listdir(args.input_path):
+            single_predict(os.path.join(args.input_path, image_name), model, device)
+    else:
+        single_predict(args.input_path, model, device)
@@ -0,0 +1,222 @@
+# prune.py
+import os
+import csv
+import json
+from datetime import date
+from pathlib import Path
+
+import torch
+from torch import nn
+
+from .config import MCFG
+
+"""
+Structured channel pruning of EfficientNet classifiers (EfficientClassifier / DaliEffClassifier / DistillClassifier
+on an EfficientNet), the pruned network is a smaller dense network, so it is faster on CPU unlike unstructured sparsity.
+
+Every MBConv block with an expansion phase (expand_ratio != 1) is pruned along its expanded channels:
+    _expand_conv (out) -> _bn0 -> _depthwise_conv (groups) -> _bn1 -> _se_reduce (in) / _se_expand (out) -> _project_conv (in)
+The block input / output channels (and so the skip connections) are kept. Channels are ranked by the magnitude of
+their _bn1 scale (|gamma| of the BN after the depthwise conv): a channel with a small gamma contributes little to the
+projection. `ratio` of every block's expanded channels are removed, the kept count is rounded to a multiple of
+channel_multiple (SIMD friendly on CPU).
+
+The kept channel indices are written to a pruning plan json next to the fine-tuned checkpoints, load_pruned_model()
+rebuilds the pruned shapes from it before loading a checkpoint.
+
+    prune_and_finetune(ckpt_path, ratios=(0.25, 0.5), datamodule_fn=create_datamodule) -> report csv of
+    ratio, MACs, params, CPU latency, val acc before / after fine-tuning
+"""
+
+PLAN_NAME = 'pruning_plan.json'
+
+
+def _get_eff_model(model):
+    """The EfficientNet inside a classifier (model.model) or the EfficientNet itself"""
+    raw_model = getattr(model, 'model', model)
+    assert hasattr(raw_model, '_blocks'), f"{raw_model.__class__} is not an EfficientNet"
+    return raw_model
+
+def _get_prunable_blocks(raw_model):
+    return {i: block for i, block in enumerate(raw_model._blocks) if block._block_args.expand_ratio != 1}
+
+def get_channel_importance(block):
+    """|gamma| of _bn1, one value per expanded channel"""
+    return block._bn1.weight.detach().abs()
+
+def _round_to_multiple(num, multiple, max_num):
+    return int(min(max_num, max(multiple, multiple*round(num/multiple))))
+
+def make_pruning_plan(model, ratio, channel_multiple=8):
+    """{block id: sorted kept channel ids} removing `ratio` of the expanded channels of every prunable block"""
+    plan = {}
+    for i, block in _get_prunable_blocks(_get_eff_model(model)).items():
+        importance = get_channel_importance(block)
+        num_kept = _round_to_multiple(len(importance)*(1 - ratio), channel_multiple, len(importance))
+        plan[i] = sorted(torch.argsort(importance, descending=True)[:num_kept].tolist())
+    return plan
+
+# --------------------------
+# Slicing layers
+# --------------------------
+def _slice_conv(conv, out_ids=None, in_ids=None):
+    weight = conv.weight.detach()
+    if out_ids is not None:
+        weight = weight[out_ids]
+        if conv.bias is not None:
+            conv.bias = nn.Parameter(conv.bias.detach()[out_ids].clone())
+    if in_ids is not None:
+        weight = weight[:, in_ids]
+    conv.weight = nn.Parameter(weight.clone())
+    conv.out_channels = weight.shape[0]
+    conv.in_channels = weight.shape[1]*conv.groups
+
+def _slice_depthwise_conv(conv, ids):
+    conv.weight = nn.Parameter(conv.weight.detach()[ids].clone())
+    conv.in_channels = conv.out_channels = conv.groups = len(ids)
+
+def _slice_bn(bn, ids):
+    bn.weight = nn.Parameter(bn.weight.detach()[ids].clone())
+    bn.bias = nn.Parameter(bn.bias.detach()[ids].clone())
+    bn.running_mean = bn.running_mean[ids].clone()
+    bn.running_var = bn.running_var[ids].clone()
+    bn.num_features = len(ids)
+
+def prune_block(block, kept_ids):
+    ids = torch.as_tensor(kept_ids, dtype=torch.long, device=block._bn1.weight.device)
+    _slice_conv(block._expand_conv, out_ids=ids)
+    _slice_bn(block._bn0, ids)
+    _slice_depthwise_conv(block._depthwise_conv, ids)
+    _slice_bn(block._bn1, ids)
+    if block.has_se:
+        _slice_conv(block._se_reduce, in_ids=ids)
+        _slice_conv(block._se_expand, out_ids=ids)
+    _slice_conv(block._project_conv, in_ids=ids)
+
+def apply_pruning_plan(model, plan):
+    """Prune model in place, plan: {block id: kept channel ids} (json keys may be str)"""
+    raw_model = _get_eff_model(model)
+    for i, kept_ids in plan.items():
+        prune_block(raw_model._blocks[int(i)], kept_ids)
+    return model
+
+def save_pruning_plan(plan, folder, **info):
+    Path(folder).mkdir(parents=True, exist_ok=True)
+    with open(Path(folder) / PLAN_NAME, 'w') as out_file:
+        json.dump({**info, 'blocks': {str(i): kept_ids for i, kept_ids in plan.items()}}, out_file)
+
+def load_pruning_plan(path):
+    with open(path) as in_file:
+        return json.load(in_file)['blocks']
+
+def get_pruning_plan_path(ckpt_path):
+    """version_folder/pruning_plan.json of a checkpoint in version_folder/checkpoints, None if the version is not pruned"""
+    plan_path = Path(ckpt_path).parent.parent / PLAN_NAME
+    return plan_path if plan_path.exists() else None
+
+def load_pruned_model(ckpt_path, plan_path=None, raw_model_type=None, model_class_name='DaliEffClassifier'):
+    """Unpruned model -> pruned shapes of the plan (default: version_folder/pruning_plan.json) -> checkpoint weights"""
+    from .model import get_model
+    plan_path = plan_path or get_pruning_plan_path(ckpt_path)
+    assert plan_path, f"no {PLAN_NAME} next to the checkpoints folder of {ckpt_path}"
+    model = get_model(raw_model_type=raw_model_type, is_pretrained=False, model_class_name=model_class_name, ckpt_path=None, is_continued_training=False)
+    apply_pruning_plan(model, load_pruning_plan(plan_path))
+    model.load_state_dict(torch.load(ckpt_path, map_location='cpu')['state_dict'])
+    return model
+
+# --------------------------
+# Cost
+# --------------------------
+def count_macs(model, input_shape=(1, 3, 224, 224)):
+    """Multiply-accumulates of one forward pass (conv + linear layers), counted with forward hooks"""
+    macs = [0]
+    def conv_hook(module, inputs, output):
+        macs[0] += output.numel()*(module.in_channels//module.groups)*module.kernel_size[0]*module.kernel_size[1]
+    def linear_hook(module, inputs, output):
+        macs[0] += output.numel()*module.in_features
+    handles = [
+        module.register_forward_hook(conv_hook if isinstance(module, nn.Conv2d) else linear_hook)
+        for module in model.modules() if isinstance(module, (nn.Conv2d, nn.Linear))
+    ]
+    was_training = model.training
+    model.eval()
+    try:
+        with torch.no_grad():
+            model(torch.zeros(*input_shape, device=next(model.parameters()).device))
+    finally:
+        for handle in handles:
+            handle.remove()
+        model.train(was_training)
+    return macs[0]
+
+def get_model_cost(model, num_threads=1):
+    from .distill import measure_cpu_latency
+    return {
+        'gmacs': count_macs(model)/1e9,
+        'params_m': sum(param.numel() for param in model.parameters())/1e6,
+        **measure_cpu_latency(model, num_threads=num_threads),
+    }
+
+def validate_accuracy(model, datamodule):
+    """val_acc_epoch of one validation run"""
+    import pytorch_lightning as pl
+    from .train import _get_device_kwargs
+    trainer = pl.Trainer(logger=False, checkpoint_callback=False, **_get_device_kwargs())
+    trainer.validate(model, datamodule=datamodule)
+    return float(trainer.callback_metrics['val_acc_epoch'])
+
+# --------------------------
+# Workflow
+# --------------------------
+def prune_and_finetune(ckpt_path, ratios=(0.25, 0.5), datamodule_fn=None, raw_model_type=None, model_class_name='DaliEffClassifier',
+        finetune_epochs=3, channel_multiple=8, num_threads=1, report_path=None):
+    """Prune a trained checkpoint with every ratio, fine-tune each pruned model with train.single_train
+    (version folder root_model_folder/model_type/{today}.pruned_{ratio}) and report the cost / accuracy of every ratio
+    Arguments:
+        datamodule_fn: function() -> datamodule, default dataset.create_datamodule
+    Returns:
+        list of row dicts, ratio 0 is the unpruned model
+    """
+    from .model import get_model
+    from .train import single_train
+    if datamodule_fn is None:
+        from .dataset import create_datamodule as datamodule_fn
+    raw_model_type = raw_model_type or MCFG.model_type
+
+    def load_model():
+        return get_model(raw_model_type=raw_model_type, is_pretrained=False, model_class_name=model_class_name, ckpt_path=ckpt_path, is_continued_training=False)
+
+    base_model = load_model()
+    rows = [{'ratio': 0.0, **get_model_cost(base_model.model, num_threads), 'val_acc': validate_accuracy(base_model, datamodule_fn()), 'finetuned_val_acc': None, 'ckpt_path': str(ckpt_path)}]
+    del base_model
+
+    max_epochs, is_continued_training = MCFG.max_epochs, MCFG.is_continued_training
+    for ratio in ratios:
+        model = load_model()
+        plan = make_pruning_plan(model, ratio, channel_multiple)
+        apply_pruning_plan(model, plan)
+        row = {'ratio': ratio, **get_model_cost(model.model, num_threads), 'val_acc': validate_accuracy(model, datamodule_fn())}
+
+        MCFG.max_epochs, MCFG.is_continued_training, MCFG.ckpt_path = finetune_epochs, False, None
+        MCFG.version = f"{date.today()}.pruned_{ratio}"
+        MCFG.target_version_folder = MCFG.root_model_folder / raw_model_type / MCFG.version
+        save_pruning_plan(plan, MCFG.target_version_folder, ratio=ratio, channel_multiple=channel_multiple, source_ckpt_path=str(ckpt_path))
+        trainer, model = single_train(model, datamodule_fn(), is_user_input_needed=False)
+        row['finetuned_val_acc'] = float(trainer.callback_metrics['val_acc_epoch'])
+        row['ckpt_path'] = str(MCFG.target_version_folder / "checkpoints")
+        rows.append(row)
+        print(row)
+        del model, trainer
+    MCFG.max_epochs, MCFG.is_continued_training = max_epochs, is_continued_training
+
+    print(f"{'ratio':>6}{'GMACs':>8}{'params(M)':>11}{'median(ms)':>12}{'val_acc':>9}{'finetuned':>11}")
+    for row in rows:
+        finetuned = f"{row['finetuned_val_acc']:.4f}" if row['finetuned_val_acc'] is not None else '-'
+        print(f"{row['ratio']:>6.2f}{row['gmacs']:>8.3f}{row['params_m']:>11.2f}{row['median_ms']:>12.2f}{row['val_acc']:>9.4f}{finetuned:>11}")
+    if report_path:
+        os.makedirs(os.path.dirname(os.path.abspath(report_path)), exist_ok=True)
+        with open(report_path, 'w', newline='') as out_file:
+            writer = csv.DictWriter(out_file, fieldnames=list(rows[-1]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
@@ -0,0 +1,275 @@
+# pseudo_label.py
+import json
+import time
+from pathlib import Path
+
+import numpy as np
+
+from .config import DCFG, NS
+from .manifest import Manifest, load_manifest_if_existing
+from .evaluate import Evaluator, TOP_K
+
+"""
+Pseudo labels of the unlabeled / noised images for the next noisy student iteration.
+
+    generate_pseudo_labels() with the current teacher (NS.teacher_model_type / NS.teacher_ckpt_path):
+        1. score: teacher top-k probabilities of every unique image of the noised manifest (batched CPU inference,
+           evaluate.Evaluator), kept in a score store, incremental: only the images that are new or were scored by
+           another teacher are scored again, the store is saved every chunk_size images so a stopped run resumes
+        2. filter: teacher confidence >= NS.pseudo_label_threshold
+        3. balance: at most NS.pseudo_label_max_per_class images per class (most confident first), classes below
+           NS.pseudo_label_min_per_class are oversampled by duplicating their images
+        4. write NS.pseudo_label_folder/iter{n+1}:
+               noised.manifest: paths and hard pseudo labels, read by NoisyStudentDataHandler.get_noisy_student_data
+               stats.json:      row / image counts, agreement with the noisy labels, per class counts
+        5. NS.student_iter = n + 1, persisted in NS.pseudo_label_folder/student_iter.json so the next training run
+           (another process) reads the new manifest, see sync_student_iter
+
+Score store layout (NS.pseudo_label_folder/scores):
+    paths.manifest: the scored unique paths (with their original noisy labels)
+    teacher_ids.npy int16 [N]: index of the teacher in meta.json 'teachers' that scored the image, -1: not scored
+    topk_ids.npy int16 [N, k], topk_probs.npy float16 [N, k]
+    meta.json: {'teachers': [...], 'top_k': k}, written last
+"""
+
+PSEUDO_MANIFEST_NAME = 'noised.manifest'
+SCORE_FOLDER_NAME = 'scores'
+STUDENT_ITER_FILE_NAME = 'student_iter.json'
+
+
+def get_pseudo_label_folder(student_iter):
+    return Path(NS.pseudo_label_folder) / f'iter{student_iter}'
+
+def get_pseudo_label_manifest_path(student_iter):
+    return get_pseudo_label_folder(student_iter) / PSEUDO_MANIFEST_NAME
+
+def save_student_iter(student_iter, manifest_path):
+    with open(Path(NS.pseudo_label_folder) / STUDENT_ITER_FILE_NAME, 'w') as out_file:
+        json.dump({'student_iter': student_iter, 'manifest': str(manifest_path)}, out_file)
+
+def sync_student_iter():
+    """Set NS.student_iter to the iteration persisted by the last generate_pseudo_labels run when it is further than
+    the configured one (config.py starts at 1), returns NS.student_iter. Edit or delete student_iter.json to go back.
+    """
+    iter_path = Path(NS.pseudo_label_folder) / STUDENT_ITER_FILE_NAME
+    if iter_path.exists():
+        with open(iter_path) as in_file:
+            student_iter = json.load(in_file)['student_iter']
+        if student_iter > NS.student_iter:
+            print(f"NS.student_iter {NS.student_iter} -> {student_iter}, the iteration of the last pseudo labels ({iter_path})")
+            NS.student_iter = student_iter
+    return NS.student_iter
+
+def get_teacher_key(ckpt_path):
+    """Identity of a teacher checkpoint, changes when the file is replaced"""
+    ckpt_path = Path(ckpt_path)
+    return f"{ckpt_path.resolve()}@{ckpt_path.stat().st_mtime}"
+
+
+class TeacherScoreStore:
+    """Teacher top-k probabilities of unique image paths, see module docstring for the layout"""
+    def __init__(self, manifest, teacher_ids, topk_ids, topk_probs, teachers):
+        self.manifest = manifest
+        self.teacher_ids = teacher_ids
+        self.topk_ids = topk_ids
+        self.topk_probs = topk_probs
+        self.teachers = teachers
+
+    def __len__(self):
+        return len(self.manifest)
+
+    @classmethod
+    def empty(cls, manifest):
+        num_rows = len(manifest)
+        return cls(
+            manifest,
+            np.full(num_rows, -1, dtype=np.int16),
+            np.zeros((num_rows, TOP_K), dtype=np.int16),
+            np.zeros((num_rows, TOP_K), dtype=np.float16),
+            [],
+        )
+
+    @classmethod
+    def load(cls, folder):
+        folder = Path(folder)
+        with open(folder / 'meta.json') as in_file:
+            meta = json.load(in_file)
+        assert meta['top_k'] == TOP_K, f"score store of top {meta['top_k']}, expected {TOP_K}"
+        arrays = [np.load(folder / f'{name}.npy') for name in ('teacher_ids', 'topk_ids', 'topk_probs')]
+        return cls(Manifest.load(folder / 'paths.manifest', mmap_mode=None), *arrays, meta['teachers'])
+
+    @staticmethod
+    def exists(folder):
+        return (Path(folder) / 'meta.json').exists()
+
+    def save(self, folder):
+        folder = Path(folder)
+        folder.mkdir(parents=True, exist_ok=True)
+        if (folder / 'meta.json').exists():
+            (folder / 'meta.json').unlink()
+        self.manifest.save(folder / 'paths.manifest')
+        for name in ('teacher_ids', 'topk_ids', 'topk_probs'):
+            np.save(folder / f'{name}.npy', getattr(self, name))
+        with open(folder / 'meta.json', 'w') as out_file:
+            json.dump({'teachers': self.teachers, 'top_k': TOP_K}, out_file)
+
+    def align(self, manifest):
+        """Store of the unique paths of manifest, carrying over the scores of the paths already scored"""
+        unique = Manifest.from_paths_and_labels(*_get_unique_paths_and_labels(manifest))
+        aligned = self.empty(unique)
+        aligned.teachers = list(self.teachers)
+        old_ids = {path: i for i, path in enumerate(self.manifest.path_table)} if len(self) else {}
+        pairs = np.array([(new_id, old_ids[path]) for new_id, path in enumerate(unique.path_table) if path in old_ids], dtype=np.int64).reshape(-1, 2)
+        if len(pairs):
+            new_ids, old_rows = pairs[:, 0], pairs[:, 1]
+            aligned.teacher_ids[new_ids] = self.teacher_ids[old_rows]
+            aligned.topk_ids[new_ids] = self.topk_ids[old_rows]
+            aligned.topk_probs[new_ids] = self.topk_probs[old_rows]
+        return aligned
+
+    def get_teacher_id(self, teacher):
+        if teacher not in self.teachers:
+            self.teachers.append(teacher)
+        return self.teachers.index(teacher)
+
+    def get_stale_ids(self, teacher_id):
+        """Rows not scored by the teacher yet"""
+        return np.flatnonzero(self.teacher_ids != teacher_id)
+
+
+def _get_unique_paths_and_labels(manifest):
+    """Unique paths in first-appearance order with the label of their first row"""
+    path_ids = np.asarray(manifest.path_ids)
+    unique_path_ids, first_rows = np.unique(path_ids, return_index=True)
+    order = np.argsort(first_rows, kind='stable')
+    path_table = manifest.path_table
+    return [path_table[i] for i in unique_path_ids[order]], np.asarray(manifest.labels)[first_rows[order]]
+
+
+def score_manifest(teacher_model, manifest, teacher, folder=None, chunk_size=20000, **evaluator_kwargs):
+    """Score the unique images of manifest with teacher_model, only those not scored by this teacher yet
+    Arguments:
+        teacher: str identifying the teacher, see get_teacher_key
+        folder: score store folder, default NS.pseudo_label_folder/scores
+        evaluator_kwargs: batch_size, num_workers, num_threads, device of evaluate.Evaluator
+    Returns:
+        TeacherScoreStore aligned with the unique paths of manifest
+    """
+    from .preprocess import teacher_view_transform
+    folder = Path(folder or Path(NS.pseudo_label_folder) / SCORE_FOLDER_NAME)
+    store = TeacherScoreStore.load(folder) if TeacherScoreStore.exists(folder) else TeacherScoreStore.empty(Manifest.from_paths_and_labels([], []))
+    store = store.align(manifest)
+    teacher_id = store.get_teacher_id(teacher)
+    stale_ids = store.get_stale_ids(teacher_id)
+    print(f"{len(stale_ids)} of {len(store)} images to score with {teacher}")
+
+    start = time.time()
+    for chunk_start in range(0, len(stale_ids), chunk_size):
+        chunk_ids = stale_ids[chunk_start:chunk_start+chunk_size]
+        evaluator = Evaluator(teacher_model, store.manifest.subset(chunk_ids), transform=teacher_view_transform, **evaluator_kwargs)
+        predictions = evaluator.run()
+        store.topk_ids[chunk_ids] = predictions.topk_ids
+        store.topk_probs[chunk_ids] = predictions.topk_probs
+        store.teacher_ids[chunk_ids] = teacher_id
+        store.save(folder)
+        print(f"scored {min(chunk_start + chunk_size, len(stale_ids))}/{len(stale_ids)}, time: {time.time() - start:.1f}s")
+    if not len(stale_ids):
+        store.save(folder) # keeps the aligned paths
+    return store
+
+
+def select_pseudo_labels(labels, confidences, threshold=None, max_per_class=None, min_per_class=None, class_num=DCFG.class_num, seed=42):
+    """Rows kept as pseudo labels: confidence >= threshold, at most max_per_class rows per class (most confident
+    first), classes with fewer than min_per_class rows are oversampled by repeating their rows
+    Returns:
+        int64 row ids, oversampled rows are repeated
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    confidences = np.asarray(confidences, dtype=np.float32)
+    kept = np.flatnonzero(confidences >= (threshold or 0))
+    rng = np.random.RandomState(seed)
+    selected = []
+    order = kept[np.lexsort((-confidences[kept], labels[kept]))] # by class, most confident first
+    class_starts = np.searchsorted(labels[order], np.arange(class_num + 1))
+    for label in range(class_num):
+        class_rows = order[class_starts[label]:class_starts[label+1]]
+        if max_per_class:
+            class_rows = class_rows[:max_per_class]
+        if min_per_class and 0 < len(class_rows) < min_per_class:
+            class_rows = np.concatenate([class_rows, rng.choice(class_rows, min_per_class - len(class_rows))])
+        selected.append(class_rows)
+    return np.concatenate(selected) if selected else np.zeros(0, dtype=np.int64)
+
+
+def write_pseudo_labels(store, row_ids, folder, teacher=''):
+    """noised.manifest of the selected store rows and stats.json in folder, returns the manifest path
+    Only hard labels are written, the soft targets of the student come from teacher_cache (NS.is_teacher_logit_cached)
+    """
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    path_table = store.manifest.path_table
+    pseudo_labels = np.asarray(store.topk_ids[row_ids, 0], dtype=np.int16)
+    manifest = Manifest.from_paths_and_labels([path_table[i] for i in row_ids.tolist()], pseudo_labels)
+    manifest.save(folder / PSEUDO_MANIFEST_NAME)
+
+    counts = np.bincount(pseudo_labels, minlength=DCFG.class_num)
+    original_labels = np.asarray(store.manifest.labels)[row_ids]
+    stats = {
+        'teacher': teacher,
+        'num_scored': len(store),
+        'num_rows': len(row_ids),
+        'num_unique_images': len(np.unique(row_ids)),
+        'agreement_with_noisy_labels': float((original_labels == pseudo_labels).mean()) if len(row_ids) else None,
+        'num_empty_classes': int((counts == 0).sum()),
+        'per_class_counts': counts.tolist(),
+    }
+    with open(folder / 'stats.json', 'w') as out_file:
+        json.dump(stats, out_file)
+    print({key: value for key, value in stats.items() if key != 'per_class_counts'})
+    return folder / PSEUDO_MANIFEST_NAME
+
+
+def load_noised_manifest(noised_txt_path=None):
+    """Manifest of the unlabeled / noised images, the converted manifest next to the txt file if there is one"""
+    from .utils import NOISED_TXT_PATH
+    noised_txt_path = noised_txt_path or NOISED_TXT_PATH
+    manifest = load_manifest_if_existing(noised_txt_path)
+    return manifest if manifest is not None else Manifest.from_txt(noised_txt_path)
+
+
+def generate_pseudo_labels(
+        teacher_ckpt_path=None,
+        teacher_model_type=None,
+        noised_manifest=None,
+        threshold=None,
+        max_per_class=None,
+        min_per_class=None,
+        is_iter_advanced=True,
+        **evaluator_kwargs
+    ):
+    """Pseudo labels of iteration NS.student_iter + 1 from the current teacher, see module docstring
+    None arguments are read from NS
+    Returns:
+        path of the next-iteration manifest
+    """
+    from .evaluate import load_eval_model
+    teacher_ckpt_path = teacher_ckpt_path or NS.teacher_ckpt_path
+    assert teacher_ckpt_path, "set NS.teacher_ckpt_path to the current teacher checkpoint"
+    threshold = NS.pseudo_label_threshold if threshold is None else threshold
+    max_per_class = max_per_class or NS.pseudo_label_max_per_class
+    min_per_class = min_per_class or NS.pseudo_label_min_per_class
+    if noised_manifest is None or not isinstance(noised_manifest, Manifest):
+        noised_manifest = load_noised_manifest(noised_manifest)
+
+    teacher = get_teacher_key(teacher_ckpt_path)
+    teacher_model = load_eval_model(teacher_ckpt_path, raw_model_type=teacher_model_type or NS.teacher_model_type)
+    store = score_manifest(teacher_model, noised_manifest, teacher, **evaluator_kwargs)
+    row_ids = select_pseudo_labels(store.topk_ids[:, 0], store.topk_probs[:, 0], threshold, max_per_class, min_per_class)
+
+    next_iter = sync_student_iter() + 1
+    manifest_path = write_pseudo_labels(store, row_ids, get_pseudo_label_folder(next_iter), teacher=teacher)
+    if is_iter_advanced:
+        NS.student_iter = next_iter
+        save_student_iter(next_iter, manifest_path)
+        print(f"NS.student_iter advanced to {next_iter}, noisy student data: {manifest_path}")
+    return manifest_path
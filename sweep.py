@@ -0,0 +1,224 @@
+# sweep.py
+import os
+import csv
+import time
+import math
+import uuid
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import date
+
+from .config import DCFG, MCFG, OCFG, NS
+CFGs = [MCFG, DCFG, OCFG, NS]
+
+"""
+Parallel hyperparameter sweeps, a process-based replacement for train.multi_train.
+
+multi_train mutates the global DCFG/MCFG/OCFG/NS classes, so two runs can not share one process. Here every config
+dict becomes an isolated RunConfig (a snapshot of the CFG classes + the overrides) that is only applied inside its own
+worker process. Workers get a fixed slice of cores (sched_setaffinity + torch threads). Read-only data (manifests,
+FeatureStores, input dicts...) passed as `shared` is loaded once in the parent and inherited copy-on-write by the
+forked workers, memory-mapped files are shared through the page cache anyway. train_trial (and distill.distill_trial)
+build their datamodules from shared={'input_data': load_shared_input_data()} instead of reading the path / label
+files again in every trial.
+
+Trials are scheduled with successive halving: every rung trains all alive trials up to the rung budget (resuming from
+their last checkpoint), then only the best 1/eta go on to the next rung with eta times more epochs.
+"""
+
+_WORKER_SHARED = None
+
+
+def get_shared():
+    """Read-only data passed to SweepRunner(shared=...), available inside trial functions"""
+    return _WORKER_SHARED
+
+
+def load_shared_input_data(data_types=None):
+    """{data type: get_input_data_and_transform_func(data type)} to pass as shared={'input_data': ...}
+    Arguments:
+        data_types: list of str, the DCFG.data_type of the trials, default [DCFG.data_type]
+    """
+    from .dataset import get_input_data_and_transform_func
+    return {data_type: get_input_data_and_transform_func(data_type) for data_type in (data_types or [DCFG.data_type])}
+
+
+def get_shared_input_data(data_type=None):
+    """Shared input data of data_type (default DCFG.data_type, ie. of the applied run config), None if not shared"""
+    shared = get_shared()
+    if not isinstance(shared, dict):
+        return None
+    return shared.get('input_data', {}).get(data_type or DCFG.data_type)
+
+
+def _update_derived_values(values, overrides):
+    """Recompute the OCFG values computed from others at class creation (see config.OCFG) when their sources are
+    overridden, eg. lr -> lr_group -> max_lr, unless the derived value is overridden too
+    """
+    ocfg = values['OCFG']
+    def is_updated(key, sources):
+        return key not in overrides and any(source in overrides for source in sources)
+    if is_updated('lr_group', ['lr']):
+        ocfg['lr_group'] = [ocfg['lr']/100, ocfg['lr']/10, ocfg['lr']]
+    if is_updated('momentum', ['optim_name']):
+        ocfg['momentum'] = 0.9 if ocfg['optim_name'] == 'SGD' else 0
+    if is_updated('schdlr_name', ['has_scheduler']):
+        ocfg['schdlr_name'] = 'OneCycleLR' if ocfg['has_scheduler'] else None
+    if is_updated('total_steps', ['has_scheduler', 'max_epochs', 'class_num', 'expected_num_per_class', 'batch_size']):
+        num_steps_per_epoch = values['DCFG']['class_num']*values['DCFG']['expected_num_per_class']//values['DCFG']['batch_size'] + 1
+        ocfg['total_steps'] = values['MCFG']['max_epochs']*num_steps_per_epoch if ocfg['has_scheduler'] else None
+    if is_updated('max_lr', ['lr', 'lr_group', 'has_differ_lr']):
+        ocfg['max_lr'] = [lr*10 for lr in ocfg['lr_group']] if ocfg['has_differ_lr'] else ocfg['lr']*10
+
+
+class RunConfig:
+    """Snapshot of the CFG classes with overrides applied, only touches the real CFG classes in apply()
+    Init Arguments:
+        sweep_id: str, part of the model version folder so the runs of two sweeps never share a folder
+    """
+    def __init__(self, name, overrides, sweep_id=''):
+        self.name = name
+        self.sweep_id = sweep_id
+        self.overrides = dict(overrides)
+        self.values = {CFG.__name__: {k: v for k, v in CFG.__dict__.items() if not k.startswith('_')} for CFG in CFGs}
+        for key, value in self.overrides.items():
+            matched_CFG_names = [CFG_name for CFG_name, values in self.values.items() if key in values]
+            assert matched_CFG_names, f"wrong argument: {key}, there's no CFG matched with it"
+            for CFG_name in matched_CFG_names:
+                self.values[CFG_name][key] = value
+        _update_derived_values(self.values, self.overrides)
+
+    def apply(self):
+        """Set the values onto the CFG classes of the current (worker) process"""
+        for CFG in CFGs:
+            for key, value in self.values[CFG.__name__].items():
+                setattr(CFG, key, value)
+
+    def __repr__(self):
+        return f"RunConfig({self.name}, {self.overrides})"
+
+
+def _init_worker(core_slots, shared):
+    global _WORKER_SHARED
+    _WORKER_SHARED = shared
+    cores = core_slots.get()
+    if hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    import torch
+    torch.set_num_threads(len(cores))
+
+
+def _run_trial(trial_fn, run_config, max_epochs, ckpt_path):
+    run_config.apply()
+    start = time.time()
+    output = trial_fn(run_config, max_epochs, ckpt_path)
+    output['run_time'] = time.time() - start
+    return output
+
+
+def train_trial(run_config, max_epochs, ckpt_path=None):
+    """Default trial: get_model + create_datamodule + single_train with the run config applied
+    Returns:
+        dict {'metric': value of MCFG.monitor, 'ckpt_path': last checkpoint to resume from}
+    """
+    from .model import get_model
+    from .dataset import create_datamodule
+    from .train import single_train
+
+    MCFG.max_epochs = max_epochs
+    MCFG.is_continued_training = ckpt_path is not None
+    MCFG.ckpt_path = ckpt_path
+    MCFG.version = f"{date.today()}.sweep_{run_config.sweep_id}_{run_config.name}"
+    MCFG.target_version_folder = MCFG.root_model_folder / MCFG.model_type / MCFG.version
+    # the function defaults were bound when the modules were imported, so pass the run config explicitly
+    model = get_model(
+        raw_model_type=MCFG.model_type,
+        is_pretrained=MCFG.is_pretrained,
+        model_class_name=MCFG.model_class_name,
+        ckpt_path=None, # weights and optimizer state are restored by resume_from_checkpoint
+        is_continued_training=False
+    )
+    datamodule = create_datamodule(is_dali_used=DCFG.is_dali_used, data_type=DCFG.data_type, input_data=get_shared_input_data())
+    trainer, model = single_train(model, datamodule, is_user_input_needed=False)
+    last_ckpt_path = MCFG.target_version_folder / "checkpoints" / "last.ckpt"
+    trainer.save_checkpoint(last_ckpt_path)
+    return {'metric': float(trainer.callback_metrics[MCFG.monitor]), 'ckpt_path': str(last_ckpt_path)}
+
+
+class SweepRunner:
+    """
+    Init Arguments:
+        trial_fn: function (run_config, max_epochs, ckpt_path) -> dict with at least 'metric' and 'ckpt_path'
+        cores_per_run: int, cores (and torch threads) of every worker
+        max_parallel_runs: int, default cpu count // cores_per_run
+        shared: any picklable / forkable read-only data, see get_shared()
+        mode: 'min' or 'max', default from MCFG.monitor
+    """
+    def __init__(self, trial_fn=train_trial, cores_per_run=4, max_parallel_runs=None, shared=None, mode=None, start_method='fork'):
+        self.trial_fn = trial_fn
+        self.cores_per_run = cores_per_run
+        num_cpus = os.cpu_count() or 1
+        self.max_parallel_runs = max_parallel_runs or max(1, num_cpus//cores_per_run)
+        self.shared = shared
+        self.mode = mode or ('min' if 'loss' in MCFG.monitor else 'max')
+        self.start_method = start_method
+        self.results = []
+
+    def _make_executor(self):
+        context = mp.get_context(self.start_method)
+        core_slots = context.Queue()
+        num_cpus = os.cpu_count() or 1
+        for slot in range(self.max_parallel_runs):
+            core_slots.put({(slot*self.cores_per_run + i) % num_cpus for i in range(self.cores_per_run)})
+        return ProcessPoolExecutor(max_workers=self.max_parallel_runs, mp_context=context, initializer=_init_worker, initargs=(core_slots, self.shared))
+
+    def run(self, config_dicts, min_epochs=1, max_epochs=MCFG.max_epochs, eta=3, results_path=None, sweep_id=None):
+        """Successive halving over config_dicts, eg. [{'lr': 1e-3}, {'lr': 5e-4, 'batch_size': 256}]
+        (lr_group / max_lr follow an lr override, see _update_derived_values)
+        Arguments:
+            sweep_id: str, default a random id, the trials are trained in {today}.sweep_{sweep_id}_{trial} versions
+        Returns:
+            list of dict rows, also written to results_path (csv) if given
+        """
+        sweep_start = time.time()
+        sweep_id = sweep_id or uuid.uuid4().hex[:8]
+        print(f"sweep {sweep_id}: {len(config_dicts)} trials")
+        run_configs = [RunConfig(f"t{i}", config_dict, sweep_id) for i, config_dict in enumerate(config_dicts)]
+        alive = {run_config.name: {'run_config': run_config, 'ckpt_path': None, 'metric': None} for run_config in run_configs}
+        num_rungs = max(1, math.ceil(math.log(max(max_epochs/min_epochs, 1), eta)) + 1)
+        self.results = []
+        with self._make_executor() as executor:
+            for rung in range(num_rungs):
+                budget = min(max_epochs, min_epochs*eta**rung)
+                futures = {
+                    executor.submit(_run_trial, self.trial_fn, trial['run_config'], budget, trial['ckpt_path']): name
+                    for name, trial in alive.items()
+                }
+                for future in as_completed(futures):
+                    name = futures[future]
+                    output = future.result()
+                    alive[name].update(metric=output['metric'], ckpt_path=output['ckpt_path'])
+                    row = {
+                        'trial': name, 'rung': rung, 'epochs': budget, 'metric': output['metric'],
+                        'run_time': output['run_time'], 'wall_clock': time.time() - sweep_start,
+                        'config': alive[name]['run_config'].overrides,
+                    }
+                    self.results.append(row)
+                    print(row)
+
+                if budget >= max_epochs or len(alive) == 1:
+                    break
+                ranked = sorted(alive, key=lambda name: alive[name]['metric'], reverse=self.mode == 'max')
+                alive = {name: alive[name] for name in ranked[:max(1, len(ranked)//eta)]}
+                print(f"rung {rung} done, keep {list(alive)}")
+
+        if results_path:
+            self.save_results(results_path)
+        return self.results
+
+    def save_results(self, results_path):
+        with open(results_path, 'w', newline='') as out_file:
+            writer = csv.DictWriter(out_file, fieldnames=list(self.results[0].keys()))
+            writer.writeheader()
+            writer.writerows(self.results)
+        print(f"sweep results saved to {results_path}")
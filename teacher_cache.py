@@ -0,0 +1,181 @@
+# teacher_cache.py
+import json
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from .dataset import YuShanDataset, NoisyStudentPipeline, BasicCustomPipeline, DaliModule, get_input_data_and_transform_func
+from .preprocess import teacher_view_transform, dali_custom_func, dali_warpaffine_transform
+from .config import DCFG, NS
+from .pseudo_label import sync_student_iter
+from .manifest import get_paths_fingerprint
+
+"""
+Offline teacher outputs for noisy student training.
+
+The teacher is frozen and its input (the raw, non augmented view) is deterministic, so its logits are computed once
+and stored memory-mapped, indexed by sample id. The student pipelines then carry sample ids instead of labels, and
+NoisyStudentDaliEffClassifier reads soft targets (and the real labels) from the cache instead of running the teacher.
+
+Cache folder layout:
+    meta.json:   {'num_samples', 'class_num', 'top_k', 'teacher', 'paths'}, written last, so an interrupted run is recomputed
+                 teacher: checkpoint path@mtime (pseudo_label.get_teacher_key), paths: fingerprint of the paths and labels
+    values.npy:  float16, [num_samples, class_num] full logits or [num_samples, top_k] top-k logits
+    indices.npy: int16, [num_samples, top_k] class indices of the top-k logits (top-k caches only)
+    labels.npy:  int16, [num_samples] real labels
+"""
+
+class TeacherLogitCache:
+    """Memory-mapped teacher logits indexed by sample id"""
+    def __init__(self, folder, mmap_mode='r'):
+        self.folder = Path(folder)
+        with open(self.folder / 'meta.json') as in_file:
+            self.meta = json.load(in_file)
+        self.class_num = self.meta['class_num']
+        self.top_k = self.meta['top_k']
+        self.values = np.load(self.folder / 'values.npy', mmap_mode=mmap_mode)
+        self.indices = np.load(self.folder / 'indices.npy', mmap_mode=mmap_mode) if self.top_k else None
+        self.labels = np.load(self.folder / 'labels.npy', mmap_mode=mmap_mode)
+
+    def __len__(self):
+        return len(self.labels)
+
+    @staticmethod
+    def is_valid(folder, num_samples, top_k, teacher, paths_fingerprint):
+        meta_path = Path(folder) / 'meta.json'
+        if not meta_path.exists():
+            return False
+        with open(meta_path) as in_file:
+            meta = json.load(in_file)
+        return (meta['num_samples'] == num_samples and meta['top_k'] == top_k and meta['teacher'] == teacher
+                and meta.get('paths') == paths_fingerprint)
+
+    @staticmethod
+    def _to_numpy_ids(ids):
+        if isinstance(ids, torch.Tensor):
+            ids = ids.detach().cpu().numpy()
+        return np.asarray(ids, dtype=np.int64).reshape(-1)
+
+    def get_logits(self, ids, device=None):
+        """Teacher logits of a batch as float32 [batch_size, class_num],
+        for top-k caches the classes outside the top-k get -inf, ie. zero probability after softmax
+        """
+        ids = self._to_numpy_ids(ids)
+        values = torch.from_numpy(np.asarray(self.values[ids], dtype=np.float32))
+        if self.top_k:
+            logits = torch.full((len(ids), self.class_num), float('-inf'))
+            logits.scatter_(1, torch.from_numpy(np.asarray(self.indices[ids], dtype=np.int64)), values)
+        else:
+            logits = values
+        return logits.to(device) if device is not None else logits
+
+    def get_labels(self, ids, device=None):
+        labels = torch.from_numpy(np.asarray(self.labels[self._to_numpy_ids(ids)], dtype=np.int64))
+        return labels.to(device) if device is not None else labels
+
+
+def get_sample_ids(paths):
+    """Map every row to the id of its unique path, oversampled rows share the same teacher output"""
+    path2id = {}
+    sample_ids = [path2id.setdefault(path, len(path2id)) for path in paths]
+    return sample_ids, list(path2id.keys())
+
+
+@torch.no_grad()
+def precompute_teacher_logits(
+        teacher_model,
+        paths,
+        labels,
+        folder,
+        top_k=NS.teacher_logit_top_k,
+        teacher='',
+        batch_size=DCFG.batch_size,
+        num_workers=DCFG.num_workers,
+        device=DCFG.device
+    ):
+    """Run the teacher once over the raw view of every path and store the logits, see module docstring
+    Arguments:
+        top_k: int or None, None stores the full logits
+        teacher: str, identifies the teacher (pseudo_label.get_teacher_key), a cache made by another teacher is recomputed,
+                 as is a cache of other paths or labels
+    """
+    folder = Path(folder)
+    paths_fingerprint = get_paths_fingerprint(paths, labels)
+    if TeacherLogitCache.is_valid(folder, len(paths), top_k, teacher, paths_fingerprint):
+        print(f'teacher logits already cached in {folder}')
+        return TeacherLogitCache(folder)
+
+    folder.mkdir(parents=True, exist_ok=True)
+    meta_path = folder / 'meta.json'
+    if meta_path.exists():
+        meta_path.unlink()
+
+    start = time.time()
+    teacher_model.eval()
+    teacher_model.to(device)
+    dataset = YuShanDataset({'image': None, 'path': paths, 'label': list(range(len(paths)))}, transform=teacher_view_transform)
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=DCFG.is_memory_pinned, shuffle=False)
+
+    values, indices = None, None
+    class_num = DCFG.class_num # replaced by the width of the teacher logits, kept for an empty input
+    for x, ids in loader:
+        logits = teacher_model(x.float().to(device)).float()
+        if values is None:
+            class_num = logits.shape[1]
+            width = top_k or class_num
+            values = np.lib.format.open_memmap(folder / 'values.npy', mode='w+', dtype=np.float16, shape=(len(paths), width))
+            if top_k:
+                indices = np.lib.format.open_memmap(folder / 'indices.npy', mode='w+', dtype=np.int16, shape=(len(paths), top_k))
+        ids = ids.numpy()
+        if top_k:
+            top_values, top_indices = torch.topk(logits, top_k, dim=1)
+            values[ids] = top_values.cpu().numpy().astype(np.float16)
+            indices[ids] = top_indices.cpu().numpy().astype(np.int16)
+        else:
+            values[ids] = logits.cpu().numpy().astype(np.float16)
+
+    if values is None: # no path, an empty cache
+        np.save(folder / 'values.npy', np.zeros((0, top_k or class_num), dtype=np.float16))
+        if top_k:
+            np.save(folder / 'indices.npy', np.zeros((0, top_k), dtype=np.int16))
+    for array in (values, indices):
+        if array is not None:
+            array.flush()
+    np.save(folder / 'labels.npy', np.asarray(labels, dtype=np.int16))
+    with open(meta_path, 'w') as out_file:
+        json.dump({'num_samples': len(paths), 'class_num': class_num, 'top_k': top_k, 'teacher': teacher, 'paths': paths_fingerprint}, out_file)
+    print(f'teacher logits of {len(paths)} samples cached in {folder}, time: {time.time() - start:.1f}s')
+    return TeacherLogitCache(folder)
+
+
+def build_teacher_logit_cache(teacher_model, input_dict, folder, **kwargs):
+    """Returns (input dict whose labels are sample ids, TeacherLogitCache)"""
+    sample_ids, unique_paths = get_sample_ids(input_dict['path'])
+    unique_labels = np.zeros(len(unique_paths), dtype=np.int16)
+    unique_labels[sample_ids] = np.asarray(input_dict['label'], dtype=np.int16)
+    cache = precompute_teacher_logits(teacher_model, unique_paths, unique_labels, folder, **kwargs)
+    return {**input_dict, 'label': sample_ids}, cache
+
+
+def create_cached_teacher_datamodule(
+        student_model,
+        teacher_model,
+        cache_folder=NS.teacher_logit_cache_folder,
+        is_for_testing=False,
+        **kwargs
+    ):
+    """Precompute the teacher logits of the noisy student train / valid data, attach them to the student
+    and return a datamodule whose pipelines only produce the augmented view and sample ids
+    kwargs: passed to precompute_teacher_logits, eg. top_k, teacher
+    """
+    cache_folder = Path(cache_folder) / f'iter{sync_student_iter()}'
+    train_input_dict, valid_input_dict, _ = get_input_data_and_transform_func('noisy_student', is_for_testing=is_for_testing)
+    train_input_dict, train_cache = build_teacher_logit_cache(teacher_model, train_input_dict, cache_folder / 'train', **kwargs)
+    valid_input_dict, valid_cache = build_teacher_logit_cache(teacher_model, valid_input_dict, cache_folder / 'valid', **kwargs)
+    student_model.set_teacher_logit_cache(train_cache, valid_cache)
+
+    train_pipeline = NoisyStudentPipeline(train_input_dict, custom_func=dali_custom_func, warpaffine_transform=dali_warpaffine_transform, is_raw_output=False)
+    valid_pipeline = BasicCustomPipeline(valid_input_dict, custom_func=dali_custom_func, phase='valid')
+    return DaliModule(train_pipeline, valid_pipeline)
@@ -0,0 +1,184 @@
+# telemetry.py
+import time
+import multiprocessing as mp
+from contextlib import contextmanager
+
+"""
+Data-loader telemetry, is the loader or the model the bottleneck?
+
+InstrumentedLoader wraps any train / val loader (torch DataLoader or DALIGenericIterator) and times every next() call,
+ie. how long the training loop waits for a batch. The datamodules of dataset.py return instrumented loaders feeding
+LOADER_STATS when DCFG.is_loader_instrumented is set, callbacks.LoaderTelemetryCallback adds the step (compute) time,
+images/sec and, for multi-process torch DataLoaders, how many batches are already waiting in the prefetch queue,
+and logs it all to the TensorBoardLogger.
+
+AugmentTimer sums per-stage augmentation time over the DataLoader worker processes through shared memory,
+it is created at import, so the workers have to be forked (the default on linux) to share it.
+"""
+
+def _get_batch_size(batch):
+    """Number of images of a batch: (x, y) tuples, dicts, or DALI outputs (a list of dicts, one per device)"""
+    if hasattr(batch, 'shape'):
+        return int(batch.shape[0]) if len(batch.shape) else 0
+    if isinstance(batch, dict):
+        return _get_batch_size(next(iter(batch.values()))) if batch else 0
+    if isinstance(batch, (list, tuple)) and batch:
+        if isinstance(batch[0], dict):
+            return sum(_get_batch_size(device_batch) for device_batch in batch)
+        return _get_batch_size(batch[0])
+    return 0
+
+
+def _get_prefetch_state(iterator):
+    """(ready batches, prefetch capacity) of a multi-process torch DataLoader iterator, None for other loaders"""
+    num_workers = getattr(iterator, '_num_workers', 0)
+    data_queue = getattr(iterator, '_data_queue', None)
+    if not num_workers or data_queue is None:
+        return None
+    try:
+        num_ready = data_queue.qsize()
+    except NotImplementedError: # macOS
+        return None
+    return num_ready, num_workers*getattr(iterator, '_prefetch_factor', 2)
+
+
+class LoaderStats:
+    """Wait / step time and images of one phase ('train' or 'val') in the current epoch"""
+    def __init__(self, phase):
+        self.phase = phase
+        self.reset()
+
+    def reset(self):
+        self.num_batches = 0
+        self.num_images = 0
+        self.wait_time = 0.0
+        self.step_time = 0.0
+        self.last_wait_time = 0.0
+        self.num_ready_sum = 0
+        self.num_ready_count = 0
+        self.prefetch_capacity = None
+        self.start_time = None
+        self.end_time = None
+
+    def add_wait(self, start_time, wait_time, num_images, prefetch_state):
+        if self.start_time is None:
+            self.start_time = start_time
+        self.num_batches += 1
+        self.num_images += num_images
+        self.wait_time += wait_time
+        self.last_wait_time = wait_time
+        if prefetch_state is not None:
+            self.num_ready_sum += prefetch_state[0]
+            self.num_ready_count += 1
+            self.prefetch_capacity = prefetch_state[1]
+
+    def add_step(self, step_time):
+        self.step_time += step_time
+        self.end_time = time.perf_counter()
+
+    def summary(self):
+        elapsed = (self.end_time - self.start_time) if self.start_time and self.end_time else 0.0
+        num_batches = max(1, self.num_batches)
+        return {
+            'batches': self.num_batches,
+            'images': self.num_images,
+            'images_per_sec': self.num_images/elapsed if elapsed else 0.0,
+            'wait_ms': 1000*self.wait_time/num_batches,
+            'step_ms': 1000*self.step_time/num_batches,
+            'wait_fraction': self.wait_time/elapsed if elapsed else 0.0,
+            'queue_ready': self.num_ready_sum/self.num_ready_count if self.num_ready_count else None,
+            'queue_capacity': self.prefetch_capacity,
+        }
+
+
+LOADER_STATS = {'train': LoaderStats('train'), 'val': LoaderStats('val')} # of this process, every DDP rank has its own
+
+
+class InstrumentedLoader:
+    """Iterable wrapper timing every next() of the wrapped loader, everything else is delegated to it"""
+    def __init__(self, loader, stats):
+        self.loader = loader
+        self.stats = stats
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __getattr__(self, name):
+        if name in ('loader', 'stats'):
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def __iter__(self):
+        iterator = iter(self.loader)
+        while True:
+            prefetch_state = _get_prefetch_state(iterator)
+            start = time.perf_counter()
+            try:
+                batch = next(iterator)
+            except StopIteration:
+                return
+            self.stats.add_wait(start, time.perf_counter() - start, _get_batch_size(batch), prefetch_state)
+            yield batch
+
+
+class AugmentTimer:
+    """Per-stage augmentation time summed over every DataLoader worker process
+    Usage:
+        with AUGMENT_TIMER.time('resize'):
+            image = cv2.resize(image, size)
+        with AUGMENT_TIMER.time('resize', count=len(images)): # batched stage, counted per image
+            images = resize_batch(images)
+    Timing is off (a no-op) until enable() is called, the shared memory is only allocated then (with
+    DCFG.is_loader_instrumented, see dataset.instrument_loader), before the DataLoader workers are forked.
+    """
+    def __init__(self, stage_names):
+        self.stage_names = list(stage_names)
+        self._stage_ids = {stage_name: i for i, stage_name in enumerate(self.stage_names)}
+        self._values = None # mp.Array [seconds of every stage, counts of every stage]
+        self._is_enabled = None # mp.Value, shared with the workers
+
+    def enable(self, is_enabled=True):
+        if self._is_enabled is None:
+            if not is_enabled:
+                return
+            self._values = mp.Array('d', 2*len(self.stage_names))
+            self._is_enabled = mp.Value('b', False, lock=False)
+        self._is_enabled.value = is_enabled
+
+    @property
+    def is_enabled(self):
+        return self._is_enabled is not None and bool(self._is_enabled.value)
+
+    @contextmanager
+    def time(self, stage_name, count=1):
+        if self._is_enabled is None or not self._is_enabled.value:
+            yield
+            return
+        start = time.perf_counter()
+        yield
+        self.add(stage_name, time.perf_counter() - start, count)
+
+    def add(self, stage_name, seconds, count=1):
+        i = self._stage_ids[stage_name]
+        with self._values.get_lock():
+            self._values[i] += seconds
+            self._values[len(self.stage_names) + i] += count
+
+    def get_stats(self):
+        """{stage name: {'count', 'total_s', 'mean_ms'}} of the stages that ran, mean_ms is per image"""
+        if self._values is None:
+            return {}
+        with self._values.get_lock():
+            values = list(self._values)
+        num_stages = len(self.stage_names)
+        return {
+            stage_name: {'count': int(values[num_stages + i]), 'total_s': values[i], 'mean_ms': 1000*values[i]/values[num_stages + i]}
+            for i, stage_name in enumerate(self.stage_names) if values[num_stages + i]
+        }
+
+    def reset(self):
+        if self._values is None:
+            return
+        with self._values.get_lock():
+            for i in range(len(self._values)):
+                self._values[i] = 0.0
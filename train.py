@@ -4,17 +4,63 @@ from pytorch_lightning.loggers import TensorBoardLogger
 from pytorch_lightning.callbacks import ModelCheckpoint
 
 from .model import get_model
-from .config import DCFG, MCFG, OCFG, NS
+from .dataset import create_datamodule
+from .teacher_cache import create_cached_teacher_datamodule
+from .pseudo_label import get_teacher_key
+from .config import DCFG, MCFG, OCFG, NS, init_config
 CFGs = [MCFG, DCFG, OCFG, NS]
 from .utils import ConfigHandler
+from .callbacks import CPUThreadsCallback, ProfilerCallback, LoaderTelemetryCallback, CheckpointCatalogCallback
+from .averaging import EMACallback
+from .preprocess import AUGMENT_TIMER
+
+def is_cpu_ddp_used():
+    return bool(MCFG.num_cpu_processes) and MCFG.num_cpu_processes > 1
+
+def _get_device_kwargs():
+    """Trainer device arguments: CPU DDP (gloo backend) when MCFG.num_cpu_processes > 1, else gpus + apex"""
+    if is_cpu_ddp_used():
+        return {
+            'accelerator': 'ddp_cpu',
+            'num_processes': MCFG.num_cpu_processes,
+        }
+    return {
+        'gpus': MCFG.gpus, 
+        'precision': MCFG.precision if MCFG.is_apex_used else None,
+        'amp_level': MCFG.amp_level if MCFG.is_apex_used else None,
+    }
+
+def _get_device_callbacks():
+    if is_cpu_ddp_used() or MCFG.num_threads_per_process:
+        return [CPUThreadsCallback(MCFG.num_threads_per_process, max(1, MCFG.num_cpu_processes))]
+    return []
+
+def _get_profiling_callbacks():
+    if not MCFG.is_profiled:
+        return []
+    return [ProfilerCallback(
+        MCFG.target_version_folder / "profiler", 
+        skip_first=MCFG.profile_skip_first, 
+        warmup=MCFG.profile_warmup, 
+        active=MCFG.profile_active
+    )]
+
+def _get_telemetry_callbacks():
+    if not DCFG.is_loader_instrumented:
+        return []
+    return [LoaderTelemetryCallback(log_every_n_steps=MCFG.log_every_n_steps, augment_timer=AUGMENT_TIMER)]
+
+def _get_averaging_callbacks(dirpath=None):
+    if not MCFG.ema_decay:
+        return []
+    return [EMACallback(MCFG.ema_decay, every_n_steps=MCFG.ema_every_n_steps, dirpath=dirpath)]
 
 def single_train(model, datamodule, is_for_testing=False, is_user_input_needed=True):
     if is_for_testing:
         trainer = pl.Trainer(
             max_epochs=MCFG.max_epochs, 
-            gpus=MCFG.gpus, 
-            precision=MCFG.precision if MCFG.is_apex_used else None,
-            amp_level=MCFG.amp_level if MCFG.is_apex_used else None,        
+            callbacks=_get_averaging_callbacks() + _get_device_callbacks() + _get_profiling_callbacks() + _get_telemetry_callbacks(),
+            **_get_device_kwargs()
         )
     else:
         ConfigHandler.save_config(CFGs, folder=MCFG.target_version_folder, model=model, is_user_input_needed=is_user_input_needed)
@@ -31,13 +77,11 @@ def single_train(model, datamodule, is_for_testing=False, is_user_input_needed=T
         trainer = pl.Trainer(
             logger=logger,        
             max_epochs=MCFG.max_epochs, 
-            gpus=MCFG.gpus, 
-            precision=MCFG.precision if MCFG.is_apex_used else None,
-            amp_level=MCFG.amp_level if MCFG.is_apex_used else None,
             log_every_n_steps=MCFG.log_every_n_steps, 
             flush_logs_every_n_steps=MCFG.log_every_n_steps,
-            callbacks=[checkpoint_callback],
-            resume_from_checkpoint=MCFG.ckpt_path if MCFG.is_continued_training else None
+            callbacks=[checkpoint_callback, CheckpointCatalogCallback()] + _get_averaging_callbacks(MCFG.target_version_folder / "checkpoints") + _get_device_callbacks() + _get_profiling_callbacks() + _get_telemetry_callbacks(),
+            resume_from_checkpoint=MCFG.ckpt_path if MCFG.is_continued_training else None,
+            **_get_device_kwargs()
         )
 
     trainer.fit(model, datamodule=datamodule)
@@ -48,6 +92,7 @@ def multi_train(config_dicts, model_classes, datamodules):
     Arguments:
         configs: list, a list of config dict, eg. [{'batch_size': 128}, {'batch_size': 256}]
         model_classes: list, a list of model class, eg. [DaliClassifier, YushanClassifier]
+    Runs one config after another in this process, see sweep.SweepRunner for parallel, isolated runs
     """
     assert len(config_dicts) == len(datamodules) == len(model_classes), "unmatched input numbers"    
     for config_dict, Model, datamodule in zip(config_dicts, model_classes, datamodules):
@@ -56,8 +101,14 @@ def multi_train(config_dicts, model_classes, datamodules):
         single_train(model, datamodule, is_user_input_needed=False)
 
         
-def train():
+def train(is_user_input_needed=True):
+    init_config(is_user_input_needed)
     model = get_model()        
-    datamodule = create_datamodule()
+    if DCFG.data_type == 'noisy_student' and NS.is_teacher_logit_cached:
+        teacher_model = get_model(raw_model_type=NS.teacher_model_type, model_class_name='DaliEffClassifier', ckpt_path=NS.teacher_ckpt_path, is_continued_training=False)
+        datamodule = create_cached_teacher_datamodule(model, teacher_model, top_k=NS.teacher_logit_top_k, teacher=get_teacher_key(NS.teacher_ckpt_path))
+        del teacher_model # the teacher is not needed during training anymore
+    else:
+        datamodule = create_datamodule()
     trainer, model = single_train(model, datamodule)    
     return model, trainer, datamodule
\ No newline at end of file
@@ -0,0 +1,167 @@
+# tta.py
+import os
+import csv
+import time
+
+import cv2
+import numpy as np
+import torch
+
+from .augment import CROP_SIZE, _center_crop, to_tensor_batch
+from .border import REPLICATE, WRAP, pad_image
+from .preprocess import _calculate_dhdw_half
+
+"""
+Test-time augmentation: K views per image, every view of every image in one batched forward, aggregated logits.
+
+A view is (border mode, resize size, rot90 k), the inference view of preprocess.preprocess is (replicate, 248, 0):
+    border to a square -> resize to size x size -> center crop 224 -> np.rot90 k times
+DEFAULT_VIEWS cover the known failure modes of the training augmentation: the ±90° rotations of the DALI pipelines,
+the wrap border of DCFG.transform_approach and the random resize (224~320) before the crop.
+
+TTAPredictor runs the base view on the whole batch first, and only the images whose confidence (max softmax) is below
+confidence_threshold get the other views, at most max_tta_fraction of the batch (the least confident ones), so the
+cost is bounded. make_tta_report compares the accuracy and the images/sec of plain inference and of every threshold.
+"""
+
+BASE_VIEW = (REPLICATE, 248, 0)
+DEFAULT_VIEWS = [
+    BASE_VIEW,
+    (REPLICATE, 248, 1), # 90°
+    (REPLICATE, 248, 3), # -90°
+    (WRAP, 248, 0),
+    (REPLICATE, 272, 0), # scale jitter
+    (REPLICATE, 232, 0),
+]
+
+
+def make_views(image, views=DEFAULT_VIEWS):
+    """uint8 RGB [H, W, C] image -> uint8 [K, 224, 224, C], one crop per view, the padded image is shared by the views
+    with the same border mode
+    """
+    dh_half, dw_half = _calculate_dhdw_half(*image.shape[:2])
+    padded = {}
+    crops = []
+    for mode, size, k in views:
+        if mode not in padded:
+            padded[mode] = pad_image(image, dh_half, dh_half, dw_half, dw_half, mode)
+        crop = _center_crop(cv2.resize(padded[mode], (size, size)), CROP_SIZE)
+        crops.append(np.rot90(crop, k) if k else crop)
+    return np.stack(crops)
+
+def views_to_tensor(views):
+    """uint8 [N, 224, 224, C] -> float [N, C, 224, 224] in 0~1, same values as preprocess.preprocess (NHWC in memory)"""
+    return to_tensor_batch(views, scale=None).div_(255.0)
+
+
+class TTAPredictor:
+    """
+    Init Arguments:
+        model: callable [N, C, H, W] -> logits, eg. an eval classifier or a compiled.CompiledModel
+        views: list of (border mode, resize size, rot90 k), the first one is the base view
+        confidence_threshold: float, images whose base view confidence is below get all views, None: every image, 0: none
+        max_tta_fraction: float, at most this fraction of a batch gets all views (the least confident first), None: no cap
+        aggregate: 'logits' (mean logits) or 'probs' (mean softmax)
+        max_batch_size: int, largest forward batch, the views of many images are chunked
+    """
+    def __init__(self, model, views=DEFAULT_VIEWS, confidence_threshold=0.8, max_tta_fraction=None, aggregate='logits', max_batch_size=128, device='cpu'):
+        assert aggregate in ('logits', 'probs'), "aggregate should be 'logits' or 'probs'"
+        self.model = model
+        self.views = list(views)
+        self.confidence_threshold = confidence_threshold
+        self.max_tta_fraction = max_tta_fraction
+        self.aggregate = aggregate
+        self.max_batch_size = max_batch_size
+        self.device = device
+        self.stats = {'images': 0, 'tta_images': 0, 'forward_images': 0}
+
+    def _forward(self, x):
+        with torch.no_grad():
+            return torch.cat([self.model(chunk.to(self.device)).float().cpu() for chunk in torch.split(x, self.max_batch_size)])
+
+    def _select_tta_ids(self, confidences):
+        if self.confidence_threshold is None:
+            ids = np.arange(len(confidences))
+        else:
+            ids = np.flatnonzero(confidences < self.confidence_threshold)
+        if self.max_tta_fraction is not None:
+            max_num = int(self.max_tta_fraction*len(confidences))
+            ids = ids[np.argsort(confidences[ids], kind='stable')[:max_num]]
+        return np.sort(ids)
+
+    def predict_batch(self, images):
+        """
+        Arguments:
+            images: list of uint8 RGB [H, W, C] images
+        Returns:
+            predictions int64 [N], confidences float [N], is_tta bool [N], aggregated logits float tensor [N, num_classes]
+        """
+        base_views = np.stack([make_views(image, self.views[:1])[0] for image in images])
+        logits = self._forward(views_to_tensor(base_views))
+        confidences = torch.softmax(logits, dim=1).max(dim=1)[0].numpy()
+        tta_ids = self._select_tta_ids(confidences) if len(self.views) > 1 else np.array([], dtype=np.int64)
+
+        if len(tta_ids):
+            num_extra_views = len(self.views) - 1
+            extra_views = np.concatenate([make_views(images[i], self.views[1:]) for i in tta_ids])
+            extra_logits = self._forward(views_to_tensor(extra_views)).view(len(tta_ids), num_extra_views, -1)
+            all_logits = torch.cat([logits[torch.as_tensor(tta_ids)].unsqueeze(1), extra_logits], dim=1)
+            if self.aggregate == 'probs':
+                # mean probs, kept as log probs so the argmax / softmax of the output stay meaningful
+                aggregated = torch.log(torch.softmax(all_logits, dim=2).mean(dim=1))
+            else:
+                aggregated = all_logits.mean(dim=1)
+            logits[torch.as_tensor(tta_ids)] = aggregated
+            self.stats['forward_images'] += len(extra_views)
+
+        probs = torch.softmax(logits, dim=1)
+        confidences, predictions = probs.max(dim=1)
+        is_tta = np.zeros(len(images), dtype=bool)
+        is_tta[tta_ids] = True
+        self.stats['images'] += len(images)
+        self.stats['tta_images'] += len(tta_ids)
+        self.stats['forward_images'] += len(images)
+        return predictions.numpy(), confidences.numpy(), is_tta, logits
+
+
+def make_tta_report(model, image_paths, labels, thresholds=(0.5, 0.8, 0.95, None), views=DEFAULT_VIEWS, batch_size=64, output_path=None, device='cpu'):
+    """Accuracy gain against throughput cost: plain inference (base view only), then TTA with every confidence
+    threshold (None: TTA on every image)
+    Returns:
+        list of row dicts
+    """
+    from .utils import ImageReader
+    labels = np.asarray(labels, dtype=np.int64)
+    images = [ImageReader.read_image_RGB_cv2(str(path)) for path in image_paths] # decoded once, not part of the timing
+
+    settings = [('no_tta', [views[0]], 0)] + [(f"tta_threshold_{threshold}", views, threshold) for threshold in thresholds]
+    rows = []
+    for name, setting_views, threshold in settings:
+        predictor = TTAPredictor(model, setting_views, confidence_threshold=threshold, device=device)
+        predictions = []
+        start = time.perf_counter()
+        for i in range(0, len(images), batch_size):
+            predictions.append(predictor.predict_batch(images[i:i+batch_size])[0])
+        elapsed = time.perf_counter() - start
+        predictions = np.concatenate(predictions)
+        rows.append({
+            'setting': name,
+            'views': len(setting_views),
+            'acc': float((predictions == labels).mean()),
+            'tta_fraction': predictor.stats['tta_images']/max(1, predictor.stats['images']),
+            'forward_images_per_image': predictor.stats['forward_images']/max(1, predictor.stats['images']),
+            'images_per_sec': len(images)/elapsed,
+        })
+    base_acc, base_speed = rows[0]['acc'], rows[0]['images_per_sec']
+    print(f"{'setting':<26}{'acc':>8}{'gain':>8}{'tta %':>8}{'img/s':>9}{'cost':>7}")
+    for row in rows:
+        row['acc_gain'] = row['acc'] - base_acc
+        row['slowdown'] = base_speed/row['images_per_sec']
+        print(f"{row['setting']:<26}{row['acc']:>8.4f}{row['acc_gain']:>+8.4f}{100*row['tta_fraction']:>7.1f}%{row['images_per_sec']:>9.1f}{row['slowdown']:>6.2f}x")
+    if output_path:
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        with open(output_path, 'w', newline='') as out_file:
+            writer = csv.DictWriter(out_file, fieldnames=list(rows[0]))
+            writer.writeheader()
+            writer.writerows(rows)
+    return rows
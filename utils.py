@@ -1,4 +1,3 @@
-import matplotlib.pyplot as plt
 import cv2
 from PIL import Image
 import time
@@ -6,14 +5,18 @@ import re
 import os
 import shutil
 import numpy as np
-import pandas as pd
 from pathlib import Path
 import json
-import torch
-from tensorboard.backend.event_processing import event_accumulator
+from functools import lru_cache
+
+from .manifest import Manifest, load_manifest_if_existing, ManifestBuilder
+from .filescan import ImageFolderScanner
+from .metrics_index import get_metrics_index
+from .ckpt_catalog import CheckpointCatalog, find_nearest_ckpt
 
 # please see #TODO
-ROOT = "/content/gdrive/MyDrive/SideProject/YushanChineseWordClassification"
+# matplotlib and pandas are imported in the functions using them, they are slow to import and not needed for predicting
+ROOT = os.environ.get("YUSHAN_ROOT", "/content/gdrive/MyDrive/SideProject/YushanChineseWordClassification")
 
 
 class ImageReader:
@@ -33,6 +36,7 @@ class ImageReader:
 
     @classmethod
     def read_and_show_image(cls, path):
+        import matplotlib.pyplot as plt
         img = cv2.imread(path)
         plt.imshow(img)
         plt.show()
@@ -176,10 +180,22 @@ class FileHandler:
 
     @classmethod
     def read_path_and_label_from_txt(cls, txt_path):
-        with open(txt_path) as in_file:
-            lines = in_file.readlines()
-            paths, labels = zip(*[[line.split(' ')[0], line.split(' ')[1].rstrip()] for line in lines])
-        return paths, labels
+        """Returns (paths, labels) as (list[str], list[int])"""
+        with open(txt_path, encoding='utf-8') as in_file:
+            rows = [line.rsplit(' ', 1) for line in in_file.read().splitlines() if line] # label is after the last space, paths may contain spaces
+        return [row[0] for row in rows], [int(row[1]) for row in rows]
+
+    @classmethod
+    def read_path_and_label(cls, txt_path):
+        """Read from the converted manifest (see manifest.py) if there is one next to the txt file, else from the txt file
+        Returns:
+            (paths, labels) as (Sequence[str], list[int]): a list of paths for txt files, a lazy manifest.ManifestPaths
+            view for manifests (indexable, sliceable, + gives a list), int labels in both cases
+        """
+        manifest = load_manifest_if_existing(txt_path)
+        if manifest is not None:
+            return manifest.to_paths_and_labels()
+        return cls.read_path_and_label_from_txt(txt_path)
 
     @classmethod
     def get_word_classes_dict(cls, training_data_dict_path=ROOT+"/data_txt/training data dic.txt"):
@@ -196,6 +212,7 @@ class FileHandler:
             df_all_path=ROOT+'/all_data.csv', 
             df_revised_path=ROOT+'/df_revised.csv', 
             df_checked_path=ROOT+'/df_checked.csv'):
+        import pandas as pd
         df_all = pd.read_csv(df_all_path)
         df_revised = pd.read_csv(df_revised_path)
         df_checked = pd.read_csv(df_checked_path)
@@ -217,12 +234,18 @@ class FileHandler:
                 train_txt_path = ROOT + '/data_txt/cleaned_train_balanced_images.txt'
 
         valid_txt_path = valid_txt_path or ROOT + '/data_txt/valid_balanced_images.txt'
-        train_image_paths, train_int_labels = cls.read_path_and_label_from_txt(train_txt_path)
-        valid_image_paths, valid_int_labels = cls.read_path_and_label_from_txt(valid_txt_path)
+        train_image_paths, train_int_labels = cls.read_path_and_label(train_txt_path)
+        valid_image_paths, valid_int_labels = cls.read_path_and_label(valid_txt_path)
         return train_image_paths, train_int_labels, valid_image_paths, valid_int_labels
     
     @classmethod
     def get_second_source_data(cls):
+        train_manifest = load_manifest_if_existing(ROOT + '/new_data_train.csv')
+        valid_manifest = load_manifest_if_existing(ROOT + '/new_data_valid.csv')
+        if train_manifest is not None and valid_manifest is not None:
+            return (*train_manifest.to_paths_and_labels(), *valid_manifest.to_paths_and_labels())
+
+        import pandas as pd
         df_train = pd.read_csv(ROOT + '/new_data_train.csv')
         df_valid = pd.read_csv(ROOT + '/new_data_valid.csv')
         
@@ -233,88 +256,36 @@ class FileHandler:
         return train_image_paths, train_int_labels, valid_image_paths, valid_int_labels
 
     @classmethod
-    def _make_raw_df_once(cls):
+    def _make_raw_df_once(cls, index_path=ROOT+'/data_txt/raw_file_index.pkl', num_workers=16, is_dir_mtime_trusted=True):
+        """Scan YuShanTrain and train into a path, label df. Only added / changed files are processed after the first run, see ImageFolderScanner"""
         root_paths = [ROOT + '/YuShanTrain', ROOT + '/train']
-        image_paths = []
-        labels = []
-        for root_path in root_paths:
-            for root, _, files in os.walk(root_path):
-                for file in files:
-                    re_result = re.search("[\u4e00-\u9fa5]{1}", file)
-                    if re_result and 'modified' not in file:
-                        labels.append(re_result.group(0))
-                        image_paths.append(os.path.join(root, file)) 
-            
-        df_all = pd.DataFrame(list(zip(image_paths, labels)), columns = ['path', 'label'])
+        scanner = ImageFolderScanner(root_paths, index_path=index_path, num_workers=num_workers, is_dir_mtime_trusted=is_dir_mtime_trusted)
+        scanner.scan()
+        df_all = scanner.get_df()
         return df_all
     
     @classmethod
-    def _average_copy_grouped_df_func(cls, gp_df):
-            num = gp_df.shape[0]
-            gp_df = pd.concat([gp_df]*(100//num+1))
-            return gp_df
-    
-    @classmethod
-    def _make_raw_train_data_txt_once(cls):
-        df_all, df_revised, df_checked = cls.load_target_dfs()
-        valid_txt_path = ROOT + '/data_txt/valid_balanced_images.txt'
-        valid_image_paths, valid_int_labels = cls.read_path_and_label_from_txt(valid_txt_path)
-        df_train_not_null = df_all[~df_all['path'].isin(valid_image_paths)].groupby('label').apply(cls._average_copy_grouped_df_func).reset_index(drop=True).groupby('label').sample(100)
-        df_train_null = df_revised[(df_revised['label'] == 'isnull') & 
-                            (~df_revised['path'].isin(df_valid_null['path']))]
-        df_train = df_train_not_null.append(df_train_null, ignore_index=True)
-
-        raw_train_image_paths, raw_train_int_labels = df_train['path'].to_list(), df_train['int_label'].to_list()
-        
-        raw_train_txt_path = ROOT + '/data_txt/raw_train_balanced_images.txt'
-        cls.save_paths_and_labels_as_txt(raw_train_txt_path, raw_train_image_paths, raw_train_int_labels)
-
-    @classmethod
-    def _make_mixed_train_valid_data_txt_once(cls):
-        """Call only once to make half raw half cleaned data txt """
-        
-        df_all, df_revised, df_checked = cls.load_target_dfs()
-        
-        not_null_cond = (df_revised['is_deleted'] == False) & (df_revised['label'] != 'isnull')
-        null_cond = df_revised['label'] == 'isnull'
-        df_valid_not_null = df_revised[not_null_cond].groupby('label').sample(12)
-        df_valid_null = df_revised[null_cond].sample(50)
-        df_valid = df_valid_not_null.append(df_valid_null, ignore_index=True)
-        
-        valid_image_paths, valid_int_labels = df_valid['path'].to_list(), df_valid['int_label'].to_list()
-        
-        df_train_not_null_raw = df_all[~df_all['path'].isin(df_checked['path'])]
-        df_train_not_null_revised = df_revised[(not_null_cond) & (~df_revised['path'].isin(valid_image_paths))]        
-        
-        df_train_not_null = df_train_not_null_raw.append(df_train_not_null_revised, ignore_index=True)
-        df_train_not_null = df_train_not_null.groupby('int_label').apply(cls._average_copy_grouped_df_func).reset_index(drop=True).groupby('label').sample(100)
-        df_train_null = df_revised[(df_revised['label'] == 'isnull') & 
-                                      (~df_revised['path'].isin(df_valid_null['path']))]
-
-        df_train = df_train_not_null.append(df_train_null, ignore_index=True)
-        
-        train_image_paths, train_int_labels = df_train['path'].to_list(), df_train['int_label'].to_list()
-
-        valid_txt_path = ROOT + '/data_txt/valid_balanced_images.txt'
-        cls.save_paths_and_labels_as_txt(valid_txt_path, valid_image_paths, valid_int_labels)
-
-        train_txt_path = ROOT + '/data_txt/mixed_train_balanced_images.txt'
-        cls.save_paths_and_labels_as_txt(train_txt_path, train_image_paths, train_int_labels)
-
-    @classmethod
-    def _make_cleaned_data_once(cls):
-        valid_txt_path = ROOT + '/data_txt/valid_balanced_images.txt'
-        valid_image_paths, valid_int_labels = cls.read_path_and_label_from_txt(valid_txt_path)
-        df_all, df_revised, df_checked = cls.load_target_dfs()
-
-        not_null_cond = (df_revised['is_deleted'] == False) & (df_revised['label'] != 'isnull')
-        null_cond = df_revised['label'] == 'isnull'
-        df_clean_not_null = df_revised[(~df_revised['path'].isin(valid_image_paths)) & not_null_cond].groupby('label').sample(60, replace=True)
-        df_clean_null = df_revised[(~df_revised['path'].isin(valid_image_paths)) & null_cond]
-        df_clean = df_clean_null.append(df_clean_not_null, ignore_index=True)
-        clean_image_paths, clean_int_labels = df_clean['path'].to_list(), df_clean['int_label'].to_list()
-        clean_txt_path = ROOT + '/data_txt/cleaned_train_balanced_images.txt'
-        cls.save_paths_and_labels_as_txt(clean_txt_path, clean_image_paths, clean_int_labels)
+    def _make_manifests_once(cls, seed=42, chunksize=200_000,
+            df_all_path=ROOT+'/all_data.csv', 
+            df_revised_path=ROOT+'/df_revised.csv', 
+            df_checked_path=ROOT+'/df_checked.csv',
+            output_folder=ROOT+'/data_txt',
+            dedup_folder=None,
+            dedup_radius=4,
+            is_conflict_dropped=False):
+        """Call only once to make valid / raw / mixed / cleaned / noised train data (manifest + txt), see ManifestBuilder
+        dedup_folder: hash store of all_data.csv (see dedup.py), near duplicates within dedup_radius are dropped,
+                      one image of every cluster is kept (none of the clusters with different labels if is_conflict_dropped)
+        """
+        excluded_paths = None
+        if dedup_folder:
+            from .manifest import Manifest
+            from .dedup import hash_manifest, find_duplicate_clusters, get_duplicate_paths
+            store = hash_manifest(Manifest.from_csv(df_all_path), dedup_folder)
+            excluded_paths = get_duplicate_paths(store, find_duplicate_clusters(store, dedup_radius), is_conflict_dropped)
+        builder = ManifestBuilder(df_all_path, df_revised_path, df_checked_path, output_folder, seed=seed, chunksize=chunksize, excluded_paths=excluded_paths)
+        outputs = builder.build()
+        return outputs, builder.timings
 
 
 
@@ -338,74 +309,38 @@ class ModelFileHandler:
                     
     @classmethod
     def get_best_metrics_record(cls, folder, target_metric="val_loss", record_num=0, is_process_showed=False):
-        """Get best metrics from tensorboard files
+        """Get best metrics from tensorboard files, through the metrics index of the model root (see metrics_index.py)
         Arguments:
+            folder: str or Path, version folder, root_model_folder/model_type/version
             target_metric: str, "val_acc" or "val_loss"
-            record_num: int, 0 stands for loading all records into memory, may OOM. 1 stands for 1 record
+            record_num: int, not used anymore, the index keeps every record on disk
+        Returns:
+            best value, record str, epoch
         """
         if isinstance(folder, str):
             folder = Path(folder)
         assert "acc" in target_metric or "loss" in target_metric, "target_metric should be accuracy or loss"
-
-        desired_metrics = ["train_epoch_acc", "val_epoch_acc", "train_acc_epoch", "val_acc_epoch", "train_loss_epoch", "val_loss_epoch", "epoch"] # 前兩項為舊紀錄之兼容
-        def _get_best_target_metric_record(record_list):
-            if "acc" in target_metric:
-                return sorted(record_list, key=lambda record: record.value)[-1]
-            elif "loss" in target_metric:
-                return sorted(record_list, key=lambda record: record.value)[0]
-
-        def _get_matched_record(record_list, step):            
-            return [record for record in record_list if record.step == step][0]
-
-        trn_val, l_acc = target_metric.split("_")     
-        best_target_metrics = []
-        matched_metrics = {k:[] for k in desired_metrics}
-        for path in folder.glob("**/*tfevent*"):
-            ea = event_accumulator.EventAccumulator(str(path), size_guidance={event_accumulator.SCALARS:record_num})
-            ea.Reload()
-            metrics_keys = ea.scalars.Keys()
-            matched_target_metric = [key for key in metrics_keys if re.search("(%s){1}_(%s){1}_(epoch){1}"%(trn_val, l_acc), key) or re.search("(%s){1}_(epoch){1}_(%s){1}"%(trn_val, l_acc), key)]
-            matched_target_metric = matched_target_metric[0] if matched_target_metric else None            
-            if is_process_showed:
-                print("matched_target_metric: ", matched_target_metric, ", metrics_keys: ", metrics_keys)
-            if matched_target_metric and ea.scalars.Items(matched_target_metric):
-                best_trgt_mtrc = _get_best_target_metric_record(ea.scalars.Items(matched_target_metric))
-                if is_process_showed:
-                    print("matched_target_metric: ", matched_target_metric, ", best_trgt_mtrc: ", best_trgt_mtrc)
-                for de_mtrc in desired_metrics:
-                    if de_mtrc in metrics_keys and ea.scalars.Items(de_mtrc):
-                        matched_record = _get_matched_record(ea.scalars.Items(de_mtrc), best_trgt_mtrc.step)
-                        if is_process_showed:
-                            print("de_mtrc: ", de_mtrc, ", matched_record: ", matched_record) 
-                        matched_metrics[de_mtrc].append(matched_record)
-                best_target_metrics.append(best_trgt_mtrc)
-                
-        if not best_target_metrics:
-            return None, "", -1
-        final_best_trgt_mtrc = _get_best_target_metric_record(best_target_metrics)
-        best_record = ""        
-        for de_mtrc in desired_metrics:
-            having_match_metrics = len(matched_metrics[de_mtrc]) > 0
-            if having_match_metrics:
-                final_mtch_rcrd = _get_matched_record(matched_metrics[de_mtrc], final_best_trgt_mtrc.step)
-                best_record += f"{de_mtrc}: {final_mtch_rcrd.value}, "
-                if de_mtrc == "epoch":
-                    epoch = int(final_mtch_rcrd.value)
-        return final_best_trgt_mtrc.value, best_record, epoch
-
+        metrics_index = get_metrics_index(folder.parent.parent)
+        metrics_index.update(folder)
+        best_metrics_record = metrics_index.get_best_metrics_record(folder, target_metric=target_metric)
+        if is_process_showed:
+            print("index update: ", metrics_index.stats, ", tags: ", metrics_index.get_tags(folder), ", best: ", best_metrics_record)
+        return best_metrics_record
 
     @classmethod
     def print_existing_model_version_and_info(cls, model_folder):
         """Print out existing model version name and its info"""
         if isinstance(model_folder, str):
             model_folder = Path(model_folder)
+        metrics_index = get_metrics_index(model_folder.parent)
+        metrics_index.update(model_folder)
         
         print_dict = {}
         for version_folder in model_folder.glob("*v[0-9]*"): 
             config = ConfigHandler.load_config(version_folder)
             other_setting = config['other_settings'] if config else "No Config"
             ckpt_files = ', '.join([ckpt_path.name for ckpt_path in version_folder.glob("**/*.ckpt")])
-            _, best_record, _ = cls.get_best_metrics_record(version_folder)
+            _, best_record, _ = metrics_index.get_best_metrics_record(version_folder)
             print_dict[version_folder.name] = (other_setting, ckpt_files, best_record)
         print('Existing Versions: \n', json.dumps(print_dict, sort_keys=True, indent=8))
 
@@ -420,22 +355,18 @@ class ModelFileHandler:
         model_folder = root_model_folder / raw_model_type
         assert model_folder.exists(), f"target model type not exists, please check model type again {[model_type.name for model_type in root_model_folder.glob('*')]}"
         
-        version_metrics = []
-        for version_folder in model_folder.glob("*v[0-9]*"): 
-            ckpt_paths = ', '.join([ckpt_path for ckpt_path in version_folder.glob("**/*.ckpt")])
-            target_metric_value, best_record, epoch = cls.get_best_metrics_record(version_folder, target_metric=target_metric)            
-            if target_metric_value:
-                version_metrics.append([target_metric_value, version_folder, epoch])
-        
-        _, best_version_folder, best_epoch = sorted(version_metrics, key=lambda elems: elems[0])[-1]
-        best_ckpt_path = best_version_folder/f"epoch={best_epoch}.ckpt"
-        i = 0
-        while 1:
-            i += 1
-            best_ckpt_path = best_version_folder/f"epoch={best_epoch-i}.ckpt"
-            if best_ckpt_path.exists(): break
-            best_ckpt_path = best_version_folder/f"epoch={best_epoch+i}.ckpt"
-            if best_ckpt_path.exists(): break
+        metrics_index = get_metrics_index(root_model_folder)
+        metrics_index.update(model_folder)
+        version_metrics = [elems for elems in metrics_index.get_best_versions(model_folder, target_metric=target_metric) if re.search("v[0-9]", elems[1].name)]
+        assert version_metrics, f"no {target_metric} logged under {model_folder}"
+        _, best_version_folder, best_epoch = version_metrics[0]
+
+        # checkpoints recorded by CheckpointCatalogCallback, then the checkpoint closest to the best epoch for legacy folders
+        catalog = CheckpointCatalog(best_version_folder / "checkpoints")
+        best_ckpt_path = catalog.get_best(target_metric) or catalog.get_by_epoch(best_epoch)
+        if best_ckpt_path is None:
+            best_ckpt_path = find_nearest_ckpt(best_version_folder, best_epoch)
+        assert best_ckpt_path is not None, f"no checkpoint found in {best_version_folder}"
         return best_ckpt_path
 
     @classmethod
@@ -688,6 +619,8 @@ class ConfigHandler:
             for k, v in CFG.__dict__.items():
                 print(f"    {k}:  {v}")
 
+NOISED_TXT_PATH = ROOT+"/data_txt/noised_train_balanced_images.txt"
+
 class NoisyStudentDataHandler:
     """A class of methods handling noisy student architecture data"""
     __slots__ = []
@@ -705,44 +638,52 @@ class NoisyStudentDataHandler:
         return pseudo_labels
 
     @classmethod
-    def get_noisy_student_data(cls, student_iter=0, noised_txt_path=ROOT+"/data_txt/noised_train_balanced_images.txt"):
+    def get_noisy_student_data(cls, student_iter=0, noised_txt_path=NOISED_TXT_PATH, pseudo_label_manifest_path=None):
+        """pseudo_label_manifest_path: pseudo labels of the iteration (see pseudo_label.py), used instead of the
+        noised labels when the manifest exists
+        """
         noised_labels, cleaned_labels = None, None
 
-        noised_image_paths, noised_int_labels = FileHandler.read_path_and_label_from_txt(noised_txt_path)
+        if pseudo_label_manifest_path and os.path.exists(pseudo_label_manifest_path):
+            print(f"student iter {student_iter}: pseudo labels of {pseudo_label_manifest_path}")
+            noised_image_paths, noised_int_labels = Manifest.load(pseudo_label_manifest_path).to_paths_and_labels()
+        else:
+            if student_iter > 1:
+                print(f"WARNING: student iter {student_iter} has no pseudo labels ({pseudo_label_manifest_path} does not exist), "
+                      f"falling back to the noisy labels of {noised_txt_path}")
+            noised_image_paths, noised_int_labels = FileHandler.read_path_and_label(noised_txt_path)
         cleaned_image_paths, cleaned_int_labels, valid_image_paths, valid_int_labels = FileHandler.get_paths_and_int_labels(train_type='cleaned')
 
         return ( noised_image_paths, noised_int_labels,
                  cleaned_image_paths, cleaned_int_labels,
                  valid_image_paths, valid_int_labels )
 
-    @classmethod
-    def _make_noisy_student_training_data_once(cls):
-        cleaned_image_paths, cleaned_int_labels, valid_image_paths, valid_int_labels = FileHandler.get_paths_and_int_labels(train_type='cleaned')
-        
-        df_all, df_revised, df_checked = FileHandler.load_target_dfs()
-        df_revised_not_used = df_revised[~(df_revised['path'].isin(cleaned_image_paths + valid_image_paths))] # there are some 
-        
-        df_noised = df_all[~df_all['path'].isin(df_checked['path'])].groupby('label').sample(100, replace=True)
-        noised_image_paths, noised_int_labels = df_noised['path'].to_list(), df_noised['int_label'].to_list()
-        noised_image_paths += df_revised_not_used['path'].to_list()
-        noised_int_labels += df_revised_not_used['int_label'].to_list()
-        noised_txt_path = ROOT + '/data_txt/noised_train_balanced_images.txt'
-        FileHandler.save_paths_and_labels_as_txt(noised_txt_path, noised_image_paths, noised_int_labels)
 
 
 
+@lru_cache(maxsize=None)
+def get_word_classes():
+    """Word classes (+ 'isnull'), read from the label file on the first call"""
+    return FileHandler.get_word_classes_dict()
+
+@lru_cache(maxsize=None)
+def _get_word2int_label_dict():
+    word_classes = get_word_classes()
+    return dict(zip(word_classes, range(len(word_classes))))
 
-word_classes = FileHandler.get_word_classes_dict()
+def __getattr__(name):
+    # module attribute word_classes, kept for `from .utils import word_classes`
+    if name == 'word_classes':
+        return get_word_classes()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # data functions
 def word2int_label(label):
     """Transform word classes into integer labels (0~800)"""
-    word2int_label_dict = dict(zip(word_classes, range(len(word_classes))))
-    return word2int_label_dict[label]
+    return _get_word2int_label_dict()[label]
 
 def int_label2word(int_label):
     """Transform integer labels into word classes"""
     if isinstance(int_label, str):
         int_label = int(int_label)
-    int_label2word_dict = dict(zip(range(len(word_classes)), word_classes))
-    return int_label2word_dict[int_label]
+    return get_word_classes()[int_label]